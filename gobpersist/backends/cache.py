@@ -20,9 +20,13 @@
 """
 
 import itertools
+import threading
+import time
+import hashlib
 
 import gobpersist.session
 import gobpersist.exception
+import gobpersist.backends.lru
 
 class CachingBackend(gobpersist.session.Backend):
     """A generic caching back end, using any cache back end and any
@@ -37,40 +41,296 @@ class CachingBackend(gobpersist.session.Backend):
     should be available in the cache, although cache invalidation may
     cause the next request to fail.  In that case, the caching query
     will loop and try to call ``cache_refill`` again.
+
+    A commit invalidates everything cached for the objects and keys it
+    touches.  With ``write_through``, the objects added and updated
+    are instead replaced in the cache by their new versions, so that
+    only the results of queries on their keys need to be refilled.
+
+    Only one refill of any one query is run at a time.  Within a
+    process, other threads missing the same query wait for the refill
+    in progress; across processes, the refill is guarded by a lease
+    taken through the cache's ``acquire_lease``, and other processes
+    wait for the cache to be filled, for up to ``lease_time`` seconds.
     """
-    def __init__(self, cache, backend):
+    def __init__(self, cache, backend, lease_time=5, lease_wait=0.05,
+                 serve_stale=False, stale_size=1024, negative_expiry=5,
+                 write_through=False, stale_age=60):
         """
         Args:
            ``cache``: The back end which is to operate as a cache.
 
            ``backend``: The "real" back end for the cache.
+
+           ``lease_time``: The longest time, in seconds, for which
+           one process may hold the right to refill a query, or
+           ``None`` to refill without a lease.
+
+           ``lease_wait``: The time, in seconds, to wait between
+           looking in the cache while another process refills it.
+
+           ``serve_stale``: Whether a query which another thread or
+           process is refilling should be answered with the result
+           this process last retrieved for it, if any, rather than
+           waiting.
+
+           ``stale_size``: The number of results to keep for
+           ``serve_stale``.
+
+              A result is forgotten when a commit through this back
+              end invalidates any of its keys, so this process always
+              sees its own writes.
+
+           ``negative_expiry``: The time, in seconds, for which the
+           cache should remember that a key was not found in the back
+           end, or ``None`` not to remember misses at all.
+
+              A miss is forgotten early when a commit invalidates the
+              key, but a miss recorded just as another process adds
+              the key may be served for this long.
+
+           ``write_through``: Whether a commit should store the
+           objects it adds and updates in the cache, rather than
+           leaving them to be refilled by the next query.
+
+              The results of queries on their keys are still
+              invalidated.
+
+           ``stale_age``: The longest time, in seconds, for which a
+           result may be kept for ``serve_stale``.
         """
         self.backend = backend
         """The "real" back end for the cache."""
         self.cache = cache
         """The back end which is to operate as a cache."""
 
+        self.lease_time = lease_time
+        """The longest time, in seconds, for which one process may
+        hold the right to refill a query, or ``None`` to refill
+        without a lease."""
+
+        self.lease_wait = lease_wait
+        """The time, in seconds, to wait between looking in the cache
+        while another process refills it."""
+
+        self.serve_stale = serve_stale
+        """Whether a query which is being refilled elsewhere should be
+        answered with the result this process last retrieved for it,
+        if any, rather than waiting."""
+
+        self.stale = gobpersist.backends.lru.LRUCache(max_size=stale_size)
+        """The results last retrieved for each query, for
+        ``serve_stale``.
+
+        Each is a tuple of the time it was retrieved, the keys on
+        which it depends, and a list of classes and cache
+        dictionaries.
+        """
+
+        self.stale_age = stale_age
+        """The longest time, in seconds, for which a result may be
+        kept for ``serve_stale``."""
+
+        self.negative_expiry = negative_expiry
+        """The time, in seconds, for which the cache should remember
+        that a key was not found in the back end, or ``None`` not to
+        remember misses at all."""
+
+        self.write_through = write_through
+        """Whether a commit should store the objects it adds and
+        updates in the cache, rather than leaving them to be refilled
+        by the next query."""
+
+        self.flights = {}
+        """Events for the refills in progress in this process, by
+        query."""
+
+        self.flights_lock = threading.Lock()
+        """Protects ``flights``."""
+
+
+    def _flight_key(self, cls, key, key_range, query, retrieve, order,
+                    offset, limit):
+        """A string identifying a query, for coalescing refills."""
+        return hashlib.sha1(repr((
+                    cls.__module__, cls.__name__,
+                    None if key is None else self.cache.key_to_mykey(key),
+                    None if key_range is None \
+                        else tuple([self.cache.key_to_mykey(k) \
+                                        for k in key_range]),
+                    None if query is None \
+                        else self.cache.query_digest(cls, query),
+                    None if retrieve is None \
+                        else tuple(sorted(self.cache.retrieve_to_myretrieve(
+                                    cls, retrieve))),
+                    None if order is None \
+                        else self.cache.canonical_order(cls, order),
+                    offset, limit))).hexdigest()
+
+    def _get_stale(self, flight_key):
+        stale = self.stale.get(flight_key)
+        if stale is None:
+            return None
+        if stale[0] + self.stale_age < time.time():
+            self.stale.pop(flight_key)
+            return None
+        return [self.cache.mygob_to_gob(cls, mygob) \
+                    for cls, mygob in stale[2]]
+
+    def _dependencies(self, items, use_persisted_version=False):
+        """The keys under which each of ``items`` is stored."""
+        for gob in items:
+            yield self.cache.key_to_mykey(gob.obj_key, use_persisted_version)
+            for key in itertools.chain(
+                    gob.unique_keyset(use_persisted_version),
+                    gob.keyset(use_persisted_version)):
+                yield self.cache.key_to_mykey(key, use_persisted_version)
+
+    def _put_stale(self, flight_key, key, key_range, res):
+        deps = set(self._dependencies(res))
+        if key is not None:
+            deps.add(self.cache.key_to_mykey(key))
+        if key_range is not None:
+            deps.update([self.cache.key_to_mykey(k) for k in key_range])
+        self.stale.put(flight_key,
+                       (time.time(), frozenset(deps),
+                        [(gob.__class__, self.cache.gob_to_mygob(gob)) \
+                             for gob in res]))
+
+    def _drop_stale(self, items, keys):
+        """Forget the stale results depending on ``items`` or
+        ``keys``."""
+        if not len(self.stale):
+            return
+        deps = set(itertools.chain(self._dependencies(items),
+                                   self._dependencies(items, True)))
+        deps.update([self.cache.key_to_mykey(key) for key in keys])
+        for gob in items:
+            for consistence in gob.consistency:
+                if consistence.get('invalidate') == 'cascade':
+                    deps.add(self.cache.key_to_mykey(
+                            consistence['foreign_obj']))
+        for flight_key, stale in self.stale.items():
+            if not deps.isdisjoint(stale[1]):
+                self.stale.pop(flight_key)
 
     def query(self, cls, key=None, key_range=None, query=None, retrieve=None,
               order=None, offset=None, limit=None):
+        flight_key = None
         while True:
             try:
                 return self.cache.query(cls, key, key_range, query,
                                         retrieve, order, offset, limit)
+            except gobpersist.exception.CachedNotFound:
+                # the back end has nothing either
+                raise
             except gobpersist.exception.NotFound:
                 # couldn't find it in cache
-                cache_refill = getattr(self.backend, 'cache_refill', None)
+                pass
+            if flight_key is None:
+                flight_key = self._flight_key(cls, key, key_range, query,
+                                              retrieve, order, offset, limit)
+            with self.flights_lock:
+                flight = self.flights.get(flight_key)
+                leader = flight is None
+                if leader:
+                    flight = self.flights[flight_key] = threading.Event()
+            if not leader:
+                # Another thread is refilling; wait for it and look
+                # again.
+                if self.serve_stale:
+                    res = self._get_stale(flight_key)
+                    if res is not None:
+                        return res
+                flight.wait(self.lease_time)
+                continue
+            try:
+                res = self._refill(flight_key, cls, key, key_range, query,
+                                   retrieve, order, offset, limit)
+            finally:
+                with self.flights_lock:
+                    del self.flights[flight_key]
+                flight.set()
+            if res is not None:
+                return res
+
+    def _refill(self, flight_key, cls, key, key_range, query, retrieve,
+                order, offset, limit):
+        """Refill the cache for a query, unless another process holds
+        the lease to do so.
+
+        Returns the result of the query if it was found in the cache
+        while waiting for another process, or ``None`` once the cache
+        has been refilled.
+        """
+        leased = self.lease_time is None \
+            or self.cache.acquire_lease(flight_key, self.lease_time)
+        if not leased:
+            if self.serve_stale:
+                res = self._get_stale(flight_key)
+                if res is not None:
+                    return res
+            deadline = time.time() + self.lease_time
+            while time.time() < deadline:
+                time.sleep(self.lease_wait)
+                try:
+                    return self.cache.query(cls, key, key_range, query,
+                                            retrieve, order, offset, limit)
+                except gobpersist.exception.CachedNotFound:
+                    raise
+                except gobpersist.exception.NotFound:
+                    pass
+            # The lease has lapsed without the cache being filled;
+            # refill it ourselves.
+        try:
+            cache_refill = getattr(self.backend, 'cache_refill', None)
+            try:
                 if cache_refill is not None:
                     cache_refill(self.cache, cls, key, key_range, query,
                                  retrieve, order, offset, limit)
                 else:
+                    ticket = self.cache.refill_ticket(cls, key, key_range)
                     res = self.backend.query(cls, key, key_range, query,
                                              retrieve, order, offset,
                                              limit)
                     self.cache.cache_query(cls, res, key, key_range, query,
                                            retrieve, order, offset,
-                                           limit)
+                                           limit, ticket=ticket)
+                    if self.serve_stale:
+                        self._put_stale(flight_key, key, key_range, res)
                     # return res
+            except gobpersist.exception.NotFound:
+                if self.negative_expiry is not None:
+                    self.cache.cache_miss(cls, key, key_range,
+                                          self.negative_expiry)
+                raise
+        finally:
+            if leased and self.lease_time is not None:
+                self.cache.release_lease(flight_key)
+        return None
+
+    def multi_query(self, cls, keys):
+        ret = self.cache.multi_query(cls, keys)
+        missing = [i for i, res in enumerate(ret) if res is None]
+        if not missing:
+            return ret
+        tickets = [self.cache.refill_ticket(cls, keys[i]) for i in missing]
+        found = self.backend.multi_query(cls, [keys[i] for i in missing])
+        for i, ticket, res in itertools.izip(missing, tickets, found):
+            if res is None:
+                if self.negative_expiry is not None:
+                    self.cache.cache_miss(cls, keys[i], None,
+                                          self.negative_expiry)
+                continue
+            self.cache.cache_query(cls, res, keys[i], ticket=ticket)
+            ret[i] = res
+        return ret
+
+    def bulk_add(self, gobs):
+        ret = self.backend.bulk_add(gobs)
+        self.cache.invalidate(gobs, [])
+        self._drop_stale(gobs, [])
+        return ret
 
     def commit(self, additions=[], updates=[], removals=[],
                collection_additions=[], collection_removals=[]):
@@ -88,10 +348,27 @@ class CachingBackend(gobpersist.session.Backend):
                 key_invalidate.update(op['remove_keys'])
             gob_invalidate.append(op['gob'])
 
+        written = {}
+        if self.write_through:
+            for op in itertools.chain(additions, updates):
+                written[id(op['gob'])] = op['gob']
+        if written:
+            ticket = self.cache.write_ticket(written.values())
+
         ret = self.backend.commit(additions, updates, removals,
                                   collection_additions,
                                   collection_removals)
-        self.cache.invalidate(gob_invalidate, key_invalidate)
+        if written:
+            # Whatever the back end changed in committing takes
+            # precedence over what was given.
+            for gob, newgob in ret:
+                if id(gob) in written:
+                    written[id(gob)] = newgob
+            self.cache.replace_items(written.values(), ticket,
+                                     gob_invalidate, key_invalidate)
+        else:
+            self.cache.invalidate(gob_invalidate, key_invalidate)
+        self._drop_stale(gob_invalidate, key_invalidate)
         return ret
 
 
@@ -104,12 +381,53 @@ class Cache(gobpersist.session.GobTranslator):
         raise NotImplementedError("Cache type '%s' does not implement" \
                                       " query" % self.__class__.__name__)
 
+    def multi_query(self, cls, keys):
+        """Query the cache for each of ``keys`` at once.
+
+        Returns a list holding, for each key, the list of gob objects
+        cached for it, or ``None`` if nothing usable is cached.  By
+        default, this simply calls :func:`query` for each key.
+        """
+        ret = []
+        for key in keys:
+            try:
+                ret.append(self.query(cls, key=key))
+            except gobpersist.exception.NotFound:
+                ret.append(None)
+        return ret
+
+    def refill_ticket(self, cls, key=None, key_range=None):
+        """Note the state of the cache for ``key`` or ``key_range``
+        before the back end is queried to refill it.
+
+        Returns a value to be passed as the ``ticket`` of
+        :func:`cache_query` once the back end has answered, so that
+        the result is not stored as any newer than the state in which
+        the query began.  By default, this is ``None``.
+        """
+        return None
+
     def cache_query(self, cls, items, key=None, key_range=None, query=None,
-                    retrieve=None, order=None, offset=None, limit=None):
-        """Store the results of a query in the cache."""
+                    retrieve=None, order=None, offset=None, limit=None,
+                    ticket=None):
+        """Store the results of a query in the cache.
+
+        ``ticket``, if given, is what :func:`refill_ticket` returned
+        before the query was made.
+        """
         raise NotImplementedError("Cache type '%s' does not implement" \
                                       " cache_query" % self.__class__.__name__)
 
+    def cache_miss(self, cls, key=None, key_range=None, expiry=None):
+        """Record that the back end has nothing for ``key`` or
+        ``key_range``, for ``expiry`` seconds.
+
+        Until then, or until the key is invalidated, :func:`query`
+        may raise :class:`gobpersist.exception.CachedNotFound` for
+        it.  By default, nothing is recorded.
+        """
+        pass
+
     def cache_items(self, items):
         """Store the provided items in the cache."""
         raise NotImplementedError("Cache type '%s' does not implement" \
@@ -120,3 +438,41 @@ class Cache(gobpersist.session.GobTranslator):
         raise NotImplementedError("Cache type '%s' does not implement" \
                                       " invalidate" % self.__class__.__name__)
 
+    def write_ticket(self, items):
+        """Note the state of the cache for ``items`` before they are
+        committed to the back end.
+
+        Returns a value to be passed as the ``ticket`` of
+        :func:`replace_items` once the commit is done, so that a
+        version cached in the meantime is not overwritten.  By
+        default, this is ``None``.
+        """
+        return None
+
+    def replace_items(self, items, ticket=None, others=None, keys=None):
+        """Store the provided items in place of the versions cached,
+        and invalidate all queries pertaining to them, to the objects
+        ``others`` and to ``keys``.
+
+        ``ticket`` is what :func:`write_ticket` returned before the
+        items were committed.  Caches should replace the items without
+        removing them first, so that readers do not miss them in the
+        meantime; by default, this simply calls :func:`invalidate`
+        and then :func:`cache_items`.
+        """
+        self.invalidate(list(items) + list(others or ()), keys)
+        self.cache_items(items)
+
+    def acquire_lease(self, name, lease_time):
+        """Try to take the lease called ``name`` for ``lease_time``
+        seconds, returning true if successful.
+
+        Caches shared between processes should override this; by
+        default, every lease is granted.
+        """
+        return True
+
+    def release_lease(self, name):
+        """Give up the lease called ``name``."""
+        pass
+
@@ -21,193 +21,493 @@
 """
 
 import operator
-import functools
-import types
+import itertools
+import heapq
+import zlib
 
 import gobpersist.gob
 import gobpersist.exception
 import gobpersist.field
 import gobpersist.session
+import gobpersist.backends.lru
 
 class GobKVQuerent(gobpersist.session.Backend):
     """Abstract superclass for classes that aren't able to implement
     complex queries.
     """
 
-    def _get_value_recursiter(self, gob, arg, path=None):
-        """Turn an argument into a value, iterator version."""
-        if isinstance(arg, tuple):
-            # identifier
-            if path is None:
-                path = list(arg)
-            value = gob
-            if len(path) == 0:
-                raise gobpersist.exception.QueryError("Could not understand " \
-                                                          "identifier %s" \
-                                                          % repr(arg))
-            pathelem = path.pop(0)
-            if isinstance(pathelem, gobpersist.field.Field):
-                pathelem = getattr(value, pathelem._name)
-            else:
-                pathelem = getattr(value, pathelem)
-            if isinstance(pathelem, gobpersist.field.ForeignObject):
-                for r in self._get_value_recursiter(pathelem.value, arg, path):
-                    yield r
-            elif isinstance(pathelem, gobpersist.field.ForeignCollection):
-                for item in pathelem.list():
-                    for r in self._get_value_recursiter(item, arg, list(path)):
-                        yield r
-            elif len(path) != 0:
-                raise gobpersist.exception.QueryError("Could not understand " \
-                                                          "identifier %s" \
-                                                          % repr(arg))
+    compiled_queries = gobpersist.backends.lru.LRUCache(max_size=1024)
+    """Compiled query predicates, keyed by class and the digest of
+    the query."""
+
+    def compile_query(self, cls, query, cache=True):
+        """Compile a query against objects of class ``cls``.
+
+        Returns a function taking a gob and returning ``True`` if it
+        matches the query and ``False`` otherwise.  Identifiers are
+        resolved against ``cls`` once, so any error in the query is
+        raised as a :class:`gobpersist.exception.QueryError` here
+        rather than when the query is executed.
+
+        Unless ``cache`` is ``False``, the compiled query is kept in
+        :attr:`compiled_queries` for reuse.
+        """
+        if not cache:
+            return self._compile_query(cls, query)
+        key = (cls, self.query_digest(cls, query))
+        ret = self.compiled_queries.get(key)
+        if ret is None:
+            ret = self._compile_query(cls, query)
+            self.compiled_queries.put(key, ret)
+        return ret
+
+
+    def _compile_query(self, cls, query):
+        """Compile a query, without caching."""
+        predicates = []
+        for cmd, args in query.iteritems():
+            if cmd in ('eq', 'ne', 'lt', 'gt', 'ge', 'le'):
+                op = getattr(operator, cmd)
+                for arg1, arg2 in zip(args[:-1], args[1:]):
+                    predicates.append(
+                        self._compile_comparison(cls, op, arg1, arg2))
+            elif cmd == 'and':
+                predicates.extend([self._compile_query(cls, subquery) \
+                                       for subquery in args])
+            elif cmd == 'or':
+                subpredicates = [self._compile_query(cls, subquery) \
+                                     for subquery in args]
+                def predicate(gob, subpredicates=subpredicates):
+                    for subpredicate in subpredicates:
+                        if subpredicate(gob):
+                            return True
+                    return False
+                predicates.append(predicate)
+            elif cmd in ('nor', 'not'):
+                subpredicates = [self._compile_query(cls, subquery) \
+                                     for subquery in args]
+                def predicate(gob, subpredicates=subpredicates):
+                    for subpredicate in subpredicates:
+                        if subpredicate(gob):
+                            return False
+                    return True
+                predicates.append(predicate)
             else:
-                yield pathelem
-        else: # literal
-            yield arg
+                raise gobpersist.exception.QueryError("Unknown query element " \
+                                                          "%s" % repr(cmd))
+        if not predicates:
+            return lambda gob: True
+        elif len(predicates) == 1:
+            return predicates[0]
+        def predicate(gob):
+            for subpredicate in predicates:
+                if not subpredicate(gob):
+                    return False
+            return True
+        return predicate
 
 
-    def _get_value(self, gob, arg):
-        """Turn an argument into a value."""
-        ret = []
-        for value in self._get_value_recursiter(gob, arg):
-            ret.append(value)
-        if not ret:
-            raise gobpersist.exception.QueryError("Could not understand " \
-                                                      "identifier %s" \
-                                                      % repr(arg))
-        elif len(ret) > 1:
-            return ret
+    def _compile_comparison(self, cls, op, arg1, arg2):
+        """Compile the application of ``op`` to two arguments, taking
+        quantifiers into account."""
+        quant1, get1 = self._compile_argument(cls, arg1)
+        quant2, get2 = self._compile_argument(cls, arg2)
+        if quant1 is None and quant2 is None:
+            return lambda gob: op(get1(gob), get2(gob))
+        elif quant2 is None:
+            return lambda gob: quant1(op(value, get2(gob)) \
+                                          for value in get1(gob))
+        elif quant1 is None:
+            return lambda gob: quant2(op(get1(gob), value) \
+                                          for value in get2(gob))
         else:
-            return ret[0]
+            return lambda gob: quant1(quant2(op(value1, value2) \
+                                                 for value2 in get2(gob)) \
+                                          for value1 in get1(gob))
+
 
+    def _compile_argument(self, cls, arg):
+        """Compile an argument to an operator.
 
-    def _apply_operator(self, gob, op, arg1, arg2):
-        """Apply operator to the two arguments, taking quantifiers
-        into account.
+        Returns a pair ``(quantifier, getter)``.  If the argument is
+        quantified, ``quantifier`` is a function reducing an iterable
+        of booleans to one, and ``getter`` returns the list of values to
+        which it applies; otherwise, ``quantifier`` is ``None`` and
+        ``getter`` returns a single value.
         """
-        #print "applying operator %s to %s and %s" % (repr(op),
-        #                                             repr(arg1),
-        #                                             repr(arg2))
-        if isinstance(arg1, dict):
-            if len(arg1) > 1:
+        if isinstance(arg, dict):
+            if len(arg) > 1:
                 raise gobpersist.exception.QueryError("Too many keys in " \
                                                           "quantifier")
-            k, v = arg1.items()[0]
-            v = self._get_value_recursiter(gob, v)
+            k, v = arg.items()[0]
             if k == 'any':
-                for arg1 in v:
-                    if self._apply_operator(gob, op, arg1, arg2):
-                        return True
-                return False
+                quantifier = any
             elif k == 'all':
-                for arg1 in v:
-                    if not self._apply_operator(gob, op, arg1, arg2):
-                        return False
-                return True
+                quantifier = all
             elif k == 'none':
-                for arg1 in v:
-                    if self._apply_operator(gob, op, arg1, arg2):
-                        return False
-                return True
+                quantifier = lambda results: not any(results)
             else:
                 raise gobpersist.exception.QueryError("Invalid key '%s' in " \
                                                           "quantifier" % k)
-        elif isinstance(arg2, dict):
-            if len(arg2) > 1:
-                raise gobpersist.exception.QueryError("Too many keys in " \
-                                                          "quantifier")
-            k, v = arg2.items()[0]
-            v = self._get_value_recursiter(gob, v)
-            if k == 'any':
-                for arg2 in v:
-                    if self._apply_operator(gob, op, arg1, arg2):
-                        return True
-                return False
-            elif k == 'all':
-                for arg2 in v:
-                    if not self._apply_operator(gob, op, arg1, arg2):
-                        return False
-                return True
-            elif k == 'none':
-                for arg2 in v:
-                    if self._apply_operator(gob, op, arg1, arg2):
-                        return False
-                return True
-            else:
-                raise gobpersist.exception.QueryError("Invalid key '%s' " \
-                                                          "in quantifier" % k)
+            if isinstance(v, tuple):
+                many, getter = self._compile_identifier(cls, v)
+                if not many:
+                    return (quantifier, lambda gob: [getter(gob)])
+                return (quantifier, getter)
+            while isinstance(v, gobpersist.field.Field):
+                v = v.value
+            values = [v]
+            return (quantifier, lambda gob: values)
+        elif isinstance(arg, tuple):
+            many, getter = self._compile_identifier(cls, arg)
+            if not many:
+                return (None, getter)
+            def get_value(gob):
+                ret = getter(gob)
+                if not ret:
+                    raise gobpersist.exception.QueryError(
+                        "Could not understand identifier %s" % repr(arg))
+                elif len(ret) > 1:
+                    return ret
+                else:
+                    return ret[0]
+            return (None, get_value)
         else:
-            return op(self._get_value(gob, arg1), self._get_value(gob, arg2))
+            # literal
+            while isinstance(arg, gobpersist.field.Field):
+                arg = arg.value
+            return (None, lambda gob: arg)
+
+
+    def _compile_identifier(self, cls, idnt):
+        """Compile an identifier into an accessor.
+
+        Returns a pair ``(many, getter)``.  If the identifier passes
+        through a foreign collection, ``many`` is ``True`` and
+        ``getter`` returns the list of values found; otherwise
+        ``getter`` returns the single value.
+        """
+        if len(idnt) == 0:
+            raise gobpersist.exception.QueryError("Could not understand " \
+                                                      "identifier %s" \
+                                                      % repr(idnt))
+        steps = []
+        for pathelem in idnt:
+            if cls is None:
+                raise gobpersist.exception.QueryError("Could not understand " \
+                                                          "identifier %s" \
+                                                          % repr(idnt))
+            if isinstance(pathelem, gobpersist.field.Field):
+                pathelem = pathelem._name
+            f = getattr(cls, pathelem, None)
+            if isinstance(f, gobpersist.field.ForeignObject):
+                steps.append((pathelem, False))
+                cls = f.foreign_class
+            elif isinstance(f, gobpersist.field.ForeignCollection):
+                steps.append((pathelem, True))
+                cls = f.foreign_class
+            elif f is None:
+                raise gobpersist.exception.QueryError("Could not understand " \
+                                                          "identifier %s" \
+                                                          % repr(idnt))
+            else:
+                steps.append((pathelem, None))
+                cls = None
+        name, collection = steps.pop()
+        if collection is not None:
+            # ends in a foreign field
+            raise gobpersist.exception.QueryError("Could not understand " \
+                                                      "identifier %s" \
+                                                      % repr(idnt))
+        getter = operator.attrgetter(name)
+        many = False
+        for name, collection in reversed(steps):
+            if collection:
+                if many:
+                    getter = self._collection_step(name, getter)
+                else:
+                    getter = self._collection_step(
+                        name, lambda gob, getter=getter: [getter(gob)])
+                many = True
+            else:
+                getter = self._object_step(name, getter)
+        return (many, getter)
+
+
+    def _object_step(self, name, getter):
+        """Accessor following the foreign object ``name``."""
+        return lambda gob: getter(getattr(gob, name).value)
+
+
+    def _collection_step(self, name, getter):
+        """Accessor following the foreign collection ``name``."""
+        return lambda gob: [value \
+                                for item in getattr(gob, name).list() \
+                                for value in getter(item)]
 
 
     def _execute_query(self, gob, query):
         """Execute a query on an object, returning True if it matches
         the query and False otherwise."""
-        #print "executing %s on %s" % (repr(query), repr(gob))
-        for cmd, args in query.iteritems():
-            if cmd in ('eq', 'ne', 'lt', 'gt', 'ge', 'le'):
-                if len(args) < 2:
+        return self.compile_query(gob.__class__, query, cache=False)(gob)
+        
+
+    def _compile_order(self, cls, order):
+        """Compile an ordering into a function returning the sort key
+        of a gob."""
+        getters = []
+        for ordering in order:
+            if not isinstance(ordering, dict) or not len(ordering) == 1:
+                raise ValueError("Invalid ordering: %s" % repr(ordering))
+            key, ordering = ordering.items()[0]
+            if key not in ('asc', 'desc'):
+                raise ValueError("Invalid key '%s' in ordering %s" \
+                                     % (key, repr(ordering)))
+            if not isinstance(ordering, tuple):
+                ordering = (ordering,)
+            quantifier, getter = self._compile_argument(cls, ordering)
+            getters.append((getter, key == 'desc'))
+        def sort_key(gob):
+            ret = []
+            for getter, descending in getters:
+                value = _raw_value(getter(gob))
+                ret.append(_Reversed(value) if descending else value)
+            return tuple(ret)
+        return sort_key
+
+
+    collection_buckets = None
+    """The number of buckets in which to store new collections, or
+    ``None`` to store each collection as a single list.
+
+    A bucketed collection is stored as a head record,
+    ``{'_BUCKETS_': n}``, under the collection's key, and as ``n``
+    bucket records, each a list of members, under the collection's
+    key followed by ``'_BUCKET_'`` and the number of the bucket.
+    Members are assigned to buckets by hash, so adding or removing a
+    member rewrites only one bucket.  A missing bucket is empty.
+
+    Collections already stored as a single list continue to be read
+    and updated as such.  The number of buckets should not be changed
+    once bucketed collections exist.
+    """
+
+    def _is_bucket_head(self, store):
+        """Whether a stored value is the head of a bucketed
+        collection."""
+        return isinstance(store, dict) and len(store) == 1 \
+            and '_BUCKETS_' in store
+
+    def _bucket_key(self, key, bucket):
+        """The key of a bucket of the collection at ``key``."""
+        return tuple(key) + ('_BUCKET_', str(bucket))
+
+    def _bucket_keys(self, key, buckets):
+        """The keys of all the buckets of the collection at ``key``."""
+        return [self._bucket_key(key, i) for i in xrange(buckets)]
+
+    def _bucket_for(self, member, buckets):
+        """The bucket to which the member key ``member`` belongs."""
+        return (zlib.crc32(self.separator.join(member)) & 0xffffffff) \
+            % buckets
+
+    def bulk_add(self, gobs):
+        # Work directly with the key strings, rather than going
+        # through the full generality of commit.
+        records = {}
+        unique = {}
+        collection_add = []
+        for gob in gobs:
+            gob_key = self.key_to_mykey(gob.obj_key)
+            records[self.separator.join(gob_key)] = self.gob_to_mygob(gob)
+            for key in gob.unique_keyset():
+                key = self.separator.join(self.key_to_mykey(key))
+                if key in unique and unique[key] != gob_key:
+                    raise gobpersist.exception.Corruption(
+                        "Duplicate addition of unique key %s detected" \
+                            % key)
+                unique[key] = gob_key
+            for key in gob.keyset():
+                collection_add.append((self.key_to_mykey(key), gob_key))
+        self.kv_bulk_write(records, collection_add, unique)
+        return []
+
+    def kv_bulk_write(self, records, collection_add, unique={}):
+        """Write many records at once, for :func:`bulk_add`.
+
+        ``records`` is a dictionary from key strings to the values,
+        not yet serialized, to store there.  ``collection_add`` is a
+        list of ``(key, member)`` pairs of key tuples to be added to
+        collections, as for :func:`_collection_changes`.  ``unique``
+        is a dictionary from unique key strings to the key tuples of
+        the objects they are to refer to.
+
+        A unique key which already refers to another object must not
+        be overwritten; :class:`gobpersist.exception.Corruption`
+        should be raised instead, before anything else is written.
+
+        Subclasses should override this method.
+        """
+        raise NotImplementedError("Back end type '%s' does not implement" \
+                                      " kv_bulk_write" \
+                                      % self.__class__.__name__)
+
+    def _collection_changes(self, fetch, collection_add, collection_remove,
+                            origins=None):
+        """Work out the records to write in order to add members to
+        and remove members from collections.
+
+        ``collection_add`` and ``collection_remove`` are iterables of
+        ``(key, member)`` pairs of key tuples.  ``fetch`` is a
+        function taking a list of key strings and returning a
+        dictionary from those keys found to their deserialized
+        values.  At most two calls are made to ``fetch``.
+
+        If ``origins`` is given, it is filled with a mapping from each
+        key string to be written to the list of ``(key, member,
+        add)`` triples responsible for the write.
+
+        Returns a dictionary from key strings to the deserialized
+        values to store there.
+        """
+        changes = [(tuple(key), tuple(member), True) \
+                       for key, member in collection_add] \
+            + [(tuple(key), tuple(member), False) \
+                   for key, member in collection_remove]
+        wanted = set([self.separator.join(key) \
+                          for key, member, add in changes])
+        if self.collection_buckets:
+            wanted.update([self.separator.join(self._bucket_key(
+                            key,
+                            self._bucket_for(member,
+                                             self.collection_buckets))) \
+                               for key, member, add in changes])
+        values = fetch(list(wanted))
+
+        def record_for(key, member):
+            # returns (record key, bucket count or None)
+            head = values.get(self.separator.join(key))
+            if self._is_bucket_head(head):
+                buckets = head['_BUCKETS_']
+            elif head is None and self.collection_buckets:
+                buckets = self.collection_buckets
+            else:
+                return (self.separator.join(key), None)
+            return (self.separator.join(self._bucket_key(
+                        key, self._bucket_for(member, buckets))),
+                    buckets)
+
+        more = set()
+        for key, member, add in changes:
+            record, buckets = record_for(key, member)
+            if record not in wanted:
+                more.add(record)
+        if more:
+            values.update(fetch(list(more)))
+
+        ret = {}
+        members = {}
+        for key, member, add in changes:
+            record, buckets = record_for(key, member)
+            if record not in members:
+                if record in values:
+                    members[record] = set([tuple(path) \
+                                               for path in values[record]])
+                elif add:
+                    members[record] = set()
+                else:
+                    # trying to remove from a key or bucket not in
+                    # the db
                     continue
-                arg1 = args[0]
-                for arg2 in args[1:]:
-                    if not self._apply_operator(gob,
-                                                getattr(operator, cmd),
-                                                arg1, arg2):
-                        return False
-                    arg1 = arg2
-            elif cmd == 'and':
-                for subquery in args:
-                    if not self._execute_query(gob, subquery):
-                        return False
-            elif cmd == 'or':
-                for subquery in args:
-                    if self._execute_query(gob, subquery):
-                        return True
-                return False
-            elif cmd in ('nor', 'not'):
-                for subquery in args:
-                    if self._execute_query(gob, subquery):
-                        return False
+            if add:
+                members[record].add(member)
             else:
-                raise gobpersist.exception.QueryError("Unknown query element " \
-                                                          "%s" % repr(cmd))
-        return True
-        
+                members[record].discard(member)
+            head_key = self.separator.join(key)
+            if buckets is not None and head_key not in values:
+                ret[head_key] = {'_BUCKETS_': buckets}
+                if origins is not None:
+                    origins.setdefault(head_key, []).append(
+                        (key, member, add))
+            if origins is not None:
+                origins.setdefault(record, []).append((key, member, add))
+        for record, value in members.iteritems():
+            ret[record] = list(value)
+        return ret
+
+    def kv_iterquery(self, cls, key=None, key_range=None, chunk_size=100):
+        """Iterate over the object or collection at a key, fetching
+        the members of a collection ``chunk_size`` at a time.
+
+        By default this simply iterates over the results of
+        ``kv_query``.  Subclasses should override it to fetch lazily.
+        """
+        return iter(self.kv_query(cls, key, key_range))
+
+
+    def _iter_multi_query(self, cls, keys, chunk_size):
+        """Iterate over the objects at ``keys``, fetching them with
+        ``do_kv_multi_query`` ``chunk_size`` at a time."""
+        for i in xrange(0, len(keys), chunk_size):
+            for item in self.do_kv_multi_query(cls, keys[i:i + chunk_size]):
+                yield item
+
 
     def query(self, cls, key=None, key_range=None, query=None, retrieve=None,
               order=None, offset=None, limit=None):
-        res = self.kv_query(cls, key, key_range)
-        ret = []
-        current = -1
+        return list(self._select(cls, self.kv_query(cls, key, key_range),
+                                 query, order, offset, limit))
+
+
+    def iterquery(self, cls, key=None, key_range=None, query=None,
+                  retrieve=None, order=None, offset=None, limit=None,
+                  chunk_size=100):
+        return self._select(cls,
+                            self.kv_iterquery(cls, key, key_range, chunk_size),
+                            query, order, offset, limit)
+
+
+    def _select(self, cls, res, query, order, offset, limit):
+        """Apply ``query``, ``order``, ``offset`` and ``limit`` to the
+        iterable ``res``, returning an iterator over the results.
+
+        Without ``order``, the results are produced as ``res`` is
+        consumed; with it, all of ``res`` must be consumed first, but
+        only the first ``offset + limit`` matches are kept if a limit
+        is given.
+        """
+        if query is not None:
+            res = itertools.ifilter(self.compile_query(cls, query), res)
+        if offset is None:
+            offset = 0
         if order is not None:
-            def order_cmp(a, b):
-                for ordering in order:
-                    if not isinstance(ordering, dict) or not len(ordering) == 1:
-                        raise ValueError("Invalid ordering: %s" % repr(ordering))
-                    key, ordering = ordering.items()[0]
-                    if isinstance(ordering, gobpersist.field.Field):
-                        ordering = ordering._name
-                    if not isinstance(ordering, tuple):
-                        ordering = (ordering,)
-                    res = cmp(self._get_value(a, ordering), self._get_value(b, ordering))
-                    if res == 0:
-                        continue
-                    if key == 'asc':
-                        return res
-                    elif key == 'desc':
-                        return -res
-                    else:
-                        raise ValueError("Invalid key '%s' in ordering %s" \
-                                             % (key, repr(ordering)))
-            res.sort(key=functools.cmp_to_key(order_cmp))
-        for item in res:
-            if limit is not None and len(ret) == limit:
-                return ret
-            if query is not None and not self._execute_query(item, query):
-                continue
-            current += 1
-            if offset is not None and current < offset:
-                continue
-            ret.append(item)
-        return ret
+            sort_key = self._compile_order(cls, order)
+            if limit is not None:
+                # Only the first offset + limit are needed
+                res = heapq.nsmallest(offset + limit, res, key=sort_key)
+            else:
+                res = sorted(res, key=sort_key)
+        if limit is not None:
+            return itertools.islice(res, offset, offset + limit)
+        return itertools.islice(res, offset, None)
+
+
+def _raw_value(value):
+    """The raw value of a field, or of a list of fields, for use in
+    sort keys."""
+    if isinstance(value, gobpersist.field.Field):
+        return value.value
+    elif isinstance(value, list):
+        return [_raw_value(item) for item in value]
+    return value
+
+
+class _Reversed(object):
+    """Wraps a value in a sort key to reverse its order."""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __cmp__(self, other):
+        return cmp(other.value, self.value)
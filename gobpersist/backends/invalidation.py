@@ -0,0 +1,218 @@
+# invalidation.py - Broadcasting cache invalidations between processes
+# Copyright (C) 2012 Accellion, Inc.
+#
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; version 2.1.
+#
+# This library is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA
+"""Transports for broadcasting the keys invalidated in one process's
+caches to the caches of other processes.
+
+.. codeauthor:: Evan Buswell <evan.buswell@accellion.com>
+"""
+
+import os
+import errno
+import socket
+import threading
+import cPickle as pickle
+import cStringIO
+import uuid
+
+class InvalidationBus(object):
+    """Abstract superclass for invalidation transports.
+
+    Keys are published and delivered in the form returned by
+    :func:`gobpersist.session.GobTranslator.key_to_mykey`.  A process
+    does not receive the keys it publishes itself.
+    """
+
+    def __init__(self):
+        self.subscribers = []
+        """The functions to call with each list of keys received."""
+
+    def subscribe(self, callback):
+        """Call ``callback`` with each list of keys published by
+        another process."""
+        self.subscribers.append(callback)
+
+    def deliver(self, keys):
+        """Pass ``keys`` received from another process on to the
+        subscribers."""
+        for callback in self.subscribers:
+            callback(keys)
+
+    def publish(self, keys):
+        """Send ``keys`` to the other processes."""
+        raise NotImplementedError("Invalidation bus '%s' does not implement" \
+                                      " publish" % self.__class__.__name__)
+
+    def close(self):
+        """Stop sending and receiving keys."""
+        pass
+
+
+class UnixDatagramBus(InvalidationBus):
+    """An invalidation transport between processes on the same host,
+    using Unix domain datagram sockets.
+
+    Each process binds a socket in ``directory``, and publishes keys
+    by sending them to every other socket there.  Sockets left behind
+    by processes which have exited are removed by the first process
+    which fails to reach them.  A child process binds a socket of its
+    own on first use after a fork.
+
+    Delivery is not guaranteed: keys for a process too busy to read
+    them within ``send_timeout`` are dropped, so caches relying on
+    this transport should still expire their entries.
+
+    Keys are sent pickled, so that they arrive exactly as they were
+    published, whatever their values.  Like pickle, this should only
+    be used between trusted processes; no other user should be able
+    to write to ``directory``.
+    """
+
+    def __init__(self, directory, max_datagram=8192, send_timeout=0.1):
+        """
+        Args:
+           ``directory``: The directory in which the sockets of all
+           processes sharing invalidations are bound.
+
+           ``max_datagram``: The largest message, in bytes, to send
+           at once.  Longer lists of keys are split.
+
+           ``send_timeout``: The longest time, in seconds, to wait for
+           room in the socket of another process.
+        """
+        super(UnixDatagramBus, self).__init__()
+
+        self.directory = directory
+        """The directory in which the sockets of all processes
+        sharing invalidations are bound."""
+
+        self.max_datagram = max_datagram
+        """The largest message, in bytes, to send at once."""
+
+        self.send_timeout = send_timeout
+        """The longest time, in seconds, to wait for room in the
+        socket of another process."""
+
+        self.pid = None
+        self.path = None
+        self.sock = None
+        self.send_sock = None
+        self.listener = None
+        self.closed = False
+        self.lock = threading.Lock()
+        self.check_pid()
+
+    def check_pid(self):
+        """Bind this process's socket, if it has not been bound since
+        the last fork."""
+        with self.lock:
+            if self.pid == os.getpid() or self.closed:
+                return
+            # Sockets inherited across a fork belong to the parent
+            self.pid = os.getpid()
+            self.path = os.path.join(self.directory, '%d.%s.sock' \
+                                         % (self.pid, uuid.uuid4().hex[:8]))
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.bind(self.path)
+            self.sock.settimeout(0.5)
+            self.send_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.send_sock.settimeout(self.send_timeout)
+            self.listener = threading.Thread(target=self._listen,
+                                             args=(self.sock,))
+            self.listener.daemon = True
+            self.listener.start()
+
+    def _listen(self, sock):
+        while not self.closed and sock is self.sock:
+            try:
+                data = sock.recv(self.max_datagram)
+            except socket.timeout:
+                continue
+            except socket.error:
+                if self.closed:
+                    return
+                raise
+            # Each key is pickled on its own
+            stream = cStringIO.StringIO(data)
+            keys = []
+            try:
+                while stream.tell() < len(data):
+                    keys.append(pickle.load(stream))
+            except (pickle.UnpicklingError, EOFError, ValueError):
+                continue
+            self.deliver(keys)
+
+    def _peers(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return [os.path.join(self.directory, name) for name in names \
+                    if name.endswith('.sock') \
+                    and os.path.join(self.directory, name) != self.path]
+
+    def _messages(self, keys):
+        """Split ``keys`` into messages of at most ``max_datagram``
+        bytes each."""
+        batch = []
+        size = 0
+        for key in keys:
+            encoded = pickle.dumps(tuple(key), pickle.HIGHEST_PROTOCOL)
+            if batch and size + len(encoded) > self.max_datagram:
+                yield ''.join(batch)
+                batch = []
+                size = 0
+            batch.append(encoded)
+            size += len(encoded)
+        if batch:
+            yield ''.join(batch)
+
+    def publish(self, keys):
+        self.check_pid()
+        if self.closed:
+            return
+        messages = list(self._messages(keys))
+        if not messages:
+            return
+        for peer in self._peers():
+            for message in messages:
+                try:
+                    self.send_sock.sendto(message, peer)
+                except socket.timeout:
+                    # Too busy to keep up; its entries will expire
+                    break
+                except socket.error, e:
+                    if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                        # Left behind by a dead process
+                        try:
+                            os.unlink(peer)
+                        except OSError:
+                            pass
+                        break
+                    raise
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.pid == os.getpid():
+                try:
+                    os.unlink(self.path)
+                except OSError:
+                    pass
+            self.sock.close()
+            self.send_sock.close()
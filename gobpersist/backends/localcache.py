@@ -0,0 +1,350 @@
+# localcache.py - An in-process cache
+# Copyright (C) 2012 Accellion, Inc.
+#
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; version 2.1.
+#
+# This library is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA
+"""A cache held in the memory of the process, to be stacked in front
+of a shared cache.
+
+.. codeauthor:: Evan Buswell <evan.buswell@accellion.com>
+"""
+
+import sys
+import time
+import itertools
+import threading
+import collections
+
+import gobpersist.exception
+import gobpersist.backends.cache
+
+class LocalCache(gobpersist.backends.cache.Cache):
+    """A cache held in the memory of the process.
+
+    Query results are kept as the dictionaries the back ends use, so
+    answering a query from this cache involves neither network I/O nor
+    deserialization.  Results are discarded least recently used first
+    once there are more than ``max_entries`` of them or they take more
+    than about ``max_bytes``, and each is discarded in any case after
+    the time to live for its class.
+
+    If another cache is given, it is consulted on a miss, and whatever
+    is stored in or invalidated from this cache is stored in or
+    invalidated from the other cache as well, so that a
+    :class:`gobpersist.backends.cache.CachingBackend` can use the two
+    as one.  Invalidation reaches only this process unless a
+    :class:`gobpersist.backends.invalidation.InvalidationBus` is
+    given to carry it to the local caches of other processes;
+    otherwise, they will see a change once their own copies expire.
+    """
+
+    def __init__(self, cache=None, max_entries=10000, max_bytes=16777216,
+                 ttl=5, class_ttls=None, lazy_hydration=False, bus=None):
+        """
+        Args:
+           ``cache``: The cache to consult on a miss, and to which
+           stores and invalidations are passed on, if any.
+
+           ``max_entries``: The maximum number of query results to
+           keep.
+
+           ``max_bytes``: The approximate maximum memory, in bytes,
+           for the query results kept.
+
+           ``ttl``: The time, in seconds, for which to keep a query
+           result, or ``None`` to keep it until it is evicted or
+           invalidated.
+
+           ``class_ttls``: A dictionary of times to keep the results
+           of queries on particular gob classes, in place of ``ttl``.
+
+           ``lazy_hydration``: Whether to create the fields of
+           retrieved gobs only on first access.
+
+              See :attr:`gobpersist.session.GobTranslator.lazy_hydration`.
+
+           ``bus``: The
+           :class:`gobpersist.backends.invalidation.InvalidationBus`
+           through which to exchange invalidated keys with the local
+           caches of other processes, if any.
+        """
+        self.cache = cache
+        """The cache to consult on a miss, and to which stores and
+        invalidations are passed on, if any."""
+
+        self.max_entries = max_entries
+        """The maximum number of query results to keep."""
+
+        self.max_bytes = max_bytes
+        """The approximate maximum memory, in bytes, for the query
+        results kept."""
+
+        self.ttl = ttl
+        """The time, in seconds, for which to keep a query result, or
+        ``None`` to keep it until it is evicted or invalidated."""
+
+        self.class_ttls = class_ttls or {}
+        """Times to keep the results of queries on particular gob
+        classes, in place of ``ttl``."""
+
+        self.lazy_hydration = lazy_hydration
+        """Whether to create the fields of retrieved gobs only on
+        first access."""
+
+        self.entries = collections.OrderedDict()
+        """The query results, from least to most recently used.
+
+        Each is a tuple of the class queried, the list of dictionaries
+        returned, the time at which it expires, its size and the keys
+        on which it depends.
+        """
+
+        self.dependents = {}
+        """The queries in ``entries`` depending on each key."""
+
+        self.size = 0
+        """The approximate memory, in bytes, taken by ``entries``."""
+
+        self.lock = threading.Lock()
+        """Protects ``entries``, ``dependents`` and ``size``."""
+
+        self.bus = bus
+        """The bus through which to exchange invalidated keys with the
+        local caches of other processes, if any."""
+        if bus is not None:
+            bus.subscribe(self.invalidate_local)
+
+    def _query_key(self, cls, key, key_range, query, retrieve, order,
+                   offset, limit):
+        return (cls,
+                None if key is None else self.key_to_mykey(key),
+                None if key_range is None \
+                    else tuple([self.key_to_mykey(k) for k in key_range]),
+                None if query is None else self.query_digest(cls, query),
+                None if retrieve is None \
+                    else frozenset(self.retrieve_to_myretrieve(cls,
+                                                               retrieve)),
+                None if order is None \
+                    else self.canonical_order(cls, order),
+                offset, limit)
+
+    def _base_dependencies(self, query_key):
+        """The keys named by a query itself."""
+        if query_key[1] is not None:
+            return (query_key[1],)
+        if query_key[2] is not None:
+            return query_key[2]
+        return ()
+
+    def _dependencies(self, items, use_persisted_version=False):
+        """The keys under which each of ``items`` is stored."""
+        for gob in items:
+            yield self.key_to_mykey(gob.obj_key, use_persisted_version)
+            for key in itertools.chain(
+                    gob.unique_keyset(use_persisted_version),
+                    gob.keyset(use_persisted_version)):
+                yield self.key_to_mykey(key, use_persisted_version)
+
+    def _sizeof(self, mygobs):
+        size = sys.getsizeof(mygobs)
+        for mygob in mygobs:
+            size += sys.getsizeof(mygob)
+            for k, v in mygob.iteritems():
+                size += sys.getsizeof(k) + sys.getsizeof(v)
+        return size
+
+    def _discard(self, query_key):
+        """Remove a query result.  ``lock`` must be held."""
+        entry = self.entries.pop(query_key, None)
+        if entry is None:
+            return
+        self.size -= entry[3]
+        for dep in entry[4]:
+            queries = self.dependents.get(dep)
+            if queries is not None:
+                queries.discard(query_key)
+                if not queries:
+                    del self.dependents[dep]
+
+    def _store(self, query_key, cls, items, deps):
+        mygobs = [self.gob_to_mygob(gob) for gob in items]
+        size = self._sizeof(mygobs)
+        if size > self.max_bytes:
+            # Too big to keep, but what was kept before is outdated
+            with self.lock:
+                self._discard(query_key)
+            return
+        ttl = self.class_ttls.get(cls, self.ttl)
+        expires = None if ttl is None else time.time() + ttl
+        deps = frozenset(itertools.chain(deps, self._dependencies(items)))
+        with self.lock:
+            self._discard(query_key)
+            self.entries[query_key] = (cls, mygobs, expires, size, deps)
+            self.size += size
+            for dep in deps:
+                self.dependents.setdefault(dep, set()).add(query_key)
+            while len(self.entries) > self.max_entries \
+                    or self.size > self.max_bytes:
+                self._discard(next(iter(self.entries)))
+
+    def _fetch(self, query_key):
+        with self.lock:
+            entry = self.entries.get(query_key)
+            if entry is None:
+                return None
+            if entry[2] is not None and entry[2] < time.time():
+                self._discard(query_key)
+                return None
+            del self.entries[query_key]
+            self.entries[query_key] = entry
+        cls = entry[0]
+        return [self.mygob_to_gob(cls, dict(mygob)) for mygob in entry[1]]
+
+    def query(self, cls, key=None, key_range=None, query=None, retrieve=None,
+              order=None, offset=None, limit=None):
+        query_key = self._query_key(cls, key, key_range, query, retrieve,
+                                    order, offset, limit)
+        res = self._fetch(query_key)
+        if res is not None:
+            return res
+        if self.cache is None:
+            raise gobpersist.exception.NotFound(
+                "Query for key %s is not cached" % repr(query_key[1]))
+        res = self.cache.query(cls, key, key_range, query, retrieve, order,
+                               offset, limit)
+        self._store(query_key, cls, res, self._base_dependencies(query_key))
+        return res
+
+    def multi_query(self, cls, keys):
+        query_keys = [self._query_key(cls, key, None, None, None, None, None,
+                                      None) \
+                          for key in keys]
+        ret = [self._fetch(query_key) for query_key in query_keys]
+        missing = [i for i, res in enumerate(ret) if res is None]
+        if not missing or self.cache is None:
+            return ret
+        found = self.cache.multi_query(cls, [keys[i] for i in missing])
+        for i, res in itertools.izip(missing, found):
+            if res is not None:
+                self._store(query_keys[i], cls, res,
+                            self._base_dependencies(query_keys[i]))
+                ret[i] = res
+        return ret
+
+    def iterquery(self, cls, key=None, key_range=None, query=None,
+                  retrieve=None, order=None, offset=None, limit=None,
+                  chunk_size=100):
+        return iter(self.query(cls, key, key_range, query, retrieve, order,
+                               offset, limit))
+
+    def refill_ticket(self, cls, key=None, key_range=None):
+        if self.cache is None:
+            return None
+        return self.cache.refill_ticket(cls, key, key_range)
+
+    def cache_query(self, cls, items, key=None, key_range=None, query=None,
+                    retrieve=None, order=None, offset=None, limit=None,
+                    ticket=None):
+        if self.cache is not None:
+            self.cache.cache_query(cls, items, key, key_range, query,
+                                   retrieve, order, offset, limit, ticket)
+        query_key = self._query_key(cls, key, key_range, query, retrieve,
+                                    order, offset, limit)
+        self._store(query_key, cls, items,
+                    self._base_dependencies(query_key))
+
+    def cache_items(self, items):
+        if self.cache is not None:
+            self.cache.cache_items(items)
+        self._store_items(items)
+
+    def _store_items(self, items):
+        for gob in items:
+            # Each item answers a query on its own key and on each of
+            # its unique keys.
+            cls = gob.__class__
+            for key in itertools.chain((gob.obj_key,), gob.unique_keyset()):
+                query_key = self._query_key(cls, key, None, None, None,
+                                            None, None, None)
+                self._store(query_key, cls, [gob], ())
+
+    def cache_miss(self, cls, key=None, key_range=None, expiry=None):
+        # A miss recorded here could not be forgotten by other
+        # processes; leave it to the shared cache.
+        if self.cache is not None:
+            self.cache.cache_miss(cls, key, key_range, expiry)
+
+    def _invalidation_dependencies(self, items, keys):
+        deps = set(itertools.chain(self._dependencies(items),
+                                   self._dependencies(items, True)))
+        deps.update(itertools.imap(self.key_to_mykey, keys))
+        for gob in items:
+            for consistence in gob.consistency:
+                if consistence.get('invalidate') == 'cascade':
+                    deps.add(self.key_to_mykey(consistence['foreign_obj']))
+        return deps
+
+    def invalidate(self, items=None, keys=None):
+        items = list(items or ())
+        keys = list(keys or ())
+        deps = self._invalidation_dependencies(items, keys)
+        self.invalidate_local(deps)
+        # The shared cache first, so that other processes do not
+        # refill from it what they have just been told to drop
+        if self.cache is not None:
+            self.cache.invalidate(items, keys)
+        if self.bus is not None:
+            self.bus.publish(deps)
+
+    def write_ticket(self, items):
+        if self.cache is None:
+            return None
+        return self.cache.write_ticket(items)
+
+    def replace_items(self, items, ticket=None, others=None, keys=None):
+        items = list(items)
+        keys = list(keys or ())
+        deps = self._invalidation_dependencies(
+            items + list(others or ()), keys)
+        self.invalidate_local(deps)
+        if self.cache is not None:
+            self.cache.replace_items(items, ticket, others, keys)
+        self._store_items(items)
+        if self.bus is not None:
+            self.bus.publish(deps)
+
+    def invalidate_local(self, mykeys):
+        """Discard the query results in this cache depending on any of
+        ``mykeys``, which are keys as returned by
+        :func:`gobpersist.session.GobTranslator.key_to_mykey`."""
+        with self.lock:
+            for dep in mykeys:
+                for query_key in list(self.dependents.get(dep, ())):
+                    self._discard(query_key)
+
+    def clear(self):
+        """Remove all query results from this cache."""
+        with self.lock:
+            self.entries.clear()
+            self.dependents.clear()
+            self.size = 0
+
+    def acquire_lease(self, name, lease_time):
+        if self.cache is None:
+            return True
+        return self.cache.acquire_lease(name, lease_time)
+
+    def release_lease(self, name):
+        if self.cache is not None:
+            self.cache.release_lease(name)
@@ -0,0 +1,168 @@
+# locks.py - Lock management for key--value back ends
+# Copyright (C) 2012 Accellion, Inc.
+#
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; version 2.1.
+#
+# This library is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA
+"""Acquisition of sets of lock keys for back ends which lock by
+storing keys.
+
+.. codeauthor:: Evan Buswell <evan.buswell@accellion.com>
+"""
+
+import time
+import random
+import threading
+
+import gobpersist.exception
+
+class LockManager(object):
+    """Acquires and releases sets of lock keys.
+
+    Locks are always taken in sorted order, so that two writers
+    wanting overlapping sets of locks contend for the same lock first
+    rather than each holding half of what the other needs.  They are
+    requested in batches of ``batch_size``, each in as few round trips
+    as the store allows.  Every lock is a lease which lapses after
+    ``lease`` seconds, so that a lock left by a crashed process is
+    eventually freed.  A lock is never taken from a holder whose lease
+    is still valid; if the locks cannot all be had in ``tries``
+    attempts, :class:`gobpersist.exception.Deadlock` is raised.
+
+    Subclasses implement the store-specific :func:`add_locks` and
+    :func:`remove_locks`.
+    """
+
+    def __init__(self, tries=8, backoff=0.01, max_backoff=0.25, lease=30,
+                 batch_size=64):
+        """
+        Args:
+           ``tries``: The number of times to try locking before
+           giving up.
+
+           ``backoff``: The longest time, in seconds, to wait before
+           the first retry.
+
+              Each subsequent wait may be twice as long as the one
+              before.  The actual wait is chosen at random up to that
+              limit, so that contending writers do not retry in step.
+
+           ``max_backoff``: The longest time, in seconds, to wait
+           before any retry.
+
+           ``lease``: The time, in seconds, after which a lock lapses.
+
+           ``batch_size``: The number of locks to request at once.
+        """
+        self.tries = tries
+        """The number of times to try locking before giving up."""
+
+        self.backoff = backoff
+        """The longest time, in seconds, to wait before the first
+        retry."""
+
+        self.max_backoff = max_backoff
+        """The longest time, in seconds, to wait before any retry."""
+
+        self.lease = lease
+        """The time, in seconds, after which a lock lapses."""
+
+        self.batch_size = batch_size
+        """The number of locks to request at once."""
+
+        self.stats = {'acquired': 0, 'contended': 0, 'retries': 0,
+                      'failed': 0, 'wait_time': 0.0}
+        """Counters of lock contention.
+
+        ``acquired`` counts sets of locks acquired, ``contended`` the
+        attempts which found a lock already held, ``retries`` the
+        waits before trying again, ``failed`` the sets of locks given
+        up on, and ``wait_time`` the total time spent waiting, in
+        seconds.
+        """
+
+        self.stats_lock = threading.Lock()
+        """Protects ``stats``."""
+
+    def count(self, stat, n=1):
+        """Add ``n`` to the counter ``stat``."""
+        with self.stats_lock:
+            self.stats[stat] += n
+
+    def add_locks(self, locks):
+        """Store each lock in ``locks`` which is not already held
+        under a valid lease.
+
+        Returns the list of locks stored.
+        """
+        raise NotImplementedError("Lock manager '%s' does not implement" \
+                                      " add_locks" % self.__class__.__name__)
+
+    def remove_locks(self, locks):
+        """Remove all the locks in ``locks``."""
+        raise NotImplementedError("Lock manager '%s' does not implement" \
+                                      " remove_locks" \
+                                      % self.__class__.__name__)
+
+    def wait(self, attempt):
+        """Wait before retry number ``attempt``, counting from 0."""
+        delay = random.uniform(0, min(self.max_backoff,
+                                      self.backoff * (2 ** attempt)))
+        self.count('retries')
+        self.count('wait_time', delay)
+        time.sleep(delay)
+
+    def try_acquire(self, locks):
+        """Try once to acquire all of ``locks``.
+
+        Returns true if successful, false otherwise, in which case no
+        locks are held.
+        """
+        locks = sorted(locks)
+        acquired = []
+        try:
+            for i in xrange(0, len(locks), self.batch_size):
+                batch = locks[i:i + self.batch_size]
+                got = self.add_locks(batch)
+                acquired.extend(got)
+                if len(got) < len(batch):
+                    # Some lock is held elsewhere; back out
+                    self.count('contended')
+                    self.release(acquired)
+                    return False
+        except:
+            self.release(acquired)
+            raise
+        self.count('acquired')
+        return True
+
+    def acquire(self, locks):
+        """Acquire all of ``locks``, trying up to ``tries`` times.
+
+        Returns the locks.  Raises
+        :class:`gobpersist.exception.Deadlock` if some lock is still
+        held after the last try.
+        """
+        for attempt in xrange(self.tries):
+            if self.try_acquire(locks):
+                return locks
+            if attempt < self.tries - 1:
+                self.wait(attempt)
+        self.count('failed')
+        raise gobpersist.exception.Deadlock("Could not acquire the locks " \
+                                                + repr(sorted(locks)))
+
+    def release(self, locks):
+        """Release all of ``locks``."""
+        if locks:
+            self.remove_locks(list(locks))
@@ -0,0 +1,89 @@
+# lru.py - A bounded, thread-safe least-recently-used mapping
+# Copyright (C) 2012 Accellion, Inc.
+#
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; version 2.1.
+#
+# This library is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA
+"""A bounded least-recently-used mapping for use by back ends.
+
+.. codeauthor:: Evan Buswell <evan.buswell@accellion.com>
+"""
+
+import collections
+import threading
+
+class LRUCache(object):
+    """A mapping which holds at most ``max_size`` entries, discarding
+    the least recently used entry to make room for a new one.
+
+    All operations are safe to use from multiple threads.
+    """
+
+    def __init__(self, max_size=1024):
+        """
+        Args:
+           ``max_size``: The maximum number of entries to hold.
+        """
+        self.max_size = max_size
+        """The maximum number of entries to hold."""
+
+        self.entries = collections.OrderedDict()
+        """The entries, from least to most recently used."""
+
+        self.lock = threading.Lock()
+        """Protects ``entries``."""
+
+    def get(self, key, default=None):
+        """Return the value for ``key``, marking it as recently used,
+        or ``default`` if it is not present."""
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                return default
+            self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        """Store ``value`` under ``key``, discarding the least recently
+        used entries if necessary."""
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove and return the value for ``key``, or ``default`` if
+        it is not present."""
+        with self.lock:
+            return self.entries.pop(key, default)
+
+    def items(self):
+        """Return a list of the keys and values of all entries, from
+        least to most recently used, without marking them as used."""
+        with self.lock:
+            return self.entries.items()
+
+    def clear(self):
+        """Remove all entries."""
+        with self.lock:
+            self.entries.clear()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
@@ -21,6 +21,7 @@ memcached protocol.
 """
 
 import time
+import math
 import cPickle as pickle
 import json
 import datetime
@@ -33,6 +34,7 @@ import gobpersist.backends.gobkvquerent
 import gobpersist.backends.gobkvbackend
 import gobpersist.backends.pools
 import gobpersist.backends.cache
+import gobpersist.backends.locks
 import gobpersist.exception
 import gobpersist.field
 
@@ -54,7 +56,57 @@ class JsonWrapper(object):
                                  else list(x) if isinstance(x, (set, frozenset))
                                  else x))
 
-default_pool = gobpersist.backends.pools.SimpleThreadMappedPool(client=pylibmc.Client)
+client_errors = tuple([getattr(pylibmc, name) \
+                          for name in ('ConnectionError', 'ConnectionBindError',
+                                       'HostLookupError', 'ServerDown',
+                                       'ServerDead', 'SocketCreateError',
+                                       'ReadError', 'WriteError',
+                                       'UnknownReadFailure', 'ProtocolError',
+                                       'Timeout') \
+                          if hasattr(pylibmc, name)]) \
+    + (EnvironmentError, EOFError)
+"""The pylibmc exceptions which mean that a connection has failed,
+as opposed to those, like ``pylibmc.NotFound``, which are answers."""
+
+default_pool = gobpersist.backends.pools.BoundedPool(
+    client=pylibmc.Client,
+    check=lambda mc: bool(mc.get_stats()),
+    client_errors=client_errors)
+
+class MemcachedLockManager(gobpersist.backends.locks.LockManager):
+    """Lock manager which stores locks in memcached, letting
+    memcached expire them when their lease lapses."""
+
+    def __init__(self, backend, *args, **kwargs):
+        """
+        Args:
+           ``backend``: The :class:`MemcachedBackend` whose
+           connections to use.
+
+           Other arguments are as for
+           :class:`gobpersist.backends.locks.LockManager`.
+        """
+        self.backend = backend
+        """The back end whose connections to use."""
+
+        super(MemcachedLockManager, self).__init__(*args, **kwargs)
+
+    def add_locks(self, locks):
+        backend = self.backend
+        with backend.pool.reserve(*backend.mc_args,
+                                  **backend.mc_kwargs) as mc:
+            add_multi = getattr(mc, 'add_multi', None)
+            if add_multi is not None:
+                failed = set(add_multi(dict([(lock, '1') for lock in locks]),
+                                       self.lease))
+                return [lock for lock in locks if lock not in failed]
+            return [lock for lock in locks if mc.add(lock, '1', self.lease)]
+
+    def remove_locks(self, locks):
+        backend = self.backend
+        with backend.pool.reserve(*backend.mc_args,
+                                  **backend.mc_kwargs) as mc:
+            mc.delete_multi(locks)
 
 class MemcachedBackend(gobpersist.backends.gobkvbackend.GobKVBackend):
     """Gob back end which uses memcached for storage"""
@@ -62,7 +114,9 @@ class MemcachedBackend(gobpersist.backends.gobkvbackend.GobKVBackend):
     def __init__(self, servers=['127.0.0.1'], expiry=0, binary=True,
                  serializer=JsonWrapper, lock_prefix='_lock',
                  pool=default_pool, separator='.', lock_tries=8,
-                 lock_backoff=0.25, *args, **kwargs):
+                 lock_backoff=0.25, lazy_hydration=False,
+                 collection_buckets=None, use_cas=False, lock_lease=30,
+                 lock_initial_backoff=0.01, *args, **kwargs):
         """
         Args:
            ``servers``: The ``servers`` argument for the memcached
@@ -77,7 +131,9 @@ class MemcachedBackend(gobpersist.backends.gobkvbackend.GobKVBackend):
            ``serializer``: An object which provides serialization of
            gobpersist data.
 
-              Must provide ``loads`` and ``dumps``.
+              Must provide ``loads`` and ``dumps``.  See
+              :class:`gobpersist.backends.serializer.SchemaSerializer`
+              for a more compact one.
 
            ``lock_prefix``: A string to prepend to a key value to
            represent the lock for that key.
@@ -89,21 +145,56 @@ class MemcachedBackend(gobpersist.backends.gobkvbackend.GobKVBackend):
               The default is '.'.
 
            ``lock_tries``: The number of times to try locking before
-           forcibly acquiring all locks.
+           raising :class:`gobpersist.exception.Deadlock`.
+
+              A lock held under a valid lease is never taken over; a
+              lock left by a crashed or hung process is freed once
+              its lease lapses.  The default is 8.
+
+           ``lock_backoff``: The longest amount of time, in seconds,
+           for the locking mechanism to wait between tries.
+
+              The default is 0.25.  Waits start at up to
+              ``lock_initial_backoff`` and double with each try, with
+              random jitter, up to this.  The wait for any lock
+              acquisition is therefore at most the sum of these
+              limits over ``lock_tries - 1`` retries, so consider all
+              three values when fine-tuning them.
+
+           ``lazy_hydration``: Whether to create the fields of
+           retrieved gobs only on first access.
+
+              See :attr:`gobpersist.session.GobTranslator.lazy_hydration`.
+
+           ``collection_buckets``: The number of buckets in which to
+           store new collections.
+
+              See
+              :attr:`gobpersist.backends.gobkvquerent.GobKVQuerent.collection_buckets`.
+              The default is to store each collection as a single
+              value, which must be rewritten whole on every change.
+
+           ``use_cas``: Whether to commit optimistically, using
+           memcached's compare-and-swap, rather than by taking lock
+           keys.  Bulk additions change collections the same way.
 
-              Since there's no way to monitor other processes to make
-              sure they've properly cleaned up, this prevents a
-              permanent object lock by a crashed or hung process.  The
-              default is 8.
+              See :func:`cas_commit`.
 
-           ``lock_backoff``: The amount of time, in seconds, for the
-           locking mechanism to wait between tries.
+           ``lock_lease``: The time, in seconds, after which memcached
+           expires a lock.
 
-              The default is 0.25.  The maximum wait time for any lock
-              acquisition is ``lock_tries * lock_backoff``, so
-              consider this value when fine-tuning these.
+              This frees the locks of a crashed or hung process, and
+              should be comfortably longer than any commit.  The
+              default is 30.
+
+           ``lock_initial_backoff``: The longest amount of time, in
+           seconds, to wait before the first retry of locking.
+
+              The default is 0.01.
         """
         behaviors = {'ketama': True}
+        if use_cas:
+            behaviors['cas'] = True
         for key, value in kwargs.iteritems():
             behaviors[key] = value
 
@@ -134,52 +225,131 @@ class MemcachedBackend(gobpersist.backends.gobkvbackend.GobKVBackend):
         """
 
         self.lock_tries = lock_tries
-        """The number of times to try locking before forcibly
-        acquiring all locks.
+        """The number of times to try locking before raising
+        :class:`gobpersist.exception.Deadlock`.
 
-        Since there's no way to monitor other processes to make sure
-        they've properly cleaned up, this prevents a permanent object
-        lock by a crashed or hung process.  The default is 8.
+        A lock held under a valid lease is never taken over.  The
+        default is 8.
         """
 
         self.lock_backoff = lock_backoff
-        """The amount of time, in seconds, for the locking mechanism
-        to wait between tries.
+        """The longest amount of time, in seconds, for the locking
+        mechanism to wait between tries.
 
-        The default is 0.25.  The maximum wait time for any lock
-        acquisition is ``lock_tries * lock_backoff``, so consider this
-        value when fine-tuning these.
+        The default is 0.25.  Waits start at up to
+        ``lock_initial_backoff`` and double with each try, up to this.
         """
 
+        self.lock_manager = MemcachedLockManager(self, tries=lock_tries,
+                                                 backoff=lock_initial_backoff,
+                                                 max_backoff=lock_backoff,
+                                                 lease=lock_lease)
+        """The lock manager, whose ``stats`` count lock contention."""
+
+        self.lazy_hydration = lazy_hydration
+        """Whether to create the fields of retrieved gobs only on
+        first access."""
+
+        self.collection_buckets = collection_buckets
+        """The number of buckets in which to store new collections."""
+
+        self.use_cas = use_cas
+        """Whether to commit optimistically, using memcached's
+        compare-and-swap, rather than by taking lock keys."""
+
         super(MemcachedBackend, self).__init__()
 
     def do_kv_multi_query(self, cls, keys):
-        keys = [str(self.separator.join(key)) for key in keys]
-        with self.pool.reserve(*self.mc_args, **self.mc_kwargs) as mc:
-            res = mc.get_multi(keys)
-        ret = []
-        for key in keys:
-            if key not in res:
-                raise gobpersist.exception.NotFound(
-                    "Could not find value for key %s" \
-                        % key)
-            store = self.serializer.loads(res[key])
-            if isinstance(store, (list, tuple)):
-                # Collection or reference?
-                if len(store) == 0:
-                    # Empty collection
-                    ret.append(store)
-                elif isinstance(store[0], (list, tuple)):
-                    # Collection
-                    ret.append(self.do_kv_multi_query(cls, store))
-                else:
-                    # Reference
-                    ret.append(self.do_kv_query(cls, store)[0])
+        # Resolve breadth first, so that every key at the same depth
+        # is fetched in a single round trip.  Each pending entry is
+        # (key, container, index, kind): the result for key goes in
+        # container[index].  kind is 'value' for an ordinary key,
+        # 'deref' if key was the target of a reference, so that only
+        # the first object found there is wanted, or 'bucket' if key
+        # is one bucket of a bucketed collection, so that its raw
+        # member list is wanted.
+        def collection(mykey, members, container, index, kind, pending):
+            if len(members) == 0:
+                # Empty collection
+                if kind == 'deref':
+                    raise gobpersist.exception.NotFound(
+                        "Reference to empty collection %s" \
+                            % mykey)
+                container[index] = members
+            elif kind == 'deref':
+                pending.append((members[0], container, index, 'value'))
             else:
-                # Object
-                ret.append(self.mygob_to_gob(cls, store))
+                results = [None] * len(members)
+                container[index] = results
+                pending.extend([(member, results, i, 'value') \
+                                    for i, member in enumerate(members)])
+
+        ret = [None] * len(keys)
+        pending = [(key, ret, i, 'value') for i, key in enumerate(keys)]
+        gathers = []
+        while pending:
+            mykeys = [str(self.separator.join(key)) \
+                          for key, container, index, kind in pending]
+            with self.pool.reserve(*self.mc_args, **self.mc_kwargs) as mc:
+                res = mc.get_multi(list(set(mykeys)))
+            next_pending = []
+            next_gathers = []
+            for (key, container, index, kind), mykey \
+                    in itertools.izip(pending, mykeys):
+                if kind == 'bucket':
+                    # A missing bucket is empty
+                    if mykey in res:
+                        container[index] = self.serializer.loads(res[mykey])
+                    else:
+                        container[index] = []
+                    continue
+                if mykey not in res:
+                    raise gobpersist.exception.NotFound(
+                        "Could not find value for key %s" \
+                            % mykey)
+                store = self.serializer.loads(res[mykey])
+                if isinstance(store, (list, tuple)):
+                    # Collection or reference?
+                    if len(store) == 0 or isinstance(store[0], (list, tuple)):
+                        # Collection
+                        collection(mykey, store, container, index, kind,
+                                   next_pending)
+                    else:
+                        # Reference
+                        next_pending.append((store, container, index,
+                                             'deref'))
+                elif self._is_bucket_head(store):
+                    # Bucketed collection; gather the buckets first
+                    buckets = [None] * store['_BUCKETS_']
+                    next_gathers.append((mykey, buckets, container, index,
+                                         kind))
+                    next_pending.extend(
+                        [(bucket_key, buckets, i, 'bucket') \
+                             for i, bucket_key \
+                             in enumerate(self._bucket_keys(key,
+                                                            len(buckets)))])
+                else:
+                    # Object
+                    container[index] = self.mygob_to_gob(cls, store)
+            for mykey, buckets, container, index, kind in gathers:
+                collection(mykey, list(itertools.chain(*buckets)), container,
+                           index, kind, next_pending)
+            pending = next_pending
+            gathers = next_gathers
         return ret
 
+    def do_kv_bucket_members(self, key, head):
+        """Fetch the members of the bucketed collection at ``key``,
+        whose head is ``head``, in a single round trip."""
+        mykeys = [str(self.separator.join(bucket_key)) \
+                      for bucket_key \
+                      in self._bucket_keys(key, head['_BUCKETS_'])]
+        with self.pool.reserve(*self.mc_args, **self.mc_kwargs) as mc:
+            res = mc.get_multi(mykeys)
+        return list(itertools.chain(*[self.serializer.loads(res[mykey]) \
+                                          for mykey in mykeys \
+                                          if mykey in res]))
+
     def do_kv_query(self, cls, key):
         with self.pool.reserve(*self.mc_args, **self.mc_kwargs) as mc:
             res = mc.get(str(self.separator.join(key)))
@@ -187,7 +357,11 @@ class MemcachedBackend(gobpersist.backends.gobkvbackend.GobKVBackend):
             raise gobpersist.exception.NotFound(
                 "Could not find value for key %s" \
                     % self.separator.join(key))
-        store = self.serializer.loads(res)
+        return self.do_kv_resolve(cls, key, self.serializer.loads(res))
+
+    def do_kv_resolve(self, cls, key, store):
+        """Turn ``store``, the value already fetched for ``key``, into
+        the list of gobs it represents."""
         if isinstance(store, (list, tuple)):
             # Collection or reference?
             if len(store) == 0:
@@ -199,16 +373,96 @@ class MemcachedBackend(gobpersist.backends.gobkvbackend.GobKVBackend):
             else:
                 # Reference
                 return self.do_kv_query(cls, store)
+        elif self._is_bucket_head(store):
+            # Bucketed collection
+            return self.do_kv_multi_query(
+                cls, self.do_kv_bucket_members(key, store))
         else:
             # Object
             return [self.mygob_to_gob(cls, store)]
 
+    def do_kv_iterquery(self, cls, key, chunk_size):
+        with self.pool.reserve(*self.mc_args, **self.mc_kwargs) as mc:
+            res = mc.get(str(self.separator.join(key)))
+        if res == None:
+            raise gobpersist.exception.NotFound(
+                "Could not find value for key %s" \
+                    % self.separator.join(key))
+        store = self.serializer.loads(res)
+        if isinstance(store, (list, tuple)):
+            # Collection or reference?
+            if len(store) == 0:
+                # Empty collection
+                return iter(store)
+            elif isinstance(store[0], (list, tuple)):
+                # Collection
+                return self._iter_multi_query(cls, store, chunk_size)
+            else:
+                # Reference
+                return self.do_kv_iterquery(cls, store, chunk_size)
+        elif self._is_bucket_head(store):
+            # Bucketed collection
+            return self._iter_multi_query(
+                cls, self.do_kv_bucket_members(key, store), chunk_size)
+        else:
+            # Object
+            return iter([self.mygob_to_gob(cls, store)])
+
+    def multi_query(self, cls, keys):
+        mykeys = [self.key_to_mykey(key) for key in keys]
+        joined = [str(self.separator.join(mykey)) for mykey in mykeys]
+        with self.pool.reserve(*self.mc_args, **self.mc_kwargs) as mc:
+            res = mc.get_multi(list(set(joined)))
+        ret = [None] * len(keys)
+        collections = []
+        for i, (mykey, k) in enumerate(itertools.izip(mykeys, joined)):
+            if k not in res:
+                continue
+            store = self.serializer.loads(res[k])
+            if isinstance(store, dict) and not self._is_bucket_head(store):
+                # Object
+                ret[i] = [self.mygob_to_gob(cls, store)]
+            elif isinstance(store, (list, tuple)) and len(store) > 0 \
+                    and isinstance(store[0], (list, tuple)):
+                # Collection; fetch the members of all of them at once
+                collections.append((i, store))
+            elif isinstance(store, (list, tuple, dict)):
+                try:
+                    ret[i] = self.do_kv_resolve(cls, mykey, store)
+                except gobpersist.exception.NotFound:
+                    pass
+            # Anything else is not a value
+        if collections:
+            try:
+                found = self.do_kv_multi_query(
+                    cls, list(itertools.chain(*[store for i, store \
+                                                    in collections])))
+            except gobpersist.exception.NotFound:
+                # Some member is missing; find out which collection
+                for i, store in collections:
+                    try:
+                        ret[i] = self.do_kv_multi_query(cls, store)
+                    except gobpersist.exception.NotFound:
+                        pass
+            else:
+                pos = 0
+                for i, store in collections:
+                    ret[i] = found[pos:pos + len(store)]
+                    pos += len(store)
+        return ret
+
     def kv_query(self, cls, key=None, key_range=None):
         if key_range is not None:
             raise gobpersist.exception.UnsupportedError("key_range is not supported by" \
                                                  " memcached")
         return self.do_kv_query(cls, self.key_to_mykey(key))
 
+    def kv_iterquery(self, cls, key=None, key_range=None, chunk_size=100):
+        if key_range is not None:
+            raise gobpersist.exception.UnsupportedError("key_range is not supported by" \
+                                                 " memcached")
+        return self.do_kv_iterquery(cls, self.key_to_mykey(key), chunk_size)
+
     def try_acquire_locks(self, locks):
         """Tries to acquire the locks.
         
@@ -217,22 +471,7 @@ class MemcachedBackend(gobpersist.backends.gobkvbackend.GobKVBackend):
         mechanism does not support holding locks for long periods of
         time.
         """
-        locks_acquired = []
-        try:
-            with self.pool.reserve(*self.mc_args, **self.mc_kwargs) as mc:
-                for lock in locks:
-                    # Lock the object
-                    if mc.add(lock, '1'):
-                        locks_acquired.append(lock)
-                    else:
-                        # The object is locked!
-                        # Back out all acquired locks
-                        self.release_locks(locks_acquired)
-                        return False
-            return True
-        except:
-            self.release_locks(locks_acquired)
-            raise
+        return self.lock_manager.try_acquire(locks)
 
     def acquire_locks(self, locks):
         """Atomically acquires a set of locks.
@@ -241,30 +480,205 @@ class MemcachedBackend(gobpersist.backends.gobkvbackend.GobKVBackend):
         module, as the locking mechanism was does not support holding
         locks for long periods of time.
         """
-        tries = self.lock_tries
-        # After this many tries, we forcibly acquire the locks
-
-        while tries > 0:
-            if self.try_acquire_locks(locks):
-                return locks
-            else:
-                # We failed to acquire all the locks; loop and try again
-                tries -= 1
-                time.sleep(self.lock_backoff)
-
-        # We failed to acquire locks after *tries* attempts.  Say a
-        # hail mary and force acquire.
-        with self.pool.reserve(*self.mc_args, **self.mc_kwargs) as mc:
-            for lock in locks:
-                # Hail Mary!
-                # Lock the object
-                mc.set(lock, 'locked')
-            return locks
+        return self.lock_manager.acquire(locks)
 
     def release_locks(self, locks):
         """Releases a set of locks."""
+        self.lock_manager.release(locks)
+
+    def gets_multi(self, mc, keys):
+        """Fetch ``keys`` along with their CAS tokens.
+
+        Uses the client's ``gets_multi`` if it has one, or else one
+        ``gets`` per key.  Returns a tuple of two dictionaries, from
+        the keys found to their values and to their CAS tokens.
+        """
+        gets_multi = getattr(mc, 'gets_multi', None)
+        if gets_multi is not None:
+            res = gets_multi(keys)
+        else:
+            res = dict([(key, mc.gets(key)) for key in keys])
+        values = {}
+        tokens = {}
+        for key, (value, token) in res.iteritems():
+            if value is not None:
+                values[key] = value
+                tokens[key] = token
+        return (values, tokens)
+
+    def cas_write(self, mc, key, value, token):
+        """Store ``value`` at ``key`` only if it has not changed since
+        it was read with CAS token ``token``, or only if it does not
+        exist if ``token`` is ``None``.
+
+        Returns true if the value was stored.  A key removed since it
+        was read counts as changed.
+        """
+        if token is None:
+            return mc.add(key, value, self.expiry)
+        try:
+            return mc.cas(key, value, token, self.expiry)
+        except pylibmc.NotFound:
+            return False
+
+    def add_multi(self, mc, values):
+        """Store each of ``values`` only if its key does not exist.
+
+        Uses the client's ``add_multi`` if it has one, or else one
+        ``add`` per key.  Returns the list of keys which already
+        existed.
+        """
+        add_multi = getattr(mc, 'add_multi', None)
+        if add_multi is not None:
+            return list(add_multi(values, self.expiry))
+        return [key for key, value in values.iteritems() \
+                    if not mc.add(key, value, self.expiry)]
+
+    def cas_commit(self, update_gobs, remove_gobs, conditions, to_set,
+                   to_add, to_delete, collection_add, collection_remove,
+                   new_collections=()):
+        """Perform the writes for :func:`kv_commit` optimistically,
+        without taking any locks.
+
+        Gobs with conditions are read along with their CAS tokens and
+        checked, all before anything is written.  New objects and
+        unique keys are then added only if they do not exist; if any
+        does, those added are removed again and
+        :class:`gobpersist.exception.ConditionFailed` is raised.  The
+        keys of ``to_add`` in ``new_collections`` are new collections,
+        which are set regardless, as with locks.
+
+        The gobs with conditions are then written back with
+        compare-and-swap, and collections are read, changed and
+        written back the same way.  When a compare-and-swap fails
+        because another process wrote the key in the meantime, only
+        the conflicting keys are read, checked and written again, up
+        to ``lock_tries`` times, after which
+        :class:`gobpersist.exception.Deadlock` is raised.  Memcached
+        has no transactions, so a conflict found then can leave the
+        commit half-applied: a condition which fails on rereading
+        raises :class:`gobpersist.exception.ConditionFailed` with the
+        other guarded gobs already written.
+
+        Memcached cannot delete conditionally, so the conditions on a
+        removal are checked but not guarded.
+        """
+        guarded = {}
+        for key, condition in conditions.iteritems():
+            if key in update_gobs:
+                gob = update_gobs[key][0]
+            elif key in remove_gobs:
+                gob = remove_gobs[key]
+            else:
+                raise gobpersist.exception.Corruption(
+                    "Got a commit condition without a"
+                    " corresponding gob object.")
+            guarded[self.separator.join(self.key_to_mykey(key))] \
+                = (gob.__class__, condition)
+
         with self.pool.reserve(*self.mc_args, **self.mc_kwargs) as mc:
-            mc.delete_multi(locks)
+            def check(keys):
+                # Returns the CAS tokens of those keys still present
+                values, tokens = self.gets_multi(mc, keys)
+                for key in keys:
+                    if key not in values:
+                        # Since this is memcached, we should be lax
+                        # about missing values
+                        del guarded[key]
+                        continue
+                    cls, condition = guarded[key]
+                    store = self.serializer.loads(values[key])
+                    if not isinstance(store, dict):
+                        raise gobpersist.exception.Corruption(
+                            "Key %s indicates a collection or reference" \
+                                " instead of an object." % key)
+                    gob = self.mygob_to_gob(cls, store)
+                    if not self._execute_query(gob, condition):
+                        raise gobpersist.exception.ConditionFailed(
+                            "The conditions '%s' could not be met for" \
+                                " object '%s'" \
+                                % (repr(condition),
+                                   repr(gob)))
+                return tokens
+
+            tokens = check(guarded.keys())
+
+            to_init = dict([(k, v) for k, v in to_add.iteritems() \
+                                if k in new_collections])
+            to_add = dict([(k, v) for k, v in to_add.iteritems() \
+                               if k not in new_collections])
+            if to_add:
+                refused = self.add_multi(mc, to_add)
+                if refused:
+                    mc.delete_multi([key for key in to_add \
+                                         if key not in refused])
+                    raise gobpersist.exception.ConditionFailed(
+                        "The keys %s already exist" % repr(refused))
+
+            written = set()
+            tries = self.lock_tries
+            while True:
+                for key in guarded.keys():
+                    if key not in to_set:
+                        del guarded[key]
+                    elif self.cas_write(mc, key, to_set[key], tokens[key]):
+                        written.add(key)
+                        del guarded[key]
+                if not guarded:
+                    break
+                tries -= 1
+                if tries <= 0:
+                    raise gobpersist.exception.Deadlock(
+                        "Could not commit to %s without conflict" \
+                            % repr(guarded.keys()))
+                tokens = check(guarded.keys())
+
+            mc.delete_multi(to_delete)
+            to_init.update([(k, v) for k, v in to_set.iteritems() \
+                                if k not in written])
+            mc.set_multi(to_init, self.expiry)
+
+            self.cas_collections(mc, collection_add, collection_remove)
+
+    def cas_collections(self, mc, collection_add, collection_remove):
+        """Add and remove collection members with compare-and-swap,
+        without taking any locks.
+
+        The changes to collections which another process wrote in the
+        meantime are recomputed and retried, up to ``lock_tries``
+        times, after which :class:`gobpersist.exception.Deadlock` is
+        raised.
+        """
+        tries = self.lock_tries
+        while collection_add or collection_remove:
+            tokens = {}
+            def fetch(keys):
+                values, new_tokens = self.gets_multi(mc, keys)
+                tokens.update(new_tokens)
+                for key in values:
+                    values[key] = self.serializer.loads(values[key])
+                return values
+            origins = {}
+            conflicts = []
+            retry = set()
+            for k, v in self._collection_changes(
+                    fetch, collection_add, collection_remove,
+                    origins).iteritems():
+                if not self.cas_write(mc, k, self.serializer.dumps(v),
+                                      tokens.get(k)):
+                    conflicts.append(k)
+                    retry.update(origins[k])
+            collection_add = [(key, member) \
+                                  for key, member, add in retry if add]
+            collection_remove = [(key, member) \
+                                     for key, member, add in retry \
+                                     if not add]
+            if retry:
+                tries -= 1
+                if tries <= 0:
+                    raise gobpersist.exception.Deadlock(
+                        "Could not commit to %s without conflict" \
+                            % repr(conflicts))
 
     def key_to_mykey(self, key, use_persisted_version=False):
         mykey = super(MemcachedBackend, self).key_to_mykey(key,
@@ -295,19 +709,33 @@ class MemcachedBackend(gobpersist.backends.gobkvbackend.GobKVBackend):
         to_delete = []
         # don't do dumps on these keys yet, since we have to compare
         # them for equality
-        collection_add = [(self.separator.join(self.key_to_mykey(k)),
-                           self.key_to_mykey(v))
+        collection_add = [(self.key_to_mykey(k), self.key_to_mykey(v))
                           for k, v in add_keys]
-        collection_remove = [(self.separator.join(self.key_to_mykey(k)),
-                              self.key_to_mykey(v))
+        collection_remove = [(self.key_to_mykey(k), self.key_to_mykey(v))
                              for k, v in remove_keys]
         locks = [self.lock_prefix + self.separator + self.separator.join(self.key_to_mykey(key))
                  for key in affected_keys]
 
         for k in collection_additions:
-            to_add[self.separator.join(self.key_to_mykey(k))] = self.serializer.dumps([])
+            k = self.key_to_mykey(k)
+            if self.collection_buckets:
+                to_add[self.separator.join(k)] \
+                    = self.serializer.dumps({'_BUCKETS_':
+                                                 self.collection_buckets})
+                to_delete.extend([self.separator.join(bucket_key) \
+                                      for bucket_key \
+                                      in self._bucket_keys(
+                                          k, self.collection_buckets)])
+            else:
+                to_add[self.separator.join(k)] = self.serializer.dumps([])
         for k in collection_removals:
-            to_delete.append(self.separator.join(self.key_to_mykey(k)))
+            k = self.key_to_mykey(k)
+            to_delete.append(self.separator.join(k))
+            if self.collection_buckets:
+                to_delete.extend([self.separator.join(bucket_key) \
+                                      for bucket_key \
+                                      in self._bucket_keys(
+                                          k, self.collection_buckets)])
         for k, v in add_gobs.iteritems():
             to_add[self.separator.join(self.key_to_mykey(k))] = self.serializer.dumps(self.gob_to_mygob(v))
         for k, v in update_gobs.iteritems():
@@ -323,6 +751,15 @@ class MemcachedBackend(gobpersist.backends.gobkvbackend.GobKVBackend):
         # print "to_set=%s, to_add=%s, to_delete=%s, collection_add=%s, collection_remove=%s, locks=%s" \
         #     % (to_set, to_add, to_delete, collection_add, collection_remove, locks)
 
+        if self.use_cas:
+            self.cas_commit(update_gobs, remove_gobs, conditions, to_set,
+                            to_add, to_delete, collection_add,
+                            collection_remove,
+                            set([self.separator.join(self.key_to_mykey(k)) \
+                                     for k in collection_additions]))
+            # memcached never changes items on update
+            return []
+
         # Acquire locks
         self.acquire_locks(locks)
         try:
@@ -366,32 +803,16 @@ class MemcachedBackend(gobpersist.backends.gobkvbackend.GobKVBackend):
             # Conditions pass! Actually perform the actions
 
             with self.pool.reserve(*self.mc_args, **self.mc_kwargs) as mc:
-                c_addsrms = mc.get_multi([c_add[0]
-                                          for c_add in itertools.chain(
-                                              collection_add,
-                                              collection_remove)])
-                for key in c_addsrms:
-                    c_addsrms[key] \
-                        = set([tuple(path)
-                               for path in self.serializer.loads(c_addsrms[key])])
-                for c_add in collection_add:
-                    key = c_add[0]
-                    if key in c_addsrms:
-                        res = c_addsrms[key]
-                    else:
-                        res = c_addsrms[key] = set()
-                    res.add(c_add[1])
-                for c_rm in collection_remove:
-                    key = c_rm[0]
-                    if key in c_addsrms:
-                        res = c_addsrms[key]
-                        res.discard(c_rm[1])
-                    else:
-                        # trying to remove from a key not in the db
-                        # be lax since this is memcached
-                        pass
-                for k, v in c_addsrms.iteritems():
-                    to_set[k] = self.serializer.dumps(list(v))
+                def fetch(keys):
+                    res = mc.get_multi(keys)
+                    for key in res:
+                        res[key] = self.serializer.loads(res[key])
+                    return res
+                # Removals from keys not in the db are skipped; be lax
+                # since this is memcached
+                for k, v in self._collection_changes(
+                        fetch, collection_add, collection_remove).iteritems():
+                    to_set[k] = self.serializer.dumps(v)
                 # print "to_set=%s, to_add=%s, to_delete=%s" \
                 #     % (to_set, to_add, to_delete)
                 mc.delete_multi(to_delete)
@@ -404,14 +825,65 @@ class MemcachedBackend(gobpersist.backends.gobkvbackend.GobKVBackend):
         # memcached never changes items on update
         return []
 
+    def _bulk_add_unique(self, mc, unique):
+        """Add the unique keys for :func:`kv_bulk_write`, raising
+        :class:`gobpersist.exception.Corruption` and removing those
+        added if any refers to another object already."""
+        to_add = dict([(str(k), self.serializer.dumps(v)) \
+                           for k, v in unique.iteritems()])
+        refused = self.add_multi(mc, to_add)
+        if not refused:
+            return
+        existing = mc.get_multi(refused)
+        collisions = [key for key in refused \
+                          if key not in existing \
+                          or tuple(self.serializer.loads(existing[key])) \
+                          != tuple(unique[key])]
+        if collisions:
+            mc.delete_multi([key for key in to_add if key not in refused])
+            raise gobpersist.exception.Corruption(
+                "Duplicate addition of unique keys %s detected" \
+                    % repr(collisions))
+
+    def kv_bulk_write(self, records, collection_add, unique={}):
+        # Only collections and unique keys are read before being
+        # written; new objects are simply set.
+        to_set = dict([(str(k), self.serializer.dumps(v)) \
+                           for k, v in records.iteritems()])
+        if self.use_cas:
+            with self.pool.reserve(*self.mc_args, **self.mc_kwargs) as mc:
+                self._bulk_add_unique(mc, unique)
+                mc.set_multi(to_set, self.expiry)
+                self.cas_collections(mc, collection_add, [])
+            return
+        locks = set([self.lock_prefix + self.separator \
+                         + self.separator.join(key) \
+                         for key, member in collection_add])
+        self.acquire_locks(locks)
+        try:
+            with self.pool.reserve(*self.mc_args, **self.mc_kwargs) as mc:
+                self._bulk_add_unique(mc, unique)
+                def fetch(keys):
+                    res = mc.get_multi(keys)
+                    for key in res:
+                        res[key] = self.serializer.loads(res[key])
+                    return res
+                for k, v in self._collection_changes(
+                        fetch, collection_add, []).iteritems():
+                    to_set[k] = self.serializer.dumps(v)
+                mc.set_multi(to_set, self.expiry)
+        finally:
+            self.release_locks(locks)
+
 class MemcachedCache(MemcachedBackend, gobpersist.backends.cache.Cache):
     """A cache backend based on Memcached."""
     def __init__(self, servers=['127.0.0.1'], expiry=0, binary=True,
                  serializer=PickleWrapper, lock_prefix='_lock',
                  pool=default_pool, separator='.', lock_tries=8,
                  lock_backoff=0.25, integrity_prefix='_INTEGRITY_',
-                 shadow_prefix='_SHADOW_',
-                 *args, **kwargs):
+                 shadow_prefix='_SHADOW_', lazy_hydration=False,
+                 use_generations=False, generation_prefix='_GEN_',
+                 lock_initial_backoff=0.01, *args, **kwargs):
         """
         Args:
            ``integrity_prefix``: A prefix to add to a key to create
@@ -427,6 +899,20 @@ class MemcachedCache(MemcachedBackend, gobpersist.backends.cache.Cache):
              Shadow keys are the keys representing everything
              currently in the cache, rather than in whatever data
              source the cache represents.
+
+           ``lazy_hydration``: See :class:`MemcachedBackend`.
+
+           ``use_generations``: Whether to invalidate cached queries
+           by generation rather than through integrity and shadow
+           keys.
+
+              See :func:`invalidate_generations`.
+
+           ``generation_prefix``: A prefix to add to a key to create
+           the key holding its generation, and to separate a key from
+           its generation in the keys of cached queries.
+
+           ``lock_initial_backoff``: See :class:`MemcachedBackend`.
         """
 
         self.integrity_prefix = integrity_prefix
@@ -446,63 +932,141 @@ class MemcachedCache(MemcachedBackend, gobpersist.backends.cache.Cache):
         represents.
         """
 
+        self.use_generations = use_generations
+        """Whether to invalidate cached queries by generation rather
+        than through integrity and shadow keys."""
+
+        self.generation_prefix = generation_prefix
+        """A prefix to add to a key to create the key holding its
+        generation, and to separate a key from its generation in the
+        keys of cached queries."""
+
         MemcachedBackend.__init__(self, servers, expiry, binary, serializer,
                                   lock_prefix, pool, separator, lock_tries,
-                                  lock_backoff)
+                                  lock_backoff, lazy_hydration,
+                                  lock_initial_backoff=lock_initial_backoff)
+        # Objects written through are replaced with CAS
+        self.mc_kwargs['behaviors']['cas'] = True
+
+    negative_marker = '_NOT_FOUND_'
+    """What is stored in place of a key which the back end does not
+    have."""
+
+    def _is_negative(self, store):
+        return store == self.negative_marker
+
+    def _generation_key(self, mykey):
+        return str(self.separator.join((self.generation_prefix,) + mykey))
+
+    def _new_generation(self, mc, mykey):
+        """Start the generation of ``mykey`` afresh, returning it.
+
+        A generation lost to eviction must not restart where it
+        started before, or stale queries would become visible again,
+        so new generations start from the current time.
+        """
+        gen_key = self._generation_key(mykey)
+        gen = str(int(time.time() * 1000000))
+        if mc.add(gen_key, gen):
+            return gen
+        # Someone else started it first
+        gen = mc.get(gen_key)
+        if gen is None:
+            return self._new_generation(mc, mykey)
+        return gen
+
+    def _generation_tag(self, mc, key, gen=None):
+        """Return ``key`` tagged with its current generation, which
+        may be given as ``gen`` if already fetched."""
+        mykey = self.key_to_mykey(key)
+        if gen is None:
+            gen = mc.get(self._generation_key(mykey))
+        if gen is None:
+            gen = self._new_generation(mc, mykey)
+        return tuple(key) + (self.generation_prefix, str(gen))
 
     def query(self, cls, key=None, key_range=None, query=None, retrieve=None,
               order=None, offset=None, limit=None):
-        # go from least to most limited.
+        # Candidates go from least to most limited, each with what
+        # remains to be done locally.  Order is significant...
         base_key = key
         if key_range is not None:
             if key is not None:
                 raise ValueError("Both key and key_range specified")
             base_key = self._key_range_to_key(key_range)
-        try:
-            return super(MemcachedCache, self).query(
-                cls=cls,
-                key=base_key,
-                query=query,
-                retrieve=retrieve,
-                order=order,
-                offset=offset,
-                limit=limit)
-        except gobpersist.exception.NotFound:
-            pass
-        # didn't find a general query; is there a more specific query?
-        # Order is significant...
+        if self.use_generations:
+            # Objects and unique keys are cached as they are; fetch
+            # those along with the generation for everything else.
+            mykey = self.key_to_mykey(base_key)
+            gen_key = self._generation_key(mykey)
+            with self.pool.reserve(*self.mc_args, **self.mc_kwargs) as mc:
+                res = mc.get_multi([str(self.separator.join(mykey)),
+                                    gen_key])
+                value = res.get(str(self.separator.join(mykey)))
+                if value is not None:
+                    store = self.serializer.loads(value)
+                    if self._is_negative(store):
+                        raise gobpersist.exception.CachedNotFound(
+                            "Key %s is known not to exist" \
+                                % self.separator.join(mykey))
+                    if (isinstance(store, dict)
+                        and not self._is_bucket_head(store)) \
+                            or (isinstance(store, (list, tuple))
+                                and len(store) > 0
+                                and not isinstance(store[0], (list, tuple))):
+                        # An object or a reference to one
+                        try:
+                            return list(self._select(
+                                    cls, self.do_kv_resolve(cls, mykey, store),
+                                    query, order, offset, limit))
+                        except gobpersist.exception.NotFound:
+                            pass
+                base_key = self._generation_tag(mc, base_key,
+                                                res.get(gen_key))
+        candidates = [(base_key, query, offset, limit)]
         if query is not None:
-            base_key = self._query_to_key(base_key, query)
-            try:
-                return super(MemcachedCache, self).query(
-                    cls=cls,
-                    key=base_key,
-                    retrieve=retrieve,
-                    order=order,
-                    offset=offset,
-                    limit=limit)
-            except gobpersist.exception.NotFound:
-                pass
+            base_key = self._query_to_key(cls, base_key, query)
+            candidates.append((base_key, None, offset, limit))
         if retrieve is not None:
             base_key = self._retrieve_to_key(base_key, retrieve)
-            try:
-                return super(MemcachedCache, self).query(
-                    cls=cls,
-                    key=base_key,
-                    order=order,
-                    offset=offset,
-                    limit=limit)
-            except gobpersist.exception.NotFound:
-                pass
+            candidates.append((base_key, None, offset, limit))
         if offset is not None or limit is not None:
             base_key = self._offlim_to_key(base_key, offset, limit)
-            return super(MemcachedCache, self).query(
-                cls=cls,
-                key=base_key,
-                order=order)
+            candidates.append((base_key, None, None, None))
+
+        # One round trip for all of them
+        mykeys = [self.key_to_mykey(candidate[0]) for candidate in candidates]
+        with self.pool.reserve(*self.mc_args, **self.mc_kwargs) as mc:
+            res = mc.get_multi([str(self.separator.join(mykey)) \
+                                    for mykey in mykeys])
+        for (candidate_key, remaining_query, remaining_offset,
+             remaining_limit), mykey in itertools.izip(candidates, mykeys):
+            value = res.get(str(self.separator.join(mykey)))
+            if value is None:
+                continue
+            store = self.serializer.loads(value)
+            if self._is_negative(store):
+                raise gobpersist.exception.CachedNotFound(
+                    "Key %s is known not to exist" \
+                        % self.separator.join(mykey))
+            try:
+                items = self.do_kv_resolve(cls, mykey, store)
+            except gobpersist.exception.NotFound:
+                # partially evicted; try something more specific
+                continue
+            return list(self._select(cls, items, remaining_query, order,
+                                     remaining_offset, remaining_limit))
         raise gobpersist.exception.NotFound(
             "Could not find value for key %s" \
-                % self.separator.join(self.key_to_mykey(base_key)))
+                % self.separator.join(mykeys[-1]))
+
+    def iterquery(self, cls, key=None, key_range=None, query=None,
+                  retrieve=None, order=None, offset=None, limit=None,
+                  chunk_size=100):
+        # Finding which cached key answers the query means fetching it
+        # whole.
+        return iter(self.query(cls, key, key_range, query, retrieve, order,
+                               offset, limit))
 
 
     def do_cache_query(self, items, base_key=None):
@@ -512,6 +1076,8 @@ class MemcachedCache(MemcachedBackend, gobpersist.backends.cache.Cache):
         # 2. All unique keys for this object are added
         # 3. Base_key is added to (integrity_prefix, key) for each key
         # 4. Each entry's keys and unique keys are added as shadow keys
+        # When using generations, base_key is already tagged with its
+        # generation, and 3 and 4 are not needed.
 
         to_set = {}
         integrity_add = []
@@ -539,8 +1105,14 @@ class MemcachedCache(MemcachedBackend, gobpersist.backends.cache.Cache):
                     gob.unique_keyset()):
                 locks.add(self.lock_prefix + self.separator + self.separator.join(key))
                 to_set[self.separator.join(key)] = self.serializer.dumps(gob_key)
+                if self.use_generations:
+                    continue
                 locks.add(self.lock_prefix + self.separator + self.shadow_prefix + self.separator + self.separator.join(key))
                 to_set[self.shadow_prefix + self.separator + self.separator.join(key)] = self.serializer.dumps(gob_key)
+            if self.use_generations:
+                if base_key is not None:
+                    base_coll.append(gob_key)
+                continue
             for key in itertools.imap(
                     self.key_to_mykey,
                     gob.keyset()):
@@ -583,6 +1155,9 @@ class MemcachedCache(MemcachedBackend, gobpersist.backends.cache.Cache):
                         integrity_set[k] = self.serializer.dumps(list(v))
 
                 # shadow adds
+                if not shadow_add:
+                    mc.set_multi(to_set, self.expiry)
+                    return
                 c_adds = mc.get_multi([self.separator.join(c_add[0]) \
                                            for c_add \
                                            in shadow_add])
@@ -618,16 +1193,37 @@ class MemcachedCache(MemcachedBackend, gobpersist.backends.cache.Cache):
             self.release_locks(locks)
 
 
+    def refill_ticket(self, cls, key=None, key_range=None):
+        # The generation current before the back end is queried is
+        # the newest one its answer can belong to.
+        if not self.use_generations:
+            return None
+        if key_range is not None:
+            if key is not None:
+                raise ValueError("Both key and key_range specified")
+            key = self._key_range_to_key(key_range)
+        with self.pool.reserve(*self.mc_args, **self.mc_kwargs) as mc:
+            return self._generation_tag(mc, key)[-1]
+
     def cache_query(self, cls, items, key=None, key_range=None, query=None,
-                    retrieve=None, order=None, offset=None, limit=None):
+                    retrieve=None, order=None, offset=None, limit=None,
+                    ticket=None):
         base_key = key
         # Order is significant...
         if key_range is not None:
             if key is not None:
                 raise ValueError("Both key and key_range specified")
             base_key = self._key_range_to_key(key_range)
+        if self.use_generations:
+            if ticket is not None:
+                base_key = tuple(base_key) \
+                    + (self.generation_prefix, ticket)
+            else:
+                with self.pool.reserve(*self.mc_args,
+                                       **self.mc_kwargs) as mc:
+                    base_key = self._generation_tag(mc, base_key)
         if query is not None:
-            base_key = self._query_to_key(base_key, query)
+            base_key = self._query_to_key(cls, base_key, query)
         if retrieve is not None:
             base_key = self._retrieve_to_key(base_key, retrieve)
         if offset is not None or limit is not None:
@@ -637,9 +1233,33 @@ class MemcachedCache(MemcachedBackend, gobpersist.backends.cache.Cache):
         self.do_cache_query(items, base_key=base_key)
 
 
+    def cache_miss(self, cls, key=None, key_range=None, expiry=None):
+        # A range has no one key by which a commit would invalidate
+        # it, so only misses on a key are recorded.
+        if key is None or key_range is not None:
+            return
+        mykey = self.key_to_mykey(key)
+        with self.pool.reserve(*self.mc_args, **self.mc_kwargs) as mc:
+            # add, so as not to hide whatever has been cached since
+            mc.add(str(self.separator.join(mykey)),
+                   self.serializer.dumps(self.negative_marker),
+                   self.expiry if expiry is None else expiry)
+
     def cache_items(self, items):
         self.do_cache_query(items=items)
 
+    def _lease_key(self, name):
+        return str(self.lock_prefix + self.separator + '_LEASE_' \
+                       + self.separator + name)
+
+    def acquire_lease(self, name, lease_time):
+        with self.pool.reserve(*self.mc_args, **self.mc_kwargs) as mc:
+            return mc.add(self._lease_key(name), '1', int(math.ceil(lease_time)))
+
+    def release_lease(self, name):
+        with self.pool.reserve(*self.mc_args, **self.mc_kwargs) as mc:
+            mc.delete(self._lease_key(name))
+
     def brute_search(self, mc, keyset):
         res = mc.get_multi(keyset)
         ret = []
@@ -730,7 +1350,59 @@ class MemcachedCache(MemcachedBackend, gobpersist.backends.cache.Cache):
         if len(items) != 0 or len(keys) != 0:
             self.build_invalidation_keyset(items, keys, locks, keyset, integrity_keyset, cascade_keyset, force_lock)
 
-    def invalidate(self, items=None, keys=None):
+    def invalidate_generations(self, items=None, keys=None, spare=()):
+        """Invalidate by generation.
+
+        Each collection key has a generation, which is part of the
+        keys of all queries cached on that collection.  Rather than
+        finding and removing those queries, invalidation moves the
+        collection on to its next generation, with a single ``incr``,
+        and the queries of the old generation are left to expire.
+        The objects themselves, and their unique keys, are removed as
+        usual.
+
+        Cascading consistency rules move the generation of the
+        foreign collection on too, but objects cached individually
+        under their own keys are not searched for, so they will only
+        be refreshed by their own invalidation or by expiry.
+
+        Keys in ``spare``, as strings, are left in place.
+        """
+        to_delete = set()
+        bump = set()
+        for gob in items or ():
+            to_delete.add(self.separator.join(self.key_to_mykey(gob.obj_key)))
+            for use_persisted_version in (False, True):
+                for key in gob.unique_keyset(use_persisted_version):
+                    to_delete.add(self.separator.join(
+                            self.key_to_mykey(key, use_persisted_version)))
+                for key in gob.keyset(use_persisted_version):
+                    key = self.key_to_mykey(key, use_persisted_version)
+                    bump.add(key)
+                    # Only a recorded miss lives at the untagged key
+                    to_delete.add(self.separator.join(key))
+            for consistence in gob.consistency:
+                if consistence.get('invalidate') == 'cascade':
+                    bump.add(self.key_to_mykey(consistence['foreign_obj']))
+        for key in itertools.imap(self.key_to_mykey, keys or ()):
+            to_delete.add(self.separator.join(key))
+            bump.add(key)
+        to_delete.difference_update(spare)
+        with self.pool.reserve(*self.mc_args, **self.mc_kwargs) as mc:
+            mc.delete_multi([str(key) for key in to_delete])
+            for key in bump:
+                try:
+                    mc.incr(self._generation_key(key))
+                except pylibmc.NotFound:
+                    # Never queried, or evicted; either way, a fresh
+                    # start is as good as a new generation.
+                    if not mc.add(self._generation_key(key),
+                                  str(int(time.time() * 1000000))):
+                        mc.incr(self._generation_key(key))
+
+    def invalidate(self, items=None, keys=None, spare=()):
+        if self.use_generations:
+            return self.invalidate_generations(items, keys, spare)
         keyset = set()
         integrity_keyset = set()
         cascade_keyset = set()
@@ -748,6 +1420,7 @@ class MemcachedCache(MemcachedBackend, gobpersist.backends.cache.Cache):
             try:
                 self.build_invalidation_keyset(items.copy(), keys.copy(), locks, keyset, integrity_keyset, cascade_keyset, tries == 0)
                 keyset |= integrity_keyset | cascade_keyset
+                keyset.difference_update(spare)
                 newlocks = set([self.lock_prefix + self.separator + key for key in keyset])
                 newlocks -= locks
                 if(tries > 0):
@@ -759,88 +1432,83 @@ class MemcachedCache(MemcachedBackend, gobpersist.backends.cache.Cache):
                 with self.pool.reserve(*self.mc_args, **self.mc_kwargs) as mc:
                     mc.delete_multi(list(keyset))
             except gobpersist.exception.Deadlock:
-                if tries == 0: # How would this happen??
+                if tries == 0: # acquire_locks gave up as well
                     raise
                 tries -= 1
                 keyset.clear()
                 integrity_keyset.clear()
                 cascade_keyset.clear()
-                time.sleep(self.lock_backoff)
+                self.lock_manager.wait(self.lock_tries - tries - 1)
                 continue
             finally:
                 self.release_locks(locks)
                 locks.clear()
             break
 
+    def write_ticket(self, items):
+        # The CAS token of each object before the commit; a version
+        # cached since then may be newer than the one being written.
+        keys = [self.separator.join(self.key_to_mykey(gob.obj_key)) \
+                    for gob in items]
+        with self.pool.reserve(*self.mc_args, **self.mc_kwargs) as mc:
+            tokens = self.gets_multi(mc, keys)[1]
+        return dict([(key, tokens.get(key)) for key in keys])
+
+    def replace_items(self, items, ticket=None, others=None, keys=None):
+        """Replace the cached versions of ``items`` with CAS, without
+        taking any locks.
+
+        The objects and their unique keys are left in place while the
+        queries pertaining to them are invalidated, and each object
+        is then stored if what is cached is still what was there
+        before the commit, or else removed, as which version is the
+        newer cannot be told.  The objects are not added to any
+        integrity or shadow keys, so cascading invalidation only
+        reaches them once a query has cached them again.
+        """
+        if ticket is None:
+            return gobpersist.backends.cache.Cache.replace_items(
+                self, items, ticket, others, keys)
+        items = list(items)
+        to_set = {}
+        for gob in items:
+            gob_key = self.key_to_mykey(gob.obj_key)
+            for key in itertools.imap(
+                    self.key_to_mykey,
+                    gob.unique_keyset()):
+                to_set[self.separator.join(key)] = self.serializer.dumps(gob_key)
+                if not self.use_generations:
+                    to_set[self.shadow_prefix + self.separator + self.separator.join(key)] = self.serializer.dumps(gob_key)
+        self.invalidate(items + list(others or ()), keys,
+                        set(ticket) | set(to_set))
+        to_delete = []
+        with self.pool.reserve(*self.mc_args, **self.mc_kwargs) as mc:
+            for gob in items:
+                key = self.separator.join(self.key_to_mykey(gob.obj_key))
+                if key not in ticket \
+                        or not self.cas_write(
+                            mc, key,
+                            self.serializer.dumps(self.gob_to_mygob(gob)),
+                            ticket[key]):
+                    to_delete.append(key)
+            if to_set:
+                mc.set_multi(to_set, self.expiry)
+            if to_delete:
+                mc.delete_multi(to_delete)
+
     def _key_range_to_key(self, key_range):
         return key_range[0] + ('-',) + key_range[1]
 
-    def _serialize_term(self, term):
-        if isinstance(term, dict):
-            # Quantifier
-            if len(term) > 1:
-                raise gobpersist.exception.QueryError("Too many keys in quantifier")
-            k, v = term.items()[0]
-            v = self._serialize_term(v)
-            return ('_' + k + '_',) + v
-        elif isinstance(term, tuple):
-            # Identifier
-            return ('(',) + term + (')',)
-        else:
-            # Literal
-            return (repr(term),)
-
-    def _serialize_query(self, query):
-        ret = []
-        for cmd, args in query.iteritems():
-            if len(args) == 0:
-                continue
-            if cmd in ('gt', 'ge', 'lt', 'le', 'eq', 'ne'):
-                if len(args) < 2:
-                    continue
-                for term in args[:-1]:
-                    ret.extend(self._serialize_term(term))
-                    ret.append('_' + cmd + '_')
-                ret.extend(self._serialize_term(args[-1]))
-            elif cmd in ('and', 'or'):
-                if len(args) == 1:
-                    ret.append(self._serialize_query(args[0]))
-                else:
-                    for subquery in args[:-1]:
-                        ret.append('(')
-                        ret.extend(self._serialize_query(subquery))
-                        ret.append(')')
-                        ret.append('_' + cmd + '_')
-                    ret.append('(')
-                    ret.extend(self._serialize_query(args[-1]))
-                    ret.append(')')
-            elif cmd in ('nor', 'not'):
-                if len(args) == 1:
-                    ret.append('_not_')
-                    ret.append('(')
-                    ret.extend(self._serialize_query(args[0]))
-                    ret.append(')')
-                else:
-                    for subquery in args[:-1]:
-                        ret.append('(')
-                        ret.extend(self._serialize_query(subquery))
-                        ret.append(')')
-                        ret.append('_nor_')
-                    ret.append('(')
-                    ret.extend(self._serialize_query(args[-1]))
-                    ret.append(')')
-            else:
-                raise gobpersist.exception.QueryError("Unknown query element %s" % repr(cmd))
-        return tuple(ret)
-
-    def _query_to_key(self, key, query):
-        return key + ('_WHERE_',) + self._serialize_query(query)
+    def _query_to_key(self, cls, key, query):
+        # The digest keeps the key short and independent of how the
+        # query happened to be written.
+        return key + ('_WHERE_', self.query_digest(cls, query))
 
     def _retrieve_to_key(self, key, retrieve):
         return key + ('_RETRIEVE_',) + tuple(retrieve)
 
     def _offlim_to_key(self, key, offset, limit):
         return key + ('_OFFSET_',) \
-            + ('_NULL_',) if offset is None else (offset,) \
+            + (('_NULL_',) if offset is None else (offset,)) \
             + ('_LIMIT_',) \
-            + ('_NULL_',) if limit is None else (limit,)
+            + (('_NULL_',) if limit is None else (limit,))
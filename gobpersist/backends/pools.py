@@ -19,11 +19,14 @@
 .. codeauthor:: Evan Buswell <evan.buswell@accellion.com>
 """
 
+import os
 import thread
 import threading
 import contextlib
 import time
 
+import gobpersist.exception
+
 class SimpleThreadMappedPool(object):
     def __init__(self, client, keeptime=180):
         """
@@ -36,6 +39,17 @@ class SimpleThreadMappedPool(object):
         self.pool = {}
         self.client = client
         self.keeptime = keeptime
+        self.pid = os.getpid()
+
+    def check_pid(self):
+        """Forget any clients inherited across a fork.
+
+        The child's copies of the parent's connections share the
+        parent's sockets, so they are dropped without being closed.
+        """
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.pool = {}
 
     def prune(self):
         live_thread_ids = set([thread.ident for thread in threading.enumerate() \
@@ -63,6 +77,7 @@ class SimpleThreadMappedPool(object):
               # do client stuff
            # connection has been returned to the pool.
         """
+        self.check_pid()
         thread_id = thread.get_ident()
         if thread_id not in self.pool:
             # create a new Client
@@ -81,12 +96,22 @@ class SimpleThreadMappedPool(object):
                 self.alloc_client(client_hash, args, kwargs)
             yield client_hash['client']
 
+    def warm(self, n=1, *args, **kwargs):
+        """Open a client ahead of time.
+
+        In this implementation, it will open the current thread's
+        client, and ``n`` is ignored.
+        """
+        with self.reserve(*args, **kwargs):
+            pass
+
     def relinquish(self):
         """Relinquish any claim to a client.
 
         In this implementation, it will simply close the current
         thread's client.
         """
+        self.check_pid()
         thread_id = thread.get_ident()
         if thread_id in self.pool:
             client_hash = self.pool[thread_id]
@@ -104,3 +129,280 @@ class SimpleThreadMappedPool(object):
             client = None
 
         return client
+
+
+class BoundedPool(object):
+    """A pool of at most ``max_size`` clients, shared by all threads.
+
+    A thread checks a client out of the pool for the duration of
+    :func:`reserve` and returns it afterwards, so the number of
+    clients follows the number of concurrent requests rather than the
+    number of threads.  A thread which reserves a client while it
+    already holds one with the same arguments gets the same client
+    back.
+    """
+
+    def __init__(self, client, max_size=10, max_idle=60, timeout=5,
+                 check=None, check_idle=5,
+                 client_errors=(EnvironmentError, EOFError)):
+        """
+        Args:
+          ``client``: The class of the client object.
+
+             We will be instantiating these based on the ``args`` and
+             ``kwargs`` passed in to :func:`reserve`.
+
+          ``max_size``: The greatest number of clients to have open
+          at once.
+
+          ``max_idle``: The time, in seconds, after which an unused
+          client is closed.
+
+          ``timeout``: The time, in seconds, to wait for a client to
+          become free, or ``None`` to wait forever.
+
+             :class:`gobpersist.exception.PoolTimeout` is raised if
+             none does.
+
+          ``check``: A function taking a client and returning whether
+          it is still usable, or ``None``.
+
+          ``check_idle``: The time, in seconds, for which a client
+          must have been unused before ``check`` is called on it.
+
+          ``client_errors``: The exceptions which mean that a client
+          has failed, so that it is closed rather than returned to
+          the pool when one escapes :func:`reserve`.
+
+             The default covers socket errors.
+        """
+        self.client = client
+        """The class of the client object."""
+
+        self.max_size = max_size
+        """The greatest number of clients to have open at once."""
+
+        self.max_idle = max_idle
+        """The time, in seconds, after which an unused client is
+        closed."""
+
+        self.timeout = timeout
+        """The time, in seconds, to wait for a client to become free,
+        or ``None`` to wait forever."""
+
+        self.check = check
+        """A function taking a client and returning whether it is
+        still usable, or ``None``."""
+
+        self.check_idle = check_idle
+        """The time, in seconds, for which a client must have been
+        unused before ``check`` is called on it."""
+
+        self.client_errors = client_errors
+        """The exceptions which mean that a client has failed."""
+
+        self.idle = []
+        """The free clients, as dictionaries of ``args``, ``kwargs``,
+        ``client`` and ``time``, from least to most recently used."""
+
+        self.size = 0
+        """The number of clients open, free or not."""
+
+        self.cond = threading.Condition()
+        """Protects ``idle`` and ``size``, and signals when a client is
+        returned."""
+
+        self.local = threading.local()
+        """The client each thread currently holds."""
+
+        self.pid = os.getpid()
+        """The process which opened the clients."""
+
+    def check_pid(self):
+        """Forget any clients inherited across a fork.
+
+        The child's copies of the parent's connections share the
+        parent's sockets, so they are dropped without being closed.
+        The lock is replaced too, since another thread of the parent
+        may have held it at the time of the fork.
+        """
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.idle = []
+            self.size = 0
+            self.cond = threading.Condition()
+            self.local = threading.local()
+
+    def warm(self, n, *args, **kwargs):
+        """Open up to ``n`` clients for ``args`` and ``kwargs`` ahead
+        of time, so that the first requests need not wait to
+        connect.
+
+        Never opens more than ``max_size`` clients in all.  Returns
+        the number opened.
+        """
+        self.check_pid()
+        opened = 0
+        while opened < n:
+            with self.cond:
+                if self.size >= self.max_size:
+                    break
+                self.size += 1
+            try:
+                client = self.client(*args, **kwargs)
+            except:
+                self.discard(None)
+                raise
+            self.checkin({'args': args, 'kwargs': kwargs,
+                          'client': client, 'time': time.time()})
+            opened += 1
+        return opened
+
+    def checkout(self, args, kwargs):
+        """Take a client for ``args`` and ``kwargs`` out of the pool,
+        opening one if necessary.
+
+        Returns a client hash as stored in ``idle``.
+        """
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        while True:
+            client_hash = None
+            to_close = []
+            with self.cond:
+                while True:
+                    now = time.time()
+                    # Close anything which has sat unused too long
+                    while self.idle \
+                            and self.idle[0]['time'] + self.max_idle < now:
+                        to_close.append(self.idle.pop(0))
+                        self.size -= 1
+                    for i in xrange(len(self.idle) - 1, -1, -1):
+                        if self.idle[i]['args'] == args \
+                                and self.idle[i]['kwargs'] == kwargs:
+                            client_hash = self.idle.pop(i)
+                            break
+                    if client_hash is not None:
+                        break
+                    if self.size < self.max_size:
+                        self.size += 1
+                        break
+                    if self.idle:
+                        # Make room by closing a client for some other
+                        # arguments
+                        to_close.append(self.idle.pop(0))
+                        self.size -= 1
+                        continue
+                    if self.timeout is None:
+                        self.cond.wait()
+                    else:
+                        remaining = deadline - now
+                        if remaining <= 0:
+                            raise gobpersist.exception.PoolTimeout(
+                                "No client became free within %s seconds" \
+                                    % self.timeout)
+                        self.cond.wait(remaining)
+            for old_hash in to_close:
+                self.client_close(old_hash['client'])
+            if client_hash is None:
+                try:
+                    return {'args': args, 'kwargs': kwargs,
+                            'client': self.client(*args, **kwargs),
+                            'time': time.time()}
+                except:
+                    self.discard(None)
+                    raise
+            if self.check is None \
+                    or client_hash['time'] + self.check_idle > time.time():
+                return client_hash
+            try:
+                if self.check(client_hash['client']):
+                    return client_hash
+            except Exception:
+                pass
+            # Unhealthy; throw it away and try again
+            self.discard(client_hash['client'])
+
+    def checkin(self, client_hash):
+        """Return a client hash to the pool."""
+        client_hash['time'] = time.time()
+        with self.cond:
+            self.idle.append(client_hash)
+            self.cond.notify()
+
+    def discard(self, client):
+        """Close a checked out client rather than returning it to
+        the pool."""
+        with self.cond:
+            self.size -= 1
+            self.cond.notify()
+        if client is not None:
+            self.client_close(client)
+
+    @contextlib.contextmanager
+    def reserve(self, *args, **kwargs):
+        """Reserve a client.
+
+        The arguments passed in will be used for class initialization
+        if necessary.  Note that this function is a
+        ``contextmanager``, hence should be called as::
+
+           with pool.reserve("some", "args") as client:
+              # do client stuff
+           # connection has been returned to the pool.
+
+        If one of ``client_errors`` escapes, or an exception such as
+        ``KeyboardInterrupt`` which may have interrupted the client
+        mid-request, the client is closed rather than returned, since
+        it may be left in an unknown state.  Other exceptions, such as
+        :class:`gobpersist.exception.NotFound`, leave it healthy.
+        """
+        self.check_pid()
+        held = getattr(self.local, 'client_hash', None)
+        if held is not None and held['args'] == args \
+                and held['kwargs'] == kwargs:
+            yield held['client']
+            return
+        client_hash = self.checkout(args, kwargs)
+        self.local.client_hash = client_hash
+        try:
+            yield client_hash['client']
+        except self.client_errors:
+            self.local.client_hash = held
+            self.discard(client_hash['client'])
+            raise
+        except Exception:
+            self.local.client_hash = held
+            self.checkin(client_hash)
+            raise
+        except:
+            self.local.client_hash = held
+            self.discard(client_hash['client'])
+            raise
+        self.local.client_hash = held
+        self.checkin(client_hash)
+
+    def relinquish(self):
+        """Relinquish any claim to a client.
+
+        In this implementation, it will close all free clients.
+        """
+        self.check_pid()
+        with self.cond:
+            to_close = self.idle
+            self.idle = []
+            self.size -= len(to_close)
+            self.cond.notify_all()
+        for client_hash in to_close:
+            self.client_close(client_hash['client'])
+
+    def client_close(self, client):
+        # Try to close the existing connection using the
+        # standard methods.
+        if hasattr(client, 'close'):
+            client.close()
+        else: # Or let gc clean up the resources.
+            del client
+            client = None
+
+        return client
@@ -0,0 +1,230 @@
+# serializer.py - A compact, schema-aware serializer
+# Copyright (C) 2012 Accellion, Inc.
+#
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; version 2.1.
+#
+# This library is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA
+"""A serializer for the key-value back ends which stores gobs as
+positional tuples, using the fields of their classes.
+
+.. codeauthor:: Evan Buswell <evan.buswell@accellion.com>
+"""
+
+import marshal
+import json
+import cPickle as pickle
+import datetime
+import binascii
+import operator
+import zlib
+
+import gobpersist.field
+
+MAGIC = '\xa7'
+"""The first byte of every value written by
+:class:`SchemaSerializer`.  Pickles start with ``'\\x80'`` and JSON
+with a printable character, so the three can be told apart."""
+
+_RECORD = 0
+_RECORDS = 1
+_VALUE = 2
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+class _Unencodable(Exception):
+    """A value does not fit the field it is stored under."""
+    pass
+
+def _encode_datetime(value):
+    if value is None:
+        return None
+    if type(value) is not datetime.datetime:
+        raise _Unencodable()
+    if value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    delta = value - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 \
+        + delta.microseconds
+
+def _decode_datetime(value):
+    if value is None:
+        return None
+    return _EPOCH + datetime.timedelta(microseconds=value)
+
+def _encode_uuid(value):
+    if value is None:
+        return None
+    if not isinstance(value, basestring) \
+            or not gobpersist.field.UUIDField.validate_re.match(value):
+        raise _Unencodable()
+    return binascii.unhexlify(value.replace('-', ''))
+
+def _decode_uuid(value):
+    if value is None:
+        return None
+    value = binascii.hexlify(value)
+    return u'%s-%s-%s-%s-%s' % (value[:8], value[8:12], value[12:16],
+                                value[16:20], value[20:])
+
+class SchemaSerializer(object):
+    """A serializer which stores gobs as tuples of their field values,
+    in a fixed order, tagged with the class key and a version of the
+    field layout of their class.
+
+    Date and time fields are stored as integer microseconds since the
+    epoch, in UTC, and read back as naive datetimes.  UUID fields are
+    stored as their sixteen bytes, and read back as unicode, as
+    :class:`gobpersist.field.UUIDField` holds them.  The result is
+    encoded with :mod:`marshal`.  Values which are not gobs of a known
+    class are marshalled as they are, and values which cannot be
+    marshalled are pickled.
+
+    Values written as JSON by
+    :class:`gobpersist.backends.memcached.JsonWrapper` or pickled by
+    either ``PickleWrapper`` are read as before, so an existing store
+    can be switched to this serializer in place.
+
+    The version of a layout changes whenever fields are added to,
+    removed from or retyped in a class.  To read records written
+    before such a change, pass the class as it was as well, along
+    with the current one; records are always written with the
+    layout of the last class given for each set of field names.
+
+    Like pickle, this should only be used to read data from a trusted
+    source.
+    """
+
+    def __init__(self, classes):
+        """
+        Args:
+           ``classes``: The gob classes whose instances should be
+           stored positionally.
+        """
+        self.layouts = {}
+        """The field layouts known for decoding, by class key and
+        version.
+
+        Each is a tuple of the field names, in order, and of the
+        position and decoding function of each field which needs
+        decoding.
+        """
+
+        self.encoders = {}
+        """The layout for encoding a dictionary, by its set of field
+        names.
+
+        Each is a tuple of the class key, the version, a function
+        returning the field values, in order, and the position and
+        encoding function of each field which needs encoding.
+        """
+
+        for cls in classes:
+            self.add_class(cls)
+
+    def add_class(self, cls):
+        """Add the layout of gob class ``cls``."""
+        fields = sorted(cls._plain_fields, key=lambda f: f.name)
+        names = tuple([f.name for f in fields])
+        kinds = tuple([self._kind(f) for f in fields])
+        version = zlib.crc32(repr((names, kinds))) & 0xffffffff
+        coders = {'datetime': (_encode_datetime, _decode_datetime),
+                  'uuid': (_encode_uuid, _decode_uuid)}
+        special = [(i, coders[kind]) for i, kind in enumerate(kinds) \
+                       if kind is not None]
+        if len(names) == 1:
+            getter = lambda obj: (obj[names[0]],)
+        else:
+            getter = operator.itemgetter(*names)
+        self.layouts[(cls.class_key, version)] \
+            = (names, tuple([(names[i], coder[1]) for i, coder in special]))
+        self.encoders[frozenset(names)] \
+            = (cls.class_key, version, getter,
+               tuple([(i, coder[0]) for i, coder in special]))
+
+    def _kind(self, f):
+        if isinstance(f, gobpersist.field.DateTimeField):
+            return 'datetime'
+        if isinstance(f, gobpersist.field.UUIDField):
+            return 'uuid'
+        return None
+
+    def _encode_record(self, obj):
+        """The positional form of the dictionary ``obj``, or ``None``
+        if it is not a gob of a known class."""
+        if type(obj) is not dict:
+            return None
+        encoder = self.encoders.get(frozenset(obj))
+        if encoder is None:
+            return None
+        class_key, version, getter, encoders = encoder
+        values = getter(obj)
+        if encoders:
+            values = list(values)
+            try:
+                for i, encode in encoders:
+                    values[i] = encode(values[i])
+            except _Unencodable:
+                return None
+        return (class_key, version, values)
+
+    def _decode_record(self, record):
+        class_key, version, values = record
+        layout = self.layouts.get((class_key, version))
+        if layout is None:
+            raise ValueError("Unknown layout %d for class '%s'" \
+                                 % (version, class_key))
+        names, decoders = layout
+        ret = dict(zip(names, values))
+        for name, decode in decoders:
+            ret[name] = decode(ret[name])
+        return ret
+
+    def dumps(self, obj):
+        record = self._encode_record(obj)
+        if record is not None:
+            payload = (_RECORD,) + record
+        else:
+            payload = None
+            if type(obj) is list and obj:
+                records = []
+                for item in obj:
+                    record = self._encode_record(item)
+                    if record is None:
+                        break
+                    records.append(record)
+                else:
+                    payload = (_RECORDS, records)
+            if payload is None:
+                payload = (_VALUE, obj)
+        try:
+            return MAGIC + marshal.dumps(payload, 2)
+        except ValueError:
+            # Not marshallable, e.g. a datetime outside a known field
+            return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        if data[:1] == MAGIC:
+            payload = marshal.loads(data[1:])
+            if payload[0] == _RECORD:
+                return self._decode_record(payload[1:])
+            elif payload[0] == _RECORDS:
+                return [self._decode_record(record) \
+                            for record in payload[1]]
+            return payload[1]
+        elif data[:1] == '\x80':
+            return pickle.loads(data)
+        try:
+            return json.loads(data)
+        except ValueError:
+            # An older pickle protocol
+            return pickle.loads(data)
@@ -24,6 +24,7 @@ import cPickle as pickle
 import datetime
 import itertools
 import socket
+import uuid
 
 import pytyrant
 
@@ -31,6 +32,7 @@ import gobpersist.backends.gobkvquerent
 import gobpersist.exception
 import gobpersist.field
 import gobpersist.backends.pools
+import gobpersist.backends.locks
 
 # These ought to be defined in pytyrant
 PYTTINVALID = 1
@@ -52,7 +54,7 @@ class PickleWrapper(object):
 
 class TyrantClient(pytyrant.Tyrant):
     """Wrapper class to create a "Client" class suitable for use with
-    the :class:`gobpersist.backends.pools.SimpleThreadMappedPool`.
+    the pools in :mod:`gobpersist.backends.pools`.
     """
     def __init__(self, host='127.0.0.1', port=pytyrant.DEFAULT_PORT,
                  unix=None):
@@ -74,7 +76,94 @@ class TyrantClient(pytyrant.Tyrant):
             sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
         super(TyrantClient, self).__init__(sock)
 
-default_pool = gobpersist.backends.pools.SimpleThreadMappedPool(client=TyrantClient)
+default_pool = gobpersist.backends.pools.BoundedPool(
+    client=TyrantClient,
+    check=lambda tyrant: tyrant.rnum() is not None)
+
+class TyrantLockManager(gobpersist.backends.locks.LockManager):
+    """Lock manager which stores locks in Tokyo Tyrant.
+
+    Tokyo Tyrant does not expire records, so each lock records the
+    claims made on it, each as the time it was made, the time at which
+    its lease lapses and a token naming the claimant.  A claim made
+    before the lease of the claim holding the lock has lapsed is void.
+    A lock found past its lease is taken over by appending a new claim
+    atomically, so that when several processes try to take it over at
+    once, all of them agree that the first to append has won.
+    """
+
+    def __init__(self, backend, *args, **kwargs):
+        """
+        Args:
+           ``backend``: The :class:`TokyoTyrantBackend` whose
+           connections to use.
+
+           Other arguments are as for
+           :class:`gobpersist.backends.locks.LockManager`.
+        """
+        self.backend = backend
+        """The back end whose connections to use."""
+
+        super(TyrantLockManager, self).__init__(*args, **kwargs)
+
+    def holder(self, value):
+        """The lease expiry and token of the claim holding a lock
+        whose value is ``value``."""
+        held = None
+        for claim in value.split(';'):
+            if not claim:
+                continue
+            parts = claim.split(':')
+            if len(parts) == 1:
+                # A lock from before claims
+                made, expires, token = 0.0, float(parts[0]), None
+            else:
+                made, expires, token = float(parts[0]), float(parts[1]), \
+                    parts[2]
+            if held is None or made >= held[0]:
+                held = (expires, token)
+        return held
+
+    def add_locks(self, locks):
+        # no putkeeplist??  At least use a single connection.
+        backend = self.backend
+        now = time.time()
+        token = uuid.uuid4().hex
+        claim = '%r:%r:%s' % (now, now + self.lease, token)
+        acquired = []
+        with backend.pool.reserve(*backend.tt_args,
+                                  **backend.tt_kwargs) as tyrant:
+            for lock in locks:
+                try:
+                    tyrant.putkeep(lock, claim)
+                except pytyrant.TyrantError as terr:
+                    if terr.args[0] != PYTTKEEP:
+                        raise
+                    try:
+                        held = self.holder(tyrant.get(lock))
+                    except (pytyrant.TyrantError, TypeError, ValueError):
+                        # Released in the meantime; try again later.
+                        continue
+                    if held is not None and held[0] >= now:
+                        continue
+                    # The lease has lapsed; claim the lock, and see
+                    # whether another claim got in first.
+                    tyrant.putcat(lock, ';' + claim)
+                    try:
+                        held = self.holder(tyrant.get(lock))
+                    except (pytyrant.TyrantError, TypeError, ValueError):
+                        continue
+                    if held is None or held[1] != token:
+                        continue
+                acquired.append(lock)
+        return acquired
+
+    def remove_locks(self, locks):
+        backend = self.backend
+        with backend.pool.reserve(*backend.tt_args,
+                                  **backend.tt_kwargs) as tyrant:
+            tyrant.misc("outlist", 0, locks)
+
 
 class TokyoTyrantBackend(gobpersist.backends.gobkvquerent.GobKVQuerent):
     """Gob back end which uses Tokyo Tyrant for storage"""
@@ -82,7 +171,9 @@ class TokyoTyrantBackend(gobpersist.backends.gobkvquerent.GobKVQuerent):
     def __init__(self, host='127.0.0.1', port=pytyrant.DEFAULT_PORT,
                  unix=None, serializer=PickleWrapper, lock_prefix='_lock',
                  pool=default_pool, separator='.', lock_tries=8,
-                 lock_backoff=0.25):
+                 lock_backoff=0.25, lazy_hydration=False,
+                 collection_buckets=None, lock_lease=30,
+                 lock_initial_backoff=0.01):
         """
         Args:
            ``host``: The hostname to connect to.
@@ -95,7 +186,9 @@ class TokyoTyrantBackend(gobpersist.backends.gobkvquerent.GobKVQuerent):
            ``serializer``: An object which provides serialization of
            gobpersist data.
 
-              Must provide ``loads`` and ``dumps``.
+              Must provide ``loads`` and ``dumps``.  See
+              :class:`gobpersist.backends.serializer.SchemaSerializer`
+              for a more compact one.
 
            ``lock_prefix``: A string to prepend to a key value to
            represent the lock for that key.
@@ -107,19 +200,44 @@ class TokyoTyrantBackend(gobpersist.backends.gobkvquerent.GobKVQuerent):
               The default is '.'.
 
            ``lock_tries``: The number of times to try locking before
-           forcibly acquiring all locks.
+           raising :class:`gobpersist.exception.Deadlock`.
+
+              A lock held under a valid lease is never taken over; a
+              lock left by a crashed or hung process is freed once
+              its lease lapses.  The default is 8.
+
+           ``lock_backoff``: The longest amount of time, in seconds,
+           for the locking mechanism to wait between tries.
+
+              The default is 0.25.  Waits start at up to
+              ``lock_initial_backoff`` and double with each try, with
+              random jitter, up to this.  The wait for any lock
+              acquisition is therefore at most the sum of these
+              limits over ``lock_tries - 1`` retries, so consider all
+              three values when fine-tuning them.
+
+           ``lazy_hydration``: Whether to create the fields of
+           retrieved gobs only on first access.
 
-              Since there's no way to monitor other processes to make
-              sure they've properly cleaned up, this prevents a
-              permanent object lock by a crashed or hung process.  The
-              default is 8.
+              See :attr:`gobpersist.session.GobTranslator.lazy_hydration`.
 
-           ``lock_backoff``: The amount of time, in seconds, for the
-           locking mechanism to wait between tries.
+           ``collection_buckets``: The number of buckets in which to
+           store new collections.
 
-              The default is 0.25.  The maximum wait time for any lock
-              acquisition is ``lock_tries * lock_backoff``, so
-              consider this value when fine-tuning these.
+              See
+              :attr:`gobpersist.backends.gobkvquerent.GobKVQuerent.collection_buckets`.
+
+           ``lock_lease``: The time, in seconds, after which a lock
+           may be taken over.
+
+              This frees the locks of a crashed or hung process, and
+              should be comfortably longer than any commit.  The
+              default is 30.
+
+           ``lock_initial_backoff``: The longest amount of time, in
+           seconds, to wait before the first retry of locking.
+
+              The default is 0.01.
         """
         self.tt_args = ()
         self.tt_kwargs = {'host': host, 'port': port, 'unix': unix}
@@ -141,25 +259,54 @@ class TokyoTyrantBackend(gobpersist.backends.gobkvquerent.GobKVQuerent):
         """
 
         self.lock_tries = lock_tries
-        """The number of times to try locking before forcibly
-        acquiring all locks.
+        """The number of times to try locking before raising
+        :class:`gobpersist.exception.Deadlock`.
 
-        Since there's no way to monitor other processes to make sure
-        they've properly cleaned up, this prevents a permanent object
-        lock by a crashed or hung process.  The default is 8.
+        A lock held under a valid lease is never taken over.  The
+        default is 8.
         """
 
         self.lock_backoff = lock_backoff
-        """The amount of time, in seconds, for the locking mechanism
-        to wait between tries.
+        """The longest amount of time, in seconds, for the locking
+        mechanism to wait between tries.
 
-        The default is 0.25.  The maximum wait time for any lock
-        acquisition is ``lock_tries * lock_backoff``, so consider this
-        value when fine-tuning these.
+        The default is 0.25.  Waits start at up to
+        ``lock_initial_backoff`` and double with each try, up to this.
         """
 
+        self.lock_manager = TyrantLockManager(self, tries=lock_tries,
+                                              backoff=lock_initial_backoff,
+                                              max_backoff=lock_backoff,
+                                              lease=lock_lease)
+        """The lock manager, whose ``stats`` count lock contention."""
+
+        self.lazy_hydration = lazy_hydration
+        """Whether to create the fields of retrieved gobs only on
+        first access."""
+
+        self.collection_buckets = collection_buckets
+        """The number of buckets in which to store new collections."""
+
         super(TokyoTyrantBackend, self).__init__()
 
+    def do_kv_bucket_members(self, key, head):
+        """Fetch the members of the bucketed collection at ``key``,
+        whose head is ``head``, in a single round trip."""
+        keys = [str(self.separator.join(bucket_key)) \
+                    for bucket_key \
+                    in self._bucket_keys(key, head['_BUCKETS_'])]
+        with self.pool.reserve(*self.tt_args, **self.tt_kwargs) as tyrant:
+            try:
+                res = tyrant.mget(keys)
+            except pytyrant.TyrantError as terr:
+                if terr.args[0] == PYTTNOREC:
+                    # A missing bucket is empty
+                    return []
+                else:
+                    raise
+        return list(itertools.chain(*[self.serializer.loads(value) \
+                                          for key, value in res]))
+
     def do_kv_multi_query(self, cls, keys):
         keys = [str(self.separator.join(key)) for key in keys]
         with self.pool.reserve(*self.tt_args, **self.tt_kwargs) as tyrant:
@@ -188,6 +335,10 @@ class TokyoTyrantBackend(gobpersist.backends.gobkvquerent.GobKVQuerent):
                 else:
                     # Reference
                     ret.append(self.do_kv_query(cls, store)[0])
+            elif self._is_bucket_head(store):
+                # Bucketed collection; key is already joined
+                ret.append(self.do_kv_multi_query(
+                        cls, self.do_kv_bucket_members((key,), store)))
             else:
                 # Object
                 ret.append(self.mygob_to_gob(cls, store))
@@ -224,16 +375,100 @@ class TokyoTyrantBackend(gobpersist.backends.gobkvquerent.GobKVQuerent):
             else:
                 # Reference
                 return self.do_kv_query(cls, store)
+        elif self._is_bucket_head(store):
+            # Bucketed collection
+            return self.do_kv_multi_query(
+                cls, self.do_kv_bucket_members(key, store))
         else:
             # Object
             return [self.mygob_to_gob(cls, store)]
 
+    def do_kv_iterquery(self, cls, key, chunk_size):
+        with self.pool.reserve(*self.tt_args, **self.tt_kwargs) as tyrant:
+            try:
+                res = tyrant.get(str(self.separator.join(key)))
+            except pytyrant.TyrantError as terr:
+                if terr.args[0] == PYTTNOREC:
+                    raise gobpersist.exception.NotFound(
+                        "Could not find value for key %s" \
+                            % self.separator.join(key))
+                else:
+                    raise
+        if res == None:
+            raise gobpersist.exception.NotFound(
+                "Could not find value for key %s" \
+                    % self.separator.join(key))
+        store = self.serializer.loads(res)
+        if isinstance(store, (list, tuple)):
+            # Collection or reference?
+            if len(store) == 0:
+                # Empty collection
+                return iter(store)
+            elif isinstance(store[0], (list, tuple)):
+                # Collection
+                return self._iter_multi_query(cls, store, chunk_size)
+            else:
+                # Reference
+                return self.do_kv_iterquery(cls, store, chunk_size)
+        elif self._is_bucket_head(store):
+            # Bucketed collection
+            return self._iter_multi_query(
+                cls, self.do_kv_bucket_members(key, store), chunk_size)
+        else:
+            # Object
+            return iter([self.mygob_to_gob(cls, store)])
+
+    def multi_query(self, cls, keys):
+        mykeys = [self.key_to_mykey(key) for key in keys]
+        joined = [str(self.separator.join(mykey)) for mykey in mykeys]
+        with self.pool.reserve(*self.tt_args, **self.tt_kwargs) as tyrant:
+            try:
+                res = dict(tyrant.mget(list(set(joined))))
+            except pytyrant.TyrantError as terr:
+                if terr.args[0] == PYTTNOREC:
+                    res = {}
+                else:
+                    raise
+        ret = [None] * len(keys)
+        for i, (mykey, k) in enumerate(itertools.izip(mykeys, joined)):
+            if k not in res:
+                continue
+            store = self.serializer.loads(res[k])
+            try:
+                if isinstance(store, (list, tuple)):
+                    # Collection or reference?
+                    if len(store) == 0:
+                        # Empty collection
+                        ret[i] = []
+                    elif isinstance(store[0], (list, tuple)):
+                        # Collection
+                        ret[i] = self.do_kv_multi_query(cls, store)
+                    else:
+                        # Reference
+                        ret[i] = self.do_kv_query(cls, store)
+                elif self._is_bucket_head(store):
+                    # Bucketed collection
+                    ret[i] = self.do_kv_multi_query(
+                        cls, self.do_kv_bucket_members(mykey, store))
+                else:
+                    # Object
+                    ret[i] = [self.mygob_to_gob(cls, store)]
+            except gobpersist.exception.NotFound:
+                pass
+        return ret
+
     def kv_query(self, cls, key=None, key_range=None):
         if key_range is not None:
             raise gobpersist.exception.UnsupportedError("key_range is not yet supported by" \
                                                             " TokyoTyrantBackend")
         return self.do_kv_query(cls, self.key_to_mykey(key))
 
+    def kv_iterquery(self, cls, key=None, key_range=None, chunk_size=100):
+        if key_range is not None:
+            raise gobpersist.exception.UnsupportedError("key_range is not yet supported by" \
+                                                            " TokyoTyrantBackend")
+        return self.do_kv_iterquery(cls, self.key_to_mykey(key), chunk_size)
+
     def acquire_locks(self, locks):
         """Atomically acquires a set of locks.
 
@@ -241,43 +476,11 @@ class TokyoTyrantBackend(gobpersist.backends.gobkvquerent.GobKVQuerent):
         module, as the locking mechanism was does not support holding
         locks for long periods of time.
         """
-        tries = self.lock_tries
-        # After this many tries, we forcibly acquire the locks
-
-        locks_acquired = []
-        with self.pool.reserve(*self.tt_args, **self.tt_kwargs) as tyrant:
-            while tries > 0:
-                try:
-                    for lock in locks:
-                        # Lock the object
-                        tyrant.putkeep(lock, '1')
-                        locks_acquired.append(lock)
-                except pytyrant.TyrantError as terr:
-                    # Back out all acquired locks
-                    self.release_locks(locks_acquired)
-                    if terr.args[0] == PYTTKEEP:
-                        # The object is locked!  Start over
-                        locks_acquired = []
-                        tries -= 1
-                        time.sleep(self.lock_backoff)
-                    else:
-                        raise
-                except:
-                    # Back out all acquired locks
-                    self.release_locks(locks_acquired)
-                    raise
-                else:
-                    # We acquired all the locks
-                    return locks_acquired
-
-            # We failed to acquire locks after *tries* attempts.  Say a
-            # hail mary and force acquire.
-            tyrant.misc("putlist", 0, [item for lock in locks for item in (lock, '1')])
+        return self.lock_manager.acquire(locks)
 
     def release_locks(self, locks):
         """Releases a set of locks."""
-        with self.pool.reserve(*self.tt_args, **self.tt_kwargs) as tyrant:
-            tyrant.misc("outlist", 0, locks)
+        self.lock_manager.release(locks)
 
     def key_to_mykey(self, key, use_persisted_version=False):
         mykey = super(TokyoTyrantBackend, self).key_to_mykey(key,
@@ -397,13 +600,22 @@ class TokyoTyrantBackend(gobpersist.backends.gobkvquerent.GobKVQuerent):
                 locks.add(self.lock_prefix + self.separator + self.separator.join(key))
                 to_delete.append(key)
 
+        to_clear = []
         for key in itertools.imap(self.key_to_mykey, collection_additions):
             locks.add(self.lock_prefix + self.separator + self.separator.join(key))
-            to_add.append((key, []))
+            if self.collection_buckets:
+                to_add.append((key, {'_BUCKETS_': self.collection_buckets}))
+                to_clear.extend(self._bucket_keys(key,
+                                                  self.collection_buckets))
+            else:
+                to_add.append((key, []))
 
         for key in itertools.imap(self.key_to_mykey, collection_removals):
             locks.add(self.lock_prefix + self.separator + self.separator.join(key))
             to_delete.append(key)
+            if self.collection_buckets:
+                to_delete.extend(self._bucket_keys(key,
+                                                   self.collection_buckets))
 
         # Acquire locks
         self.acquire_locks(locks)
@@ -448,32 +660,24 @@ class TokyoTyrantBackend(gobpersist.backends.gobkvquerent.GobKVQuerent):
                 add_multi.append((self.separator.join(add[0]), self.serializer.dumps(add[1])))
             # no putkeeplist??
             with self.pool.reserve(*self.tt_args, **self.tt_kwargs) as tyrant:
+                if to_clear:
+                    # New collections start with empty buckets
+                    tyrant.misc("outlist", 0, [self.separator.join(clear) for clear in to_clear])
                 tyrant.misc("putlist", 0, [item for tuple_ in add_multi for item in tuple_])
-                c_addsrms_list = tyrant.mget([self.separator.join(c_add[0]) \
-                                                      for c_add \
-                                                      in itertools.chain(
-                                                          collection_add,
-                                                          collection_remove)])
-                c_addsrms = {}
-                for key, value in c_addsrms_list:
-                    c_addsrms[key] \
-                        = set([tuple(path)
-                               for path in self.serializer.loads(value)])
-                for c_add in collection_add:
-                    key = self.separator.join(c_add[0])
-                    if key in c_addsrms:
-                        res = c_addsrms[key]
-                    else:
-                        res = c_addsrms[key] = set()
-                    res.add(c_add[1])
-                for c_rm in collection_remove:
-                    key = self.separator.join(c_add[0])
-                    if key in c_addsrms:
-                        res = c_addsrms[key]
-                        res.discard(c_rm[1])
+                def fetch(keys):
+                    try:
+                        res = tyrant.mget(keys)
+                    except pytyrant.TyrantError as terr:
+                        if terr.args[0] == PYTTNOREC:
+                            return {}
+                        else:
+                            raise
+                    return dict([(key, self.serializer.loads(value)) \
+                                     for key, value in res])
                 set_multi = []
-                for k, v in c_addsrms.iteritems():
-                    set_multi.append((k, self.serializer.dumps(list(v))))
+                for k, v in self._collection_changes(
+                        fetch, collection_add, collection_remove).iteritems():
+                    set_multi.append((k, self.serializer.dumps(v)))
                 for setting in to_set:
                     set_multi.append((self.separator.join(setting[0]),
                                       self.serializer.dumps(setting[1])))
@@ -484,3 +688,68 @@ class TokyoTyrantBackend(gobpersist.backends.gobkvquerent.GobKVQuerent):
             self.release_locks(locks)
         # this never changes items on update
         return []
+
+    def _bulk_add_unique(self, tyrant, unique):
+        """Add the unique keys for :func:`kv_bulk_write`, raising
+        :class:`gobpersist.exception.Corruption` and removing those
+        added if any refers to another object already."""
+        # no putkeeplist??  At least use a single connection.
+        added = []
+        collisions = []
+        for key, value in unique.iteritems():
+            key = str(key)
+            try:
+                tyrant.putkeep(key, self.serializer.dumps(value))
+            except pytyrant.TyrantError as terr:
+                if terr.args[0] != PYTTKEEP:
+                    raise
+                try:
+                    existing = tyrant.get(key)
+                except pytyrant.TyrantError as terr:
+                    if terr.args[0] != PYTTNOREC:
+                        raise
+                    existing = None
+                if existing is not None:
+                    existing = self.serializer.loads(existing)
+                if existing is None or tuple(existing) != tuple(value):
+                    collisions.append(key)
+            else:
+                added.append(key)
+        if collisions:
+            if added:
+                tyrant.misc("outlist", 0, added)
+            raise gobpersist.exception.Corruption(
+                "Duplicate addition of unique keys %s detected" \
+                    % repr(collisions))
+
+    def kv_bulk_write(self, records, collection_add, unique={}):
+        # Only collections and unique keys are read before being
+        # written; new objects are simply put.
+        put = []
+        for k, v in records.iteritems():
+            put.append(k)
+            put.append(self.serializer.dumps(v))
+        locks = set([self.lock_prefix + self.separator \
+                         + self.separator.join(key) \
+                         for key, member in collection_add])
+        self.acquire_locks(locks)
+        try:
+            with self.pool.reserve(*self.tt_args, **self.tt_kwargs) as tyrant:
+                self._bulk_add_unique(tyrant, unique)
+                def fetch(keys):
+                    try:
+                        res = tyrant.mget(keys)
+                    except pytyrant.TyrantError as terr:
+                        if terr.args[0] == PYTTNOREC:
+                            return {}
+                        else:
+                            raise
+                    return dict([(key, self.serializer.loads(value)) \
+                                     for key, value in res])
+                for k, v in self._collection_changes(
+                        fetch, collection_add, []).iteritems():
+                    put.append(k)
+                    put.append(self.serializer.dumps(v))
+                tyrant.misc("putlist", 0, put)
+        finally:
+            self.release_locks(locks)
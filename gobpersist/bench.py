@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# bench.py - Micro-benchmarks for Gobpersist
+# Copyright (C) 2012 Accellion, Inc.
+#
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; version 2.1.
+#
+# This library is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA
+"""Micro-benchmarks for the hot paths of gob handling.
+
+Run as a script; each benchmark prints the time per gob in
+microseconds.
+
+.. codeauthor:: Evan Buswell <evan.buswell@accellion.com>
+"""
+
+import sys
+if __name__ == '__main__':
+    import os.path
+
+    libdir = os.path.join(os.path.dirname(__file__), '..')
+    sys.path.insert(0, libdir)
+
+import timeit
+import gc
+import datetime
+import uuid
+
+import gobpersist.gob
+import gobpersist.field
+import gobpersist.session
+import gobpersist.backends.memcached
+import gobpersist.backends.serializer
+
+def get_gob_class():
+    class BenchGob(gobpersist.gob.Gob):
+        my_key = gobpersist.field.UUIDField(primary_key=True)
+        parent_key = gobpersist.field.UUIDField(null=True)
+        boolean_field = gobpersist.field.BooleanField()
+        datetime_field = gobpersist.field.DateTimeField()
+        string_field = gobpersist.field.StringField(encoding='UTF-8')
+        integer_field = gobpersist.field.IntegerField()
+        real_field = gobpersist.field.RealField()
+        enum_field = gobpersist.field.EnumField(choices=('test1','test2'))
+        uuid_field = gobpersist.field.UUIDField()
+        list_field = gobpersist.field.ListField(
+            element_type=gobpersist.field.IntegerField())
+        revision = gobpersist.field.IncrementingField(revision_tag=True)
+
+        parent = gobpersist.field.ForeignObject(foreign_class='self',
+                                                local_field='parent_key',
+                                                foreign_field='primary_key',
+                                                key=('benchgobs', parent_key))
+
+        keys = [('benchgobs', parent_key, 'children')]
+    return BenchGob
+
+def get_gob(cls):
+    return cls(my_key=str(uuid.uuid4()),
+               parent_key=str(uuid.uuid4()),
+               boolean_field=True,
+               datetime_field=datetime.datetime.utcnow(),
+               string_field=u'bench',
+               integer_field=42,
+               real_field=4.2,
+               enum_field='test1',
+               uuid_field=str(uuid.uuid4()),
+               list_field=[1, 2, 3])
+
+def dir_scan_gob_to_mygob(translator, gob):
+    """The reflective serialization which preceded the per-class
+    field tables, kept here as a baseline."""
+    mygob = {}
+    for key in dir(gob):
+        f = getattr(gob, key)
+        if isinstance(f, gobpersist.field.Field) \
+                and not isinstance(f, gobpersist.field.Foreign):
+            mygob[f.name] = translator.field_to_myfield(f)
+    return mygob
+
+def dir_scan_fields(cls):
+    """The reflective field discovery which preceded the per-class
+    field tables, kept here as a baseline."""
+    ret = []
+    for key in dir(cls):
+        value = getattr(cls, key)
+        if isinstance(value, gobpersist.field.Field):
+            ret.append(value)
+    return ret
+
+def field_size(f):
+    """The memory taken by a field, not counting its values."""
+    # Looking up __dict__ would create one on a bound field, so find
+    # it through the garbage collector instead.
+    return sys.getsizeof(f) + sum([sys.getsizeof(o)
+                                   for o in gc.get_referents(f)
+                                   if type(o) is dict])
+
+def gob_size(gob):
+    """The memory taken by a gob and its fields, not counting their
+    values."""
+    size = sys.getsizeof(gob) + sys.getsizeof(gob.__dict__)
+    d = gob.__dict__
+    for value in gob._all_fields:
+        size += field_size(d[value.instance_key])
+    return size
+
+def cloned_gob_size(gob):
+    """The memory the gob would take if each field were a full clone
+    of the class field, as before bound fields."""
+    size = sys.getsizeof(gob) + sys.getsizeof(gob.__dict__)
+    d = gob.__dict__
+    for value in gob._all_fields:
+        f = value.clone()
+        for name in value._instance_attrs:
+            if hasattr(d[value.instance_key], name):
+                setattr(f, name, getattr(d[value.instance_key], name))
+        size += sys.getsizeof(f) + sys.getsizeof(f.__dict__)
+    return size
+
+def report(name, seconds, number):
+    print "%-40s %10.2f usec/gob" % (name, seconds * 1e6 / number)
+
+def run(number=2000):
+    cls = get_gob_class()
+    translator = gobpersist.session.GobTranslator()
+    gob = get_gob(cls)
+    gob.mark_persisted()
+    mygob = translator.gob_to_mygob(gob)
+
+    report("field discovery (dir scan)",
+           timeit.timeit(lambda: dir_scan_fields(cls), number=number),
+           number)
+    report("field discovery (table)",
+           timeit.timeit(lambda: cls._all_fields, number=number),
+           number)
+    report("serialization (dir scan)",
+           timeit.timeit(lambda: dir_scan_gob_to_mygob(translator, gob),
+                         number=number),
+           number)
+    report("serialization (table)",
+           timeit.timeit(lambda: translator.gob_to_mygob(gob),
+                         number=number),
+           number)
+    report("construction (mygob_to_gob)",
+           timeit.timeit(lambda: translator.mygob_to_gob(cls, mygob),
+                         number=number),
+           number)
+
+    def read_two(gob):
+        return (gob.string_field.value, gob.integer_field.value)
+    report("construction + 2 reads (eager)",
+           timeit.timeit(lambda: read_two(translator.mygob_to_gob(cls, mygob)),
+                         number=number),
+           number)
+    lazy_translator = gobpersist.session.GobTranslator()
+    lazy_translator.lazy_hydration = True
+    report("construction + 2 reads (lazy)",
+           timeit.timeit(
+               lambda: read_two(lazy_translator.mygob_to_gob(cls,
+                                                             dict(mygob))),
+               number=number),
+           number)
+
+    serializers = [
+        ('json', gobpersist.backends.memcached.JsonWrapper),
+        ('pickle', gobpersist.backends.memcached.PickleWrapper),
+        ('schema', gobpersist.backends.serializer.SchemaSerializer([cls]))]
+    for name, serializer in serializers:
+        data = serializer.dumps(mygob)
+        report("encoding (%s)" % name,
+               timeit.timeit(lambda: serializer.dumps(mygob), number=number),
+               number)
+        report("decoding (%s)" % name,
+               timeit.timeit(lambda: serializer.loads(data), number=number),
+               number)
+        # JSON leaves datetimes to be parsed by the field
+        report("decoding + construction (%s)" % name,
+               timeit.timeit(
+                   lambda: translator.mygob_to_gob(cls,
+                                                   serializer.loads(data)),
+                   number=number),
+               number)
+        print "%-40s %10d bytes/gob" % ("size (%s)" % name, len(data))
+
+    gob = translator.mygob_to_gob(cls, mygob)
+    print "%-40s %10d bytes/gob" % ("memory (cloned fields)",
+                                    cloned_gob_size(gob))
+    print "%-40s %10d bytes/gob" % ("memory (bound fields)", gob_size(gob))
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,223 @@
+# dump.py - Streaming dump and restore of a whole datastore
+# Copyright (C) 2012 Accellion, Inc.
+#
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; version 2.1.
+#
+# This library is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA
+"""Dump the objects of a schema to a stream, and restore them from
+it, for backup or for migration between back ends.
+
+A dump is the string ``MAGIC`` followed by a series of records, each a
+four-byte big-endian length followed by that many bytes of pickled
+tuple.  A ``('collection', key)`` record names the collection key of
+one class of the schema, and a ``('gob', class_key, dictionary)``
+record holds one object, as produced by
+:func:`gobpersist.session.GobTranslator.gob_to_mygob`.  Unique keys
+and collection memberships are not recorded, as they follow from the
+objects and are rebuilt from them on restore.
+
+Since records are pickled, only restore dumps from a trusted source.
+
+.. codeauthor:: Evan Buswell <evan.buswell@accellion.com>
+"""
+
+import struct
+import cPickle as pickle
+
+import gobpersist.exception
+import gobpersist.field
+import gobpersist.schema
+
+MAGIC = 'GOBDUMP\x01'
+"""The string with which every dump starts."""
+
+_length = struct.Struct('>I')
+
+def schema_classes(schema):
+    """The gob classes of the collections of ``schema``, by class
+    key."""
+    ret = {}
+    for name in dir(schema):
+        collection = getattr(schema, name, None)
+        if isinstance(collection, gobpersist.schema.SchemaCollection):
+            ret[collection.cls.class_key] = collection.cls
+    return ret
+
+def _shape(key):
+    """``key`` with ``None`` in place of each field."""
+    return tuple([None if isinstance(keyelem, gobpersist.field.Field) \
+                      else keyelem \
+                      for keyelem in key])
+
+def _matches(key, shape):
+    if len(key) != len(shape):
+        return False
+    for keyelem, shapeelem in zip(key, shape):
+        if shapeelem is None:
+            continue
+        if isinstance(keyelem, gobpersist.field.Field) \
+                or keyelem != shapeelem:
+            return False
+    return True
+
+def _walked_shapes(classes):
+    """The shapes of the keys walked by :func:`iter_gobs` for the
+    objects of each of ``classes``, by class key.
+
+    Each is a tuple of the shape of the collection key of the class,
+    or ``None`` if it has none, and a list of the shapes of the keyed
+    foreign collections which hold its objects.
+    """
+    ret = {}
+    for cls in classes.itervalues():
+        if cls.coll_key is not None:
+            ret[cls.class_key] = (_shape(cls.coll_key),
+                                  ret.get(cls.class_key, (None, []))[1])
+        for f in cls._foreign_fields:
+            if isinstance(f, gobpersist.field.ForeignCollection) \
+                    and f.key is not None:
+                ret.setdefault(f.foreign_class.class_key, (None, []))[1] \
+                    .append(_shape(f.key))
+    return ret
+
+def _home(gob, shapes):
+    """The key under which :func:`iter_gobs` produces ``gob``, or
+    ``None`` if none of its keys is walked."""
+    coll_shape, foreign_shapes = shapes
+    keys = gob.keyset()
+    if coll_shape is not None:
+        for key in keys:
+            if _matches(key, coll_shape):
+                return key
+    for key in keys:
+        for shape in foreign_shapes:
+            if _matches(key, shape):
+                return key
+    return None
+
+def iter_gobs(schema, chunk_size=100):
+    """Iterate over every object reachable in the back end of
+    ``schema``.
+
+    The collection key of each class is walked, and from each object
+    found, the keyed foreign collections of that object.  An object
+    found in several collections is produced only from its home: the
+    collection key of its class, if it is stored there, or else the
+    first of its own keys of the form of a keyed foreign collection.
+    An object none of whose keys are walked is produced wherever it
+    is found.  No record of the objects already produced needs to be
+    kept, so memory use depends on the depth to which collections are
+    nested, not on their size.
+    """
+    backend = schema.session.backend
+    classes = schema_classes(schema)
+    shapes = _walked_shapes(classes)
+
+    def walk(cls, key):
+        try:
+            return backend.iterquery(cls, key=key, chunk_size=chunk_size)
+        except gobpersist.exception.NotFound:
+            return iter([])
+
+    for cls in classes.itervalues():
+        if cls.coll_key is None:
+            continue
+        stack = [(backend.key_to_mykey(cls.coll_key),
+                  walk(cls, cls.coll_key))]
+        while stack:
+            mykey, gobs = stack[-1]
+            try:
+                gob = next(gobs)
+            except (StopIteration, gobpersist.exception.NotFound):
+                stack.pop()
+                continue
+            home = _home(gob, shapes.get(gob.class_key, (None, [])))
+            if home is not None and backend.key_to_mykey(home) != mykey:
+                # Not found at home; it will be found there
+                continue
+            yield gob
+            for f in gob._foreign_fields:
+                if isinstance(f, gobpersist.field.ForeignCollection) \
+                        and f.key is not None:
+                    key = gob._get_field(f).key
+                    stack.append((backend.key_to_mykey(key),
+                                  walk(f.foreign_class, key)))
+
+def write_record(fp, record):
+    """Write ``record`` to the dump in ``fp``."""
+    data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+    fp.write(_length.pack(len(data)))
+    fp.write(data)
+
+def read_records(fp):
+    """Iterate over the records of the dump in ``fp``."""
+    if fp.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a gobpersist dump")
+    while True:
+        header = fp.read(_length.size)
+        if not header:
+            return
+        if len(header) < _length.size:
+            raise ValueError("Truncated gobpersist dump")
+        length, = _length.unpack(header)
+        data = fp.read(length)
+        if len(data) < length:
+            raise ValueError("Truncated gobpersist dump")
+        yield pickle.loads(data)
+
+def dump(schema, fp, chunk_size=100):
+    """Write every object reachable in the back end of ``schema`` to
+    the file ``fp``, reading them ``chunk_size`` at a time.
+
+    See :func:`iter_gobs`.  Returns the number of objects written.
+    """
+    session = schema.session
+    fp.write(MAGIC)
+    for cls in schema_classes(schema).itervalues():
+        if cls.coll_key is not None:
+            write_record(fp, ('collection',
+                              session.key_to_mykey(cls.coll_key)))
+    count = 0
+    for gob in iter_gobs(schema, chunk_size):
+        write_record(fp, ('gob', gob.class_key, session.gob_to_mygob(gob)))
+        count += 1
+    return count
+
+def restore(schema, fp, batch_size=1000):
+    """Add the objects in the dump in the file ``fp`` to the back end
+    of ``schema``, ``batch_size`` at a time.
+
+    The collection key of each class is initialized first, and the
+    objects are then written with
+    :func:`gobpersist.session.Session.bulk_add`, which rebuilds their
+    unique keys and collection memberships.  As with
+    :func:`gobpersist.schema.Schema.initialize_db`, this should only
+    be done to an empty back end.  Returns the number of objects
+    restored.
+    """
+    classes = schema_classes(schema)
+    session = schema.session
+
+    def gobs():
+        for record in read_records(fp):
+            if record[0] == 'collection':
+                session.backend.commit(collection_additions=[record[1]])
+            elif record[0] == 'gob':
+                if record[1] not in classes:
+                    raise ValueError("Class '%s' is not in the schema" \
+                                         % record[1])
+                yield session.mygob_to_gob(classes[record[1]], record[2])
+            else:
+                raise ValueError("Unknown record type '%s'" % record[0])
+
+    return session.bulk_add(gobs(), batch_size)
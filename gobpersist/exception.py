@@ -32,6 +32,11 @@ class NotFound(Exception):
     """
     pass
 
+class CachedNotFound(NotFound):
+    """Raised by a cache when it has recorded that a query finds
+    nothing in the back end it caches."""
+    pass
+
 class ConditionFailed(Exception):
     """Raised when a commit with conditions was attempted but those
     conditions could not be reconciled."""
@@ -55,3 +60,7 @@ class Corruption(Exception):
 class Deadlock(Exception):
     """Raised to indicate that a required lock cannot be obtained."""
     pass
+
+class PoolTimeout(Exception):
+    """Raised when no connection in a pool becomes free in time."""
+    pass
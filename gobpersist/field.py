@@ -29,9 +29,32 @@ import iso8601
 # moved to the end to avoid circular dependency
 # import gobpersist.schema
 
+class _Shared(object):
+    """Holds an attribute of a field which is shared by all of its
+    bound copies, without letting it act as a descriptor."""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __get__(self, instance, owner):
+        return self.value
+
+
 class Field(object):
     """An abstract base class for defining a field type."""
 
+    _instance_attrs = ('instance', 'value', 'persisted_value', 'dirty',
+                       'has_value', 'has_persisted_value', 'immutable')
+    """The attributes which hold per-instance state.
+
+    Bound copies of a field (see :func:`bind`) keep only these in
+    ``__slots__``; everything else is shared through the class.
+    """
+
+    _bound_class = None
+    """The class of bound copies of this field, once generated."""
+
     def __init__(self, null=False, unique=False, primary_key=False,
                  name=None, default=None, default_update=None,
                  revision_tag=False, modifiable=True):
@@ -213,6 +236,46 @@ class Field(object):
         Subclasses can override this to provide custom set behavior."""
         self.value = value
 
+    def bind(self, instance):
+        """Create the copy of this field to be held by ``instance``.
+
+        The copy belongs to a subclass generated for this field,
+        holding the field's configuration as class attributes and
+        only the per-instance state in ``__slots__``.  If the
+        configuration of this field is changed, :func:`unbind` must
+        be called before creating further copies.
+        """
+        cls = self._bound_class
+        if cls is None:
+            cls = self._make_bound_class()
+        ret = cls.__new__(cls)
+        for name in cls._instance_attrs:
+            object.__setattr__(ret, name, getattr(self, name, None))
+        ret.immutable = False
+        ret.instance = instance
+        return ret
+
+    def unbind(self):
+        """Forget the generated class of bound copies of this field."""
+        self._bound_class = None
+
+    def _make_bound_class(self):
+        """Generate the class for bound copies of this field."""
+        attrs = {'__slots__': self._instance_attrs,
+                 '__module__': self.__class__.__module__,
+                 '__doc__': self.__class__.__doc__}
+        for name, value in self.__dict__.iteritems():
+            if name in self._instance_attrs or name == '_bound_class':
+                continue
+            if hasattr(type(value), '__get__'):
+                # functions and fields would otherwise bind to the copy
+                value = _Shared(value)
+            attrs[name] = value
+        cls = type(self.__class__.__name__, (self.__class__,), attrs)
+        cls._bound_class = cls
+        self._bound_class = cls
+        return cls
+
     def clone(self, clean_break=False):
         """Create a clone of this field.
 
@@ -231,17 +294,21 @@ class Field(object):
 
     def __set__(self, instance, value):
         if instance is not None:
-            instance.__dict__[self.instance_key].set(value)
+            instance._get_field(self).set(value)
 
     def __get__(self, instance, owner):
         if instance is not None:
-            return instance.__dict__[self.instance_key]
+            try:
+                return instance.__dict__[self.instance_key]
+            except KeyError:
+                # lazily hydrated
+                return instance._materialize(self)
         else:
             return self
 
     def __delete__(self, instance):
         if instance is not None:
-            instance.__dict__[self.instance_key].set(None)
+            instance._get_field(self).set(None)
 
     # Functions for delegation
 
@@ -330,6 +397,9 @@ class TimestampField(DateTimeField):
 class StringField(Field):
     """A field to represent string data."""
 
+    _instance_attrs = Field._instance_attrs + ('value_encoded',
+                                               'value_decoded')
+
     def __init__(self, encoding='binary', max_length=None, allow_empty=True,
                  validate = lambda x: True, *args, **kwargs):
         """
@@ -751,8 +821,7 @@ class MultiField(Field):
 
     def _element_to_field(self, element):
         """Transform an element to the underlying field type."""
-        f = self.field.clone()
-        f.instance = self.instance
+        f = self.field.bind(self.instance)
         f.set(element.value if isinstance(element, Field) else element)
         return f
 
@@ -1070,6 +1139,14 @@ class Foreign(Field):
     def reload_field(self):
         pass
 
+    def bind(self, instance):
+        # The per-instance state of foreign fields includes their
+        # keys and cached values; there is little to gain by compacting
+        # them.
+        ret = self.clone()
+        ret.instance = instance
+        return ret
+
     def mark_persisted(self):
         pass
 
@@ -19,11 +19,32 @@
 .. codeauthor:: Evan Buswell <evan.buswell@accellion.com>
 """
 
+import itertools
+
 import gobpersist.field
 
 def field_key(key):
     return '_Field__' + key
 
+def _template_elem(elem):
+    """Turn an element of a key or consistency rule into an
+    ``(instance_key, literal)`` pair.
+
+    Elements which are unbound fields are represented by their
+    instance key, so that the local field can be substituted for them
+    when an instance is created; everything else is kept as a
+    literal.
+    """
+    if isinstance(elem, gobpersist.field.Field) and elem.instance is None:
+        return (elem.instance_key, None)
+    return (None, elem)
+
+def _template_path(path):
+    """Turn a key path into a template suitable for binding."""
+    if path is None:
+        return None
+    return tuple([_template_elem(elem) for elem in path])
+
 class GobMetaclass(type):
     """Metaclass for the Gob class."""
     def __init__(cls, *args, **kwargs):
@@ -146,6 +167,61 @@ class Gob(object):
       object(s)), or ``None`` (take no action).
     """
 
+    _plain_fields = ()
+    """All non-foreign fields of this class, in ``dir()`` order.
+
+    Set automatically by :func:`reload_class`.
+    """
+
+    _foreign_fields = ()
+    """All foreign fields of this class, in ``dir()`` order.
+
+    Set automatically by :func:`reload_class`.
+    """
+
+    _all_fields = ()
+    """All fields of this class, foreign or not, in ``dir()`` order.
+
+    Set automatically by :func:`reload_class`.
+    """
+
+    _revision_tag_fields = ()
+    """All fields of this class which are revision tags.
+
+    Set automatically by :func:`reload_class`.
+    """
+
+    _primary_key_instance_key = None
+    """The instance key of the primary key field, if any.
+
+    Set automatically by :func:`reload_class`.
+    """
+
+    _key_templates = None
+    """Templates for binding ``keys``, ``unique_keys``, ``obj_key``,
+    ``consistency``, ``set_consistency`` and the keys of foreign
+    fields to the fields of an instance.
+
+    Set automatically by :func:`reload_class`.
+    """
+
+    _eager_fields = ()
+    """The fields which must be created immediately when an instance
+    is lazily hydrated: the primary key and every field referred to
+    by ``keys``, ``unique_keys``, ``obj_key``, ``consistency`` or
+    ``set_consistency``.
+
+    Set automatically by :func:`reload_class`.
+    """
+
+    _lazy_data = None
+    """The raw data from the back end for a lazily hydrated instance,
+    or ``None``.
+
+    Fields not yet present on the instance are created from this
+    data on first access.
+    """
+
 
     def keyset(self, use_persisted_version=False):
         """This function is called to determine the keys under which
@@ -199,8 +275,96 @@ class Gob(object):
         if 'coll_key' not in cls.__dict__:
             cls.coll_key = (cls.class_key,)
 
+        cls._build_field_tables()
 
-    def __init__(self, session=None, _incoming_data=False, **kwdict):
+    @classmethod
+    def _build_field_tables(cls):
+        """Build the per-class tables of fields and key templates used
+        when creating, serializing and updating instances.
+
+        Everything which would otherwise require a scan over
+        ``dir()`` of the class or an instance is precomputed here.
+        """
+        plain_fields = []
+        foreign_fields = []
+        all_fields = []
+        revision_tag_fields = []
+        primary_key_instance_key = None
+        seen = set()
+        for key in dir(cls):
+            if key == 'primary_key':
+                # alias of another field
+                continue
+            value = getattr(cls, key, None)
+            if not isinstance(value, gobpersist.field.Field) \
+                    or id(value) in seen:
+                continue
+            seen.add(id(value))
+            # the configuration may have changed
+            value.unbind()
+            all_fields.append(value)
+            if isinstance(value, gobpersist.field.Foreign):
+                foreign_fields.append(value)
+            else:
+                plain_fields.append(value)
+            if value.revision_tag:
+                revision_tag_fields.append(value)
+            if value.primary_key:
+                primary_key_instance_key = value.instance_key
+
+        cls._plain_fields = tuple(plain_fields)
+        cls._foreign_fields = tuple(foreign_fields)
+        cls._all_fields = tuple(all_fields)
+        cls._revision_tag_fields = tuple(revision_tag_fields)
+        cls._primary_key_instance_key = primary_key_instance_key
+
+        def consistency_template(consistence, extra=()):
+            ret = {
+                'field': _template_elem(consistence.get('field')),
+                'foreign_class': consistence['foreign_class'],
+                'foreign_obj': _template_path(consistence['foreign_obj']),
+                'foreign_field': consistence.get('foreign_field'),
+                'update': consistence.get('update'),
+                'remove': consistence.get('remove'),
+                'invalidate': consistence.get('invalidate')}
+            for key in extra:
+                ret[key] = _template_elem(consistence.get(key))
+            return ret
+
+        cls._key_templates = {
+            'keys': [_template_path(path) for path in cls.keys],
+            'unique_keys': [_template_path(path) for path in cls.unique_keys],
+            'obj_key': _template_path(cls.obj_key),
+            'consistency': [consistency_template(consistence)
+                            for consistence in cls.consistency],
+            'set_consistency': [consistency_template(consistence,
+                                                     ('foreign_value',))
+                                for consistence in cls.set_consistency],
+            'foreign': dict([(value.instance_key, _template_path(value.key))
+                             for value in foreign_fields
+                             if value.key is not None])
+            }
+
+        eager_keys = set([primary_key_instance_key])
+        templates = cls._key_templates
+        paths = templates['keys'] + templates['unique_keys']
+        if templates['obj_key'] is not None:
+            paths.append(templates['obj_key'])
+        for consistence in itertools.chain(templates['consistency'],
+                                           templates['set_consistency']):
+            paths.append(consistence['foreign_obj'])
+            paths.append((consistence['field'],
+                          consistence.get('foreign_value', (None, None))))
+        for path in paths:
+            for ikey, lit in path:
+                if ikey is not None:
+                    eager_keys.add(ikey)
+        cls._eager_fields = tuple([value for value in all_fields
+                                   if value.instance_key in eager_keys])
+
+
+    def __init__(self, session=None, _incoming_data=False, _lazy_data=None,
+                 **kwdict):
         """
         Args:
            ``session``: The session for this object.
@@ -208,6 +372,16 @@ class Gob(object):
            ``_incoming_data``: used by the session to skip checking of
            values currently in the database.
 
+           ``_lazy_data``: used by the session to hydrate this object
+           lazily from a dictionary of values currently in the
+           database.
+
+              Only the fields needed for keys and consistency are
+              created immediately; every other field is created from
+              this dictionary on first access.  The object takes
+              ownership of the dictionary.  Implies
+              ``_incoming_data``.
+
            The remainder of the arguments are interpreted as initial
            values for the fields in this gob.
         """
@@ -226,130 +400,144 @@ class Gob(object):
         """The path to this object."""
 
         # make local copies of fields
-        for key in dir(self.__class__):
-            value = getattr(self.__class__, key)
-            if isinstance(value, gobpersist.field.Field):
-                value = value.clone()
-                value.instance = self
-                self.__dict__[value.instance_key] = value
-                if value.primary_key:
-                    self.__dict__['primary_key'] = value
+        cls = self.__class__
+        d = self.__dict__
+        if _lazy_data is not None:
+            _incoming_data = True
+            self._lazy_data = _lazy_data
+            fields = cls._eager_fields
+        else:
+            fields = cls._all_fields
+        for value in fields:
+            value = value.bind(self)
+            d[value.instance_key] = value
+        if cls._primary_key_instance_key is not None:
+            d['primary_key'] = d[cls._primary_key_instance_key]
+
+        templates = cls._key_templates
 
         # make foreign fields refer to local fields
-        for key in dir(self):
-            value = getattr(self, key)
-            if isinstance(value, gobpersist.field.Foreign) and value.key is not None:
-                value.key = tuple([
-                        self.__dict__[keyelem.instance_key] \
-                                    if isinstance(keyelem, gobpersist.field.Field) \
-                                else keyelem \
-                            for keyelem in value.key])
+        for instance_key, path in templates['foreign'].iteritems():
+            if instance_key in d:
+                self._bind_foreign(d[instance_key], path)
 
         # make indices refer to local fields
         self.keys \
-            = [tuple([self.__dict__[keyelem.instance_key] \
-                                  if isinstance(keyelem, gobpersist.field.Field) \
-                                  and keyelem.instance is None \
-                              else keyelem \
-                          for keyelem in path]) \
-                   for path in self.keys]
+            = [tuple([d[ikey] if ikey is not None else lit \
+                          for ikey, lit in path]) \
+                   for path in templates['keys']]
         self.unique_keys \
-            = [tuple([self.__dict__[keyelem.instance_key] \
-                                  if isinstance(keyelem, gobpersist.field.Field) \
-                                  and keyelem.instance is None \
-                              else keyelem \
-                          for keyelem in path]) \
-                   for path in self.unique_keys]
-        self.obj_key \
-            = tuple([self.__dict__[keyelem.instance_key] \
-                                 if isinstance(keyelem, gobpersist.field.Field) \
-                                 and keyelem.instance is None \
-                             else keyelem \
-                         for keyelem in self.obj_key])
+            = [tuple([d[ikey] if ikey is not None else lit \
+                          for ikey, lit in path]) \
+                   for path in templates['unique_keys']]
+        if templates['obj_key'] is not None:
+            self.obj_key \
+                = tuple([d[ikey] if ikey is not None else lit \
+                             for ikey, lit in templates['obj_key']])
 
         # make consistency rules refer to local fields
-        self.consistency \
-            = [{'field': self.__dict__[consistence['field'].instance_key] \
-                        if 'field' in consistence \
-                        and isinstance(consistence['field'], gobpersist.field.Field) \
-                        and consistence['field'].instance is None \
-                    else consistence['field'] \
-                        if 'field' in consistence \
-                    else None,
-                'foreign_class': consistence['foreign_class'],
-                'foreign_obj': \
-                    tuple([self.__dict__[keyelem.instance_key] \
-                                       if isinstance(keyelem, gobpersist.field.Field) \
-                                       and keyelem.instance is None \
-                                   else keyelem \
-                               for keyelem in consistence['foreign_obj']]),
-                'foreign_field': consistence['foreign_field'] \
-                        if 'foreign_field' in consistence \
-                    else None,
-                'update': consistence['update'] \
-                        if 'update' in consistence \
-                    else None,
-                'remove': consistence['remove'] \
-                        if 'remove' in consistence \
-                    else None,
-                'invalidate': consistence['invalidate'] \
-                        if 'invalidate' in consistence \
-                    else None}
-               for consistence in self.consistency]
-
-        self.set_consistency \
-            = [{'field': self.__dict__[consistence['field'].instance_key] \
-                        if 'field' in consistence \
-                        and isinstance(consistence['field'], gobpersist.field.Field) \
-                        and consistence['field'].instance is None \
-                    else consistence['field'] \
-                        if 'field' in consistence \
-                    else None,
-                'foreign_class': consistence['foreign_class'],
-                'foreign_obj': \
-                    tuple([self.__dict__[keyelem.instance_key] \
-                                       if isinstance(keyelem, gobpersist.field.Field) \
-                                       and keyelem.instance is None \
-                                   else keyelem \
-                               for keyelem in consistence['foreign_obj']]),
-                'foreign_field': consistence['foreign_field'] \
-                        if 'foreign_field' in consistence \
-                    else None,
-                'foreign_value': self.__dict__[consistence['foreign_value'].instance_key] \
-                        if 'foreign_value' in consistence \
-                        and isinstance(consistence['foreign_value'], gobpersist.field.Field) \
-                        and consistence['foreign_value'].instance is None \
-                    else consistence['foreign_value'] \
-                        if 'foreign_value' in consistence \
-                    else None,
-                'update': consistence['update'] \
-                        if 'update' in consistence \
-                    else None,
-                'remove': consistence['remove'] \
-                        if 'remove' in consistence \
-                    else None,
-                'invalidate': consistence['invalidate'] \
-                        if 'invalidate' in consistence \
-                    else None}
-               for consistence in self.set_consistency]
+        self.consistency = []
+        for consistence in templates['consistency']:
+            ikey, lit = consistence['field']
+            self.consistency.append({
+                    'field': d[ikey] if ikey is not None else lit,
+                    'foreign_class': consistence['foreign_class'],
+                    'foreign_obj': \
+                        tuple([d[ikey] if ikey is not None else lit \
+                                   for ikey, lit in consistence['foreign_obj']]),
+                    'foreign_field': consistence['foreign_field'],
+                    'update': consistence['update'],
+                    'remove': consistence['remove'],
+                    'invalidate': consistence['invalidate']})
+
+        self.set_consistency = []
+        for consistence in templates['set_consistency']:
+            ikey, lit = consistence['field']
+            vkey, vlit = consistence['foreign_value']
+            self.set_consistency.append({
+                    'field': d[ikey] if ikey is not None else lit,
+                    'foreign_class': consistence['foreign_class'],
+                    'foreign_obj': \
+                        tuple([d[ikey] if ikey is not None else lit \
+                                   for ikey, lit in consistence['foreign_obj']]),
+                    'foreign_field': consistence['foreign_field'],
+                    'foreign_value': d[vkey] if vkey is not None else vlit,
+                    'update': consistence['update'],
+                    'remove': consistence['remove'],
+                    'invalidate': consistence['invalidate']})
+
+        if _lazy_data is not None:
+            for value in fields:
+                if value._name in _lazy_data:
+                    value = d[value.instance_key]
+                    value.trip_set()
+                    value._set(_lazy_data[value._name])
 
         # autoset fields according to constructor arguments
         for key, value in kwdict.iteritems():
             f_key = field_key(key)
-            if f_key not in self.__dict__:
+            if f_key not in d:
                 raise TypeError("__init__() got an unexpected keyword" \
                                     " argument '%s'" % key)
             if _incoming_data:
                 # skip validation...
-                self.__dict__[f_key].trip_set()
-                self.__dict__[f_key]._set(value)
+                d[f_key].trip_set()
+                d[f_key]._set(value)
             else:
-                self.__dict__[f_key].set(value)
+                d[f_key].set(value)
 
         if _incoming_data:
             self.mark_persisted()
 
 
+    def _bind_foreign(self, value, path):
+        """Make the key of the local foreign field ``value`` refer to
+        local fields, according to the template ``path``."""
+        value.key = tuple([self._get_field_by_key(ikey) if ikey is not None \
+                               else lit \
+                               for ikey, lit in path])
+
+    def _get_field_by_key(self, instance_key):
+        """Return the local field stored under ``instance_key``."""
+        try:
+            return self.__dict__[instance_key]
+        except KeyError:
+            for value in self._all_fields:
+                if value.instance_key == instance_key:
+                    return self._materialize(value)
+            raise
+
+    def _get_field(self, field):
+        """Return the local copy of the class field ``field``, creating
+        it if this object was lazily hydrated."""
+        try:
+            return self.__dict__[field.instance_key]
+        except KeyError:
+            return self._materialize(field)
+
+    def _materialize(self, field):
+        """Create the local copy of the class field ``field`` from the
+        data this object was hydrated with.
+
+        This does not alter the dirty state of the object.
+        """
+        dirty = self.dirty
+        value = field.bind(self)
+        self.__dict__[value.instance_key] = value
+        if isinstance(value, gobpersist.field.Foreign):
+            path = self._key_templates['foreign'].get(value.instance_key)
+            if path is not None:
+                self._bind_foreign(value, path)
+        else:
+            lazy_data = self._lazy_data
+            if lazy_data is not None and value._name in lazy_data:
+                value.trip_set()
+                value._set(lazy_data[value._name])
+            value.mark_persisted()
+        self.dirty = dirty
+        return value
+
+
     def save(self):
         """Save this object.
 
@@ -379,9 +567,8 @@ class Gob(object):
         Don't call this method directly unless you know what you're
         doing.
         """
-        for value in self.__dict__.itervalues():
-            if isinstance(value, gobpersist.field.Field):
-                value.prepare_add()
+        for value in self._all_fields:
+            self._get_field(value).prepare_add()
 
 
     def prepare_update(self):
@@ -390,9 +577,12 @@ class Gob(object):
         Don't call this method directly unless you know what you're
         doing.
         """
-        for value in self.__dict__.itervalues():
-            if isinstance(value, gobpersist.field.Field):
-                value.prepare_update()
+        d = self.__dict__
+        for value in self._all_fields:
+            if value.instance_key in d:
+                d[value.instance_key].prepare_update()
+            elif value.default_update is not None:
+                self._materialize(value).prepare_update()
 
 
     def prepare_delete(self):
@@ -410,9 +600,10 @@ class Gob(object):
         This does not clear any pending operations on this object; for
         that you must use
         :func:`gobpersist.session.Session.rollback`."""
-        for value in self.__dict__.itervalues():
-            if isinstance(value, gobpersist.field.Field):
-                value.revert()
+        d = self.__dict__
+        for value in self._all_fields:
+            if value.instance_key in d:
+                d[value.instance_key].revert()
 
 
     def mark_persisted(self):
@@ -424,9 +615,10 @@ class Gob(object):
         self.persisted = True
         self.dirty = False
 
-        for value in self.__dict__.itervalues():
-            if isinstance(value, gobpersist.field.Field):
-                value.mark_persisted()
+        d = self.__dict__
+        for value in self._all_fields:
+            if value.instance_key in d:
+                d[value.instance_key].mark_persisted()
 
 
     @classmethod
@@ -450,6 +642,8 @@ class Gob(object):
                 session.add_collection(key)
 
     def __repr__(self):
+        for value in self._all_fields:
+            self._get_field(value)
         # Because Python should be lisp?  I dunno...
         return "%s(%s)" % (
             self.__class__.__name__,
@@ -77,6 +77,15 @@ class SchemaCollection(object):
         """A dictionary of key-value pairs that will be set on each
         added item."""
 
+        self.prefetched = None
+        """The items of the collection, if already fetched by
+        :func:`gobpersist.session.Session.prefetch`.
+
+        Listing the collection without a query returns these rather
+        than querying again, until an item is added, updated or
+        removed through the collection, or the session commits.
+        """
+
 
     def _translate_qelem(self, k, v):
         """Translate an element of a query into normal query
@@ -115,13 +124,29 @@ class SchemaCollection(object):
         See the documentation for this class for an explanation of the
         query language.
         """
+        if _query is None and not kwargs and self.prefetched is not None:
+            return list(self.prefetched)
         if _query is None:
             _query = self._translate_query(kwargs)
         return self.session.query(cls=self.cls, key=self.key, query=_query)
 
 
-    def get(self, primary_key):
-        """Get an item with a specific primary key."""
+    def iterlist(self, _query=None, _chunk_size=100, **kwargs):
+        """Iterate over items in the collection, retrieving them
+        ``_chunk_size`` at a time.
+
+        See :func:`list`.
+        """
+        if _query is None and not kwargs and self.prefetched is not None:
+            return iter(self.prefetched)
+        if _query is None:
+            _query = self._translate_query(kwargs)
+        return self.session.iterquery(cls=self.cls, key=self.key,
+                                      query=_query, chunk_size=_chunk_size)
+
+
+    def _obj_key(self, primary_key):
+        """The key of the item with a specific primary key."""
         key = []
         for keyelem in self.cls.obj_key:
             if isinstance(keyelem, gobpersist.field.Field) \
@@ -131,15 +156,35 @@ class SchemaCollection(object):
                 key.append(f)
             else:
                 key.append(keyelem)
-        res = self.session.query(cls=self.cls, key=tuple(key))
+        return tuple(key)
+
+
+    def get(self, primary_key):
+        """Get an item with a specific primary key."""
+        res = self.session.query(cls=self.cls,
+                                 key=self._obj_key(primary_key))
         if res:
             return res[0]
         else:
             return None
 
 
+    def get_many(self, primary_keys):
+        """Get the items with each of several primary keys at once.
+
+        Returns a list holding, for each primary key, the item with
+        that key, or ``None`` if there is none.
+        """
+        return [res[0] if res else None \
+                    for res in self.session.query_many(
+                        self.cls,
+                        [self._obj_key(primary_key) \
+                             for primary_key in primary_keys])]
+
+
     def add(self, gob):
         """Add an item to the collection."""
+        self.prefetched = None
         gob.session = self.session
         if self.autoset is not None:
             for key, value in self.autoset.iteritems():
@@ -155,6 +200,7 @@ class SchemaCollection(object):
 
         This is equivalent to calling ``gob.save()``
         """
+        self.prefetched = None
         gob.session = self.session
         gob.save()
 
@@ -164,6 +210,7 @@ class SchemaCollection(object):
 
         This is equivalent to calling ``gob.remove()``
         """
+        self.prefetched = None
         gob.session = self.session
         gob.remove()
 
@@ -19,20 +19,33 @@
 .. codeauthor:: Evan Buswell <evan.buswell@accellion.com>
 """
 
+import itertools
+import hashlib
+import weakref
+
 import gobpersist.field
+import gobpersist.exception
 
 class GobTranslator(object):
     """Abstract class to translate gobs for the back end."""
 
+    lazy_hydration = False
+    """Whether gobs created by :func:`mygob_to_gob` should be hydrated
+    lazily, creating each field only when it is first accessed."""
+
     def gob_to_mygob(self, gob, only_dirty=False):
         """Turn a gob into a object appropriate for the back end."""
         mygob = {}
-        for key in dir(gob):
-            f = getattr(gob, key)
-            if isinstance(f, gobpersist.field.Field) \
-                    and not isinstance(f, gobpersist.field.Foreign) \
-                    and (not only_dirty or f.dirty):
-                mygob[f.name] = self.field_to_myfield(f)
+        d = gob.__dict__
+        for f in gob._plain_fields:
+            value = d.get(f.instance_key)
+            if value is None:
+                if only_dirty:
+                    # never accessed, hence never altered
+                    continue
+                value = gob._materialize(f)
+            if not only_dirty or value.dirty:
+                mygob[value.name] = self.field_to_myfield(value)
         return mygob
 
     def query_to_myquery(self, cls, query):
@@ -53,14 +66,13 @@ class GobTranslator(object):
                     elif isinstance(item, dict):
                         # quantifier
                         if len(item) > 1:
-                            raise exception.QueryError("Too many keys" \
-                                                           " in quantifier")
+                            raise gobpersist.exception.QueryError(
+                                "Too many keys in quantifier")
                         newquant = {}
                         k, v = item.items()[0]
                         if k not in ('all', 'any', 'none'):
-                            raise exception.QueryError("Invalid key '%s'" \
-                                                           " in quantifier" \
-                                                           % k)
+                            raise gobpersist.exception.QueryError(
+                                "Invalid key '%s' in quantifier" % k)
                         identifier = self.idnt_to_myidnt(cls, item)
                         f = self.field_for_idnt(cls, item)
                         newquant[k] = identifier
@@ -91,9 +103,126 @@ class GobTranslator(object):
                     newvalue.append(self.query_to_myquery(cls, item))
                 ret[key] = newvalue
             else:
-                raise exception.QueryError("Invalid query operator '%s'" % key)
+                raise gobpersist.exception.QueryError(
+                    "Invalid query operator '%s'" % key)
         return ret
 
+    def canonical_query(self, cls, query):
+        """Return a canonical, hashable form of a query on objects of
+        class ``cls``.
+
+        Queries which differ only in the order of their commands, in
+        the order of the operands of ``eq``, ``and``, ``or``, ``nor``
+        and a two-operand ``ne``, in using ``gt`` or ``ge`` for a
+        reversed ``lt`` or ``le``, or in the type of equal literals,
+        have the same canonical form.  A longer ``ne`` compares only
+        neighbouring operands, so their order is kept.
+
+        Literals are normalized by setting them on a copy of the field
+        to which they are compared, but only where the normalized
+        value is equal to the literal, as queries compare the literal
+        itself.
+        """
+        ret = []
+        for cmd, args in query.iteritems():
+            if cmd in ('and', 'or', 'nor'):
+                ret.append((cmd,) + tuple(sorted(
+                            [self.canonical_query(cls, arg) for arg in args])))
+            elif cmd == 'not':
+                ret.append((cmd,) + tuple(
+                        [self.canonical_query(cls, arg) for arg in args]))
+            elif cmd in ('eq', 'ne', 'gt', 'lt', 'ge', 'le'):
+                f = None
+                for arg in args:
+                    if isinstance(arg, dict) and len(arg) == 1:
+                        arg = arg.values()[0]
+                    if isinstance(arg, tuple):
+                        try:
+                            f = self.field_for_idnt(cls, arg)
+                        except (ValueError, AttributeError):
+                            pass
+                        break
+                if isinstance(f, gobpersist.field.Foreign):
+                    f = None
+                terms = [self._canonical_term(arg, f) for arg in args]
+                if cmd == 'eq' or (cmd == 'ne' and len(terms) == 2):
+                    terms.sort()
+                elif cmd in ('gt', 'ge'):
+                    terms.reverse()
+                    cmd = 'lt' if cmd == 'gt' else 'le'
+                ret.append((cmd,) + tuple(terms))
+            else:
+                raise gobpersist.exception.QueryError(
+                    "Invalid query operator '%s'" % cmd)
+        ret.sort()
+        return tuple(ret)
+
+    def _canonical_term(self, term, f):
+        """The canonical form of a term compared to the field ``f``,
+        which may be ``None``."""
+        if isinstance(term, dict):
+            # quantifier
+            if len(term) != 1:
+                raise gobpersist.exception.QueryError(
+                    "Too many keys in quantifier")
+            k, v = term.items()[0]
+            return ('{', k, self._canonical_term(v, f))
+        elif isinstance(term, tuple):
+            # identifier
+            return ('(',) + tuple([pathelem._name \
+                                       if isinstance(pathelem,
+                                                     gobpersist.field.Field) \
+                                       else pathelem \
+                                       for pathelem in term])
+        # literal
+        if f is not None and not isinstance(term, gobpersist.field.Field):
+            try:
+                newf = f.clone(clean_break=True)
+                newf.set(term)
+                # A literal the field changes compares differently
+                same = newf.value == term
+            except (ValueError, TypeError):
+                pass
+            else:
+                if same:
+                    return ('=', self._canonical_value(
+                            self.field_to_myfield(newf)))
+        term = self.value_to_myvalue(term)
+        return ('=', type(term).__name__, self._canonical_value(term))
+
+    def _canonical_value(self, value):
+        """A hashable form of a literal value."""
+        if isinstance(value, (list, tuple)):
+            return ('[',) + tuple([self._canonical_value(v) for v in value])
+        elif isinstance(value, (set, frozenset)):
+            return ('{',) + tuple(sorted([self._canonical_value(v) \
+                                              for v in value]))
+        elif isinstance(value, dict):
+            return ('{:',) + tuple(sorted(
+                    [(self._canonical_value(k), self._canonical_value(v)) \
+                         for k, v in value.iteritems()]))
+        return value
+
+    def canonical_order(self, cls, order):
+        """Return a hashable form of ``order``, naming each field
+        ordered on by its path of field names."""
+        ret = []
+        for ordering in order:
+            for direction, idnt in ordering.iteritems():
+                if not isinstance(idnt, tuple):
+                    idnt = (idnt,)
+                ret.append((direction,) + tuple(
+                        [pathelem._name \
+                             if isinstance(pathelem, gobpersist.field.Field) \
+                             else pathelem \
+                             for pathelem in idnt]))
+        return tuple(ret)
+
+    def query_digest(self, cls, query):
+        """A short, fixed-length string identifying the canonical form
+        of a query, suitable for use in a key."""
+        return hashlib.sha1(repr(self.canonical_query(cls, query))).hexdigest()
+
     def key_to_mykey(self, key, use_persisted_version=False):
         """Transforms a key into something more palatable to the back
         end."""
@@ -193,10 +322,15 @@ class GobTranslator(object):
     def mygob_to_gob(self, cls, dictionary):
         """Create a gob from a dictionary.
 
+        If :attr:`lazy_hydration` is set, the gob keeps
+        ``dictionary`` and creates its fields on first access.
+
         TODO: This should retransform the keys it gets into their
         appropriate values based on the ``field.name`` attributes in
         the class.
         """
+        if self.lazy_hydration:
+            return cls(self, _lazy_data=dictionary)
         return cls(self, _incoming_data=True, **dictionary)
 
 
@@ -237,6 +371,10 @@ class Session(GobTranslator):
         self.storage_engine = storage_engine
         """The storage engine for this session."""
 
+        self.prefetched = weakref.WeakSet()
+        """The foreign collections filled by :func:`prefetch`, which
+        are emptied again by the next commit."""
+
 
     def register_gob(self, gob):
         """Called to add a gob to this session's registry.
@@ -263,6 +401,37 @@ class Session(GobTranslator):
         gob.prepare_delete()
         self.operations['removals'].add(gob)
 
+    def bulk_add(self, gobs, batch_size=1000):
+        """Persist many new items, ``batch_size`` at a time.
+
+        ``gobs`` may be any iterable, and is consumed one batch at a
+        time.  Each batch is written straight to the back end with
+        :func:`Backend.bulk_add`, outside of any transaction, so a
+        failure leaves earlier batches written.  The items are not
+        registered with the session.
+
+        A unique key which already refers to another object, whether
+        in the same batch, an earlier one or the store, raises
+        :class:`gobpersist.exception.Corruption` without writing the
+        batch.
+
+        Returns the number of items added.
+        """
+        count = 0
+        gobs = iter(gobs)
+        while True:
+            batch = list(itertools.islice(gobs, batch_size))
+            if not batch:
+                return count
+            for gob in batch:
+                gob.prepare_add()
+            for (gob, newgob) in self.backend.bulk_add(batch):
+                self._update_object(gob, newgob, force=True)
+            self._forget_prefetched()
+            for gob in batch:
+                gob.mark_persisted()
+            count += len(batch)
+
     def add_collection(self, path):
         """Add an empty collection at path.
 
@@ -275,46 +444,125 @@ class Session(GobTranslator):
         self.operations['collection_removals'].add(path)
 
     def query(self, cls, key=None, key_range=None, query=None, retrieve=None,
-              order=None, offset=None, limit=None):
-        """Perform a query against the back end."""
+              order=None, offset=None, limit=None, prefetch=None):
+        """Perform a query against the back end.
+
+        ``prefetch`` may name foreign fields to fill for all of the
+        results at once; see :func:`prefetch`.
+        """
+        self._prepare_query(cls, retrieve)
+        ret = [self._deduplicate(gob) \
+                   for gob in self.backend.query(cls, key, key_range, query,
+                                                 retrieve, order, offset,
+                                                 limit)]
+        if prefetch:
+            self.prefetch(ret, *prefetch)
+        return ret
+
+    def prefetch(self, gobs, *names):
+        """Fill the foreign fields called ``names`` on all of ``gobs``,
+        with one request to the back end per field name and foreign
+        class rather than one per gob.
+
+        Only foreign fields with a key are prefetched.  Fields which
+        already hold a value are left alone, as are fields whose key
+        is not found; these are fetched on access as usual.  A
+        prefetched foreign collection answers
+        :func:`gobpersist.schema.SchemaCollection.list` without a
+        query from what was fetched, until anything is added to or
+        removed from it, or the session commits.
+        """
+        for name in names:
+            # foreign class -> key -> (key, fields)
+            wanted = {}
+            for gob in gobs:
+                f = gob._get_field(getattr(gob.__class__, name))
+                if f.has_value or f.key is None:
+                    continue
+                mykey = self.key_to_mykey(f.key)
+                by_key = wanted.setdefault(f.foreign_class, {})
+                if mykey in by_key:
+                    by_key[mykey][1].append(f)
+                else:
+                    by_key[mykey] = (f.key, [f])
+            for cls, by_key in wanted.iteritems():
+                requests = by_key.values()
+                results = self.query_many(cls,
+                                          [key for key, fields in requests])
+                for (key, fields), res in itertools.izip(requests, results):
+                    if res is None:
+                        continue
+                    for f in fields:
+                        if isinstance(f, gobpersist.field.ForeignObject):
+                            value = res[0] if res else None
+                        else:
+                            value = f.fetch_value()
+                            value.prefetched = res
+                            self.prefetched.add(value)
+                        f._value = value
+                        f.has_value = True
+
+    def query_many(self, cls, keys):
+        """Look up each of ``keys`` at once.
+
+        Returns a list holding, for each key, the list of gobs found
+        there, or ``None`` if the key was not found.  Back ends which
+        are able to do so fetch all the keys in one round trip.
+        """
+        self._prepare_query(cls, None)
+        return [None if res is None \
+                    else [self._deduplicate(gob) for gob in res] \
+                    for res in self.backend.multi_query(cls, keys)]
+
+    def iterquery(self, cls, key=None, key_range=None, query=None,
+                  retrieve=None, order=None, offset=None, limit=None,
+                  chunk_size=100):
+        """Perform a query against the back end, returning an iterator
+        over the results.
+
+        Where the back end supports it, results are retrieved
+        ``chunk_size`` at a time as the iterator is consumed, so that
+        large collections can be scanned in bounded memory.
+        """
+        self._prepare_query(cls, retrieve)
+        return itertools.imap(self._deduplicate,
+                              self.backend.iterquery(cls, key, key_range,
+                                                     query, retrieve, order,
+                                                     offset, limit,
+                                                     chunk_size))
+
+    def _prepare_query(self, cls, retrieve):
+        """Set up for a query on ``cls``."""
         if retrieve is not None:
             # Should we be doing this?  Maybe the caller should get blank
             # revision tags if that's what they want.
             retrieve.append(cls.primary_key)
-            for k in dir(cls):
-                v = getattr(cls, k)
-                if isinstance(v, gobpersist.field.Field) and v.revision_tag:
-                    retrieve.append(k)
+            for f in cls._revision_tag_fields:
+                retrieve.append(f._name)
         if cls.class_key not in self.collections:
             self.collections[cls.class_key] = {}
-        ret = []
-        for gob in self.backend.query(cls, key, key_range, query, retrieve,
-                                      order, offset, limit):
-            if gob.primary_key in self.collections[gob.class_key]:
-                # deduplicate
-                self._update_object(
-                    self.collections[gob.class_key][gob.primary_key],
-                    gob)
-                ret.append(
-                    self.collections[gob.class_key][gob.primary_key])
-            else:
-                gob.session = self
-                self.collections[gob.class_key][gob.primary_key] = gob
-                ret.append(gob)
-        return ret
+
+    def _deduplicate(self, gob):
+        """Return the gob registered with this session for the same
+        object as ``gob``, updated from it, or register ``gob`` if
+        there is none."""
+        collection = self.collections[gob.class_key]
+        if gob.primary_key in collection:
+            self._update_object(collection[gob.primary_key], gob)
+            return collection[gob.primary_key]
+        gob.session = self
+        collection[gob.primary_key] = gob
+        return gob
 
     def _update_object(self, gob, updater, force=False):
         """Updates an object to have the values of another one.
 
         Dirty values are not overwritten, unless ``force`` is ``True``.
         """
-        for key in dir(gob):
-            value = getattr(gob, key)
-            if isinstance(value, gobpersist.field.Field) \
-                    and value.instance is not None \
-                    and not isinstance(value, gobpersist.field.Foreign) \
-                    and (not value.dirty or force):
-                value.value = updater.__dict__[value.instance_key].value
+        for f in gob._plain_fields:
+            value = gob._get_field(f)
+            if not value.dirty or force:
+                value.value = updater._get_field(f).value
 
     def start_transaction(self):
         """Starts a new transaction.
@@ -350,11 +598,9 @@ class Session(GobTranslator):
             op = {
                 'gob': gob
                 }
-            for key in dir(gob):
-                f = getattr(gob, key)
-                if isinstance(f, gobpersist.field.Field) \
-                        and f.revision_tag \
-                        and f.has_persisted_value:
+            for f in gob._revision_tag_fields:
+                f = gob._get_field(f)
+                if f.has_persisted_value:
                     f = f.clone(clean_break = True)
                     f._set(f.persisted_value)
                     if 'conditions' not in op:
@@ -368,11 +614,9 @@ class Session(GobTranslator):
             op = {
                 'gob': gob
                 }
-            for key in dir(gob):
-                f = getattr(gob, key)
-                if isinstance(f, gobpersist.field.Field) \
-                        and f.revision_tag \
-                        and f.has_persisted_value:
+            for f in gob._revision_tag_fields:
+                f = gob._get_field(f)
+                if f.has_persisted_value:
                     f = f.clone(clean_break=True)
                     f._set(f.persisted_value)
                     if 'conditions' not in op:
@@ -392,6 +636,7 @@ class Session(GobTranslator):
                 collection_removals=collection_removals):
             # gob.mark_persisted()
             self._update_object(gob, newgob, force=True)
+        self._forget_prefetched()
 
         for operation in ('additions', 'removals', 'updates'):
             for gob in self.operations[operation]:
@@ -405,6 +650,14 @@ class Session(GobTranslator):
             }
 
 
+    def _forget_prefetched(self):
+        """Empty the collections filled by :func:`prefetch`, which a
+        commit may have changed."""
+        for collection in self.prefetched:
+            collection.prefetched = None
+        self.prefetched.clear()
+
+
     def rollback(self, revert=False):
         """Roll back the transaction.
 
@@ -468,6 +721,45 @@ class Backend(GobTranslator):
         raise NotImplementedError("Backend type '%s' does not implement" \
                                       " query" % self.__class__.__name__)
 
+    def iterquery(self, cls, key=None, key_range=None, query=None,
+                  retrieve=None, order=None, offset=None, limit=None,
+                  chunk_size=100):
+        """Perform a query against the database, returning an iterator
+        over the resulting gob objects.
+
+        Back ends able to do so should retrieve results lazily,
+        ``chunk_size`` at a time.  By default, this simply iterates
+        over the results of :func:`query`.
+        """
+        return iter(self.query(cls, key, key_range, query, retrieve, order,
+                               offset, limit))
+
+    def multi_query(self, cls, keys):
+        """Look up each of ``keys`` at once.
+
+        Returns a list holding, for each key, the list of gob objects
+        found there, or ``None`` if the key was not found.  By
+        default, this simply calls :func:`query` for each key; back
+        ends able to fetch several keys in one round trip should
+        override it.
+        """
+        ret = []
+        for key in keys:
+            try:
+                ret.append(self.query(cls, key=key))
+            except gobpersist.exception.NotFound:
+                ret.append(None)
+        return ret
+
+    def bulk_add(self, gobs):
+        """Add many new gobs at once.
+
+        Returns the same as :func:`commit`.  By default, this simply
+        commits the gobs as additions; back ends able to write them
+        more cheaply should override it.
+        """
+        return self.commit(additions=[{'gob': gob} for gob in gobs])
+
     def commit(self, additions=[], updates=[], removals=[],
                collection_additions=[], collection_removals=[]):
         """Atomically commit some changeset to the db.
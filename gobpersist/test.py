@@ -33,6 +33,17 @@ import warnings
 
 import hashlib
 import operator
+import threading
+import time
+import os
+import errno
+import socket
+import tempfile
+import shutil
+import StringIO
+import cPickle as pickle
+
+import pylibmc
 
 import gobpersist.gob
 import gobpersist.field
@@ -41,6 +52,12 @@ import gobpersist.session
 import gobpersist.storage
 import gobpersist.exception
 import gobpersist.backends.memcached
+import gobpersist.backends.pools
+import gobpersist.backends.cache
+import gobpersist.backends.localcache
+import gobpersist.backends.invalidation
+import gobpersist.dump
+import gobpersist.backends.serializer
 
 warnings.simplefilter('default')
 
@@ -157,6 +174,41 @@ class Initialization(unittest.TestCase):
         gob_class.reload_class()
         assert(gob_class.new_field.name == 'new_field')
         assert(gob_class.new_field._name == 'new_field')
+        assert(gob_class.new_field in gob_class._plain_fields)
+
+    def test_gob_field_tables(self):
+        gob_class = get_gob_class()
+        assert(len(gob_class._all_fields) == 15)
+        assert(len(gob_class._foreign_fields) == 2
+               and gob_class.parent in gob_class._foreign_fields
+               and gob_class.children in gob_class._foreign_fields)
+        assert(len(gob_class._plain_fields) == 13
+               and gob_class.parent not in gob_class._plain_fields)
+        assert(gob_class._revision_tag_fields == ())
+        assert(gob_class._primary_key_instance_key
+               == gob_class.my_key.instance_key)
+        gob = gob_class()
+        assert(gob.primary_key is gob.my_key)
+        assert(gob.obj_key[1] is gob.my_key)
+        assert(gob.keys[0][1] is gob.parent_key)
+        assert(gob.parent.key[1] is gob.parent_key)
+        assert(gob.consistency[0]['field'] is gob.my_key)
+
+    def test_gob_field_binding(self):
+        gob_class = get_gob_class()
+        gob = gob_class()
+        gob2 = gob_class()
+        assert(isinstance(gob.string_field, gobpersist.field.StringField))
+        assert(type(gob.string_field) is type(gob2.string_field))
+        assert(gob.string_field.encoding == 'UTF-8')
+        assert(gob.list_field.field is gob_class.list_field.field)
+        assert(gob.timestamp_field.default is gob_class.timestamp_field.default)
+        gob.integer_field = 5
+        assert(gob2.integer_field.value is None
+               and gob_class.integer_field.value is None)
+        gob_class.string_field.max_length = 3
+        gob_class.reload_class()
+        assert(gob_class().string_field.max_length == 3)
 
     def test_schema_definition(self):
         sc_class = get_schema_class()
@@ -510,6 +562,48 @@ class TestSession(TestWithGob):
     def test_commit(self):
         pass
 
+    def get_lazy_schema(self):
+        backend = get_memcached()
+        backend.lazy_hydration = True
+        return self.sc_class(
+            session=gobpersist.session.Session(backend=backend))
+
+    def test_lazy_hydration(self):
+        self.gob.save()
+        self.sc.commit()
+        try:
+            r = self.get_lazy_schema().gobtests.get(self.gob_key)
+            string_key = gobpersist.gob.field_key('string_field')
+            assert(string_key not in r.__dict__)
+            assert(r.string_field == 'example string'
+                   and not r.string_field.dirty)
+            assert(string_key in r.__dict__)
+            assert(r.integer_field == 2)
+            assert(r.list_field == [1, 2, 3])
+            assert(not r.dirty)
+        finally:
+            self.gob.remove()
+            self.sc.commit()
+
+    def test_lazy_hydration_update(self):
+        self.gob.save()
+        self.sc.commit()
+        try:
+            sc = self.get_lazy_schema()
+            r = sc.gobtests.get(self.gob_key)
+            r.string_field = 'changed example string'
+            assert(r.dirty)
+            r.save()
+            sc.commit()
+            r = get_schema_class()(session=get_session()).gobtests.get(
+                self.gob_key)
+            assert(r.string_field == 'changed example string')
+            assert(r.integer_field == 2)
+            assert(r.enum_field == 'test2')
+        finally:
+            self.gob.remove()
+            self.sc.commit()
+
     def test_repr(self):
         s = repr(self.sc.session)
         assert(isinstance(s, (str, unicode)))
@@ -577,6 +671,63 @@ class TestQuery(TestWithGob):
                           key=('gobtests', self.gob_key), limit=0)
         assert(len(r) == 0)
 
+    def test_order_limit(self):
+        gob3 = self.sc_class.gobtests(self.sc)
+        gob3.boolean_field.set(True)
+        gob3.datetime_field = datetime.datetime.utcnow()
+        gob3.string_field = 'example string 3'
+        gob3.integer_field = 97
+        gob3.real_field = 6.2831
+        gob3.enum_field = 'test1'
+        gob3.list_field = [1, 2, 3]
+        gob3.set_field = set([1, 2, 3])
+        gob3.uuid_field = str(uuid.uuid4())
+        gob3.primary_key = str(uuid.uuid4())
+        gob3.parent_key = self.gob_key
+        gob3.save()
+        self.sc.commit()
+        try:
+            key = ('gobtests', self.gob_key, 'children')
+            r = self.sc.query(self.gob_cls, key=key,
+                              order=[{'desc': 'real_field'}])
+            assert([g.primary_key for g in r]
+                   == [gob3.primary_key, self.gob2_key])
+            r = self.sc.query(self.gob_cls, key=key,
+                              order=[{'asc': 'integer_field'},
+                                     {'desc': 'enum_field'}],
+                              limit=1)
+            assert(len(r) == 1 and r[0].primary_key == self.gob2_key)
+            r = self.sc.query(self.gob_cls, key=key,
+                              order=[{'asc': 'real_field'}],
+                              offset=1, limit=5)
+            assert(len(r) == 1 and r[0].primary_key == gob3.primary_key)
+            r = self.sc.query(self.gob_cls, key=key,
+                              query={'eq': [('enum_field',), 'test1']},
+                              order=[{'asc': 'real_field'}],
+                              limit=1)
+            assert(len(r) == 1 and r[0].primary_key == gob3.primary_key)
+        finally:
+            gob3.remove()
+            self.sc.commit()
+
+    def test_iterquery(self):
+        r = self.sc.iterquery(self.gob_cls, key=('gobtests', self.gob_key))
+        assert(not isinstance(r, list))
+        r = list(r)
+        assert(len(r) == 1 and r[0] is self.gob)
+        key = ('gobtests', self.gob_key, 'children')
+        r = list(self.sc.iterquery(self.gob_cls, key=key, chunk_size=1,
+                                   query={'eq': [('integer_field',), 97]}))
+        assert(len(r) == 1 and r[0] is self.gob2)
+        r = list(self.sc.iterquery(self.gob_cls, key=key, chunk_size=1,
+                                   query={'eq': [('integer_field',), 2]}))
+        assert(len(r) == 0)
+        r = list(self.sc.gobtests.iterlist(_chunk_size=1))
+        assert(self.gob in r)
+        self.assertRaises(gobpersist.exception.NotFound,
+                          self.sc.iterquery, self.gob_cls,
+                          key=('gobtests', str(uuid.uuid4())))
+
     def test_comparison(self):
         r = self.sc.query(self.gob_cls, key=('gobtests', self.gob_key),
                           query={'eq': [('real_field',), 3.1415]})
@@ -764,6 +915,1157 @@ class TestQuery(TestWithGob):
             gob3.remove()
             self.sc.commit()
 
+    def test_compiled_query(self):
+        backend = self.sc.session.backend
+        query = {'eq': [('real_field',), 3.1415]}
+        predicate = backend.compile_query(self.gob_cls, query)
+        assert(backend.compile_query(self.gob_cls,
+                                     {'eq': [('real_field',), 3.1415]})
+               is predicate)
+        assert(predicate(self.gob))
+        assert(not predicate(self.gob2))
+        predicate = backend.compile_query(
+            self.gob_cls, {'eq': [('parent', 'real_field'), 3.1415]})
+        assert(predicate(self.gob2))
+        self.assertRaises(gobpersist.exception.QueryError,
+                          backend.compile_query, self.gob_cls,
+                          {'eq': [('no_such_field',), 1]})
+        self.assertRaises(gobpersist.exception.QueryError,
+                          backend.compile_query, self.gob_cls,
+                          {'eq': [('parent',), 1]})
+        self.assertRaises(gobpersist.exception.QueryError,
+                          backend.compile_query, self.gob_cls,
+                          {'eq': [{'some': ('children', 'real_field')}, 1]})
+        self.assertRaises(gobpersist.exception.QueryError,
+                          backend.compile_query, self.gob_cls,
+                          {'xor': []})
+
+    def test_canonical_query(self):
+        backend = self.sc.session.backend
+        query = {'and': [{'eq': [('string_field',), 'example string']},
+                         {'gt': [('integer_field',), 1]}],
+                 'ne': [('real_field',), 2.0]}
+        same = {'ne': [2.0, ('real_field',)],
+                'and': [{'lt': [1, ('integer_field',)]},
+                        {'eq': [u'example string', ('string_field',)]}]}
+        different = {'and': [{'eq': [('string_field',), 'example string']},
+                             {'lt': [('integer_field',), 1]}],
+                     'ne': [('real_field',), 2.0]}
+        assert(backend.canonical_query(self.gob_cls, query)
+               == backend.canonical_query(self.gob_cls, same))
+        assert(backend.canonical_query(self.gob_cls, query)
+               != backend.canonical_query(self.gob_cls, different))
+        digest = backend.query_digest(self.gob_cls, query)
+        assert(len(digest) == 40)
+        assert(digest == backend.query_digest(self.gob_cls, same))
+        assert(backend.compile_query(self.gob_cls, query)
+               is backend.compile_query(self.gob_cls, same))
+        # a chained ne only compares neighbours
+        chained = {'ne': [('integer_field',), 1, 5]}
+        reordered = {'ne': [1, ('integer_field',), 5]}
+        assert(backend.query_digest(self.gob_cls, chained)
+               != backend.query_digest(self.gob_cls, reordered))
+        self.gob.integer_field = 5
+        assert(backend.compile_query(self.gob_cls, chained)(self.gob)
+               != backend.compile_query(self.gob_cls, reordered)(self.gob))
+        # nor does a literal which the field would change
+        as_str = {'eq': [('datetime_field',), '2012-01-01T00:00:00']}
+        as_datetime = {'eq': [('datetime_field',),
+                              datetime.datetime(2012, 1, 1)]}
+        assert(backend.query_digest(self.gob_cls, as_str)
+               != backend.query_digest(self.gob_cls, as_datetime))
+        self.gob.datetime_field = datetime.datetime(2012, 1, 1)
+        for q in (as_str, as_datetime):
+            assert(backend.compile_query(self.gob_cls, q)(self.gob)
+                   == backend.compile_query(self.gob_cls, q,
+                                            cache=False)(self.gob))
+        assert(not backend.compile_query(self.gob_cls, as_str)(self.gob))
+        assert(backend.compile_query(self.gob_cls, as_datetime)(self.gob))
+
+
+class TestMemcachedBackend(TestWithGob):
+    def setUp(self):
+        super(TestMemcachedBackend, self).setUp()
+        self.gob_cls = self.sc_class.gobtests
+        self.gob.save()
+        self.gob2.save()
+        self.sc.commit()
+        calls = self.calls = []
+        class CountingClient(pylibmc.Client):
+            def get(self, key):
+                calls.append(key)
+                return super(CountingClient, self).get(key)
+            def get_multi(self, keys):
+                calls.append(keys)
+                return super(CountingClient, self).get_multi(keys)
+        self.backend = gobpersist.backends.memcached.MemcachedBackend(
+            expiry=60,
+            pool=gobpersist.backends.pools.SimpleThreadMappedPool(
+                client=CountingClient))
+
+    def tearDown(self):
+        self.gob.remove()
+        self.gob2.remove()
+        self.sc.commit()
+
+    def test_multi_query_references(self):
+        dumps = self.backend.serializer.dumps
+        with self.backend.pool.reserve(*self.backend.mc_args,
+                                       **self.backend.mc_kwargs) as mc:
+            mc.set('bfstests.ref1', dumps(['gobtests', self.gob_key]))
+            mc.set('bfstests.ref2', dumps(['gobtests', self.gob2_key]))
+            mc.set('bfstests.ref3', dumps(['bfstests', 'ref1']))
+            mc.set('bfstests', dumps([['bfstests', 'ref1'],
+                                      ['bfstests', 'ref2'],
+                                      ['bfstests', 'ref3']]))
+        try:
+            del self.calls[:]
+            r = self.backend.do_kv_query(self.gob_cls, ('bfstests',))
+            assert([g.primary_key for g in r]
+                   == [self.gob_key, self.gob2_key, self.gob_key])
+            # the collection, then one round trip per level of references
+            assert(len(self.calls) == 4)
+        finally:
+            with self.backend.pool.reserve(*self.backend.mc_args,
+                                           **self.backend.mc_kwargs) as mc:
+                mc.delete_multi(['bfstests', 'bfstests.ref1',
+                                 'bfstests.ref2', 'bfstests.ref3'])
+
+    def test_collection_buckets(self):
+        backend = gobpersist.backends.memcached.MemcachedBackend(
+            expiry=60, collection_buckets=4)
+        sc = self.sc_class(session=gobpersist.session.Session(backend=backend))
+        parent_key = str(uuid.uuid4())
+        children = []
+        for i in xrange(6):
+            child = self.sc_class.gobtests(sc)
+            child.primary_key = str(uuid.uuid4())
+            child.parent_key = parent_key
+            child.boolean_field = False
+            child.datetime_field = datetime.datetime.utcnow()
+            child.string_field = 'bucketed child %d' % i
+            child.integer_field = i
+            child.real_field = 0.5
+            child.enum_field = 'test1'
+            child.uuid_field = str(uuid.uuid4())
+            child.list_field = []
+            child.set_field = set()
+            child.save()
+            children.append(child)
+        sc.commit()
+        coll_key = ('gobtests', parent_key, 'children')
+        with backend.pool.reserve(*backend.mc_args, **backend.mc_kwargs) as mc:
+            assert(backend.serializer.loads(mc.get('.'.join(coll_key)))
+                   == {'_BUCKETS_': 4})
+            buckets = [mc.get('.'.join(bucket_key)) \
+                           for bucket_key in backend._bucket_keys(coll_key, 4)]
+        assert(sum([len(backend.serializer.loads(b)) \
+                        for b in buckets if b is not None]) == 6)
+        assert(sorted([g.primary_key for g in backend.kv_query(
+                        self.gob_cls, coll_key)])
+               == sorted([c.primary_key for c in children]))
+        assert(len(list(backend.kv_iterquery(self.gob_cls, coll_key,
+                                             chunk_size=4))) == 6)
+        assert(len(backend.do_kv_multi_query(self.gob_cls, [coll_key])[0])
+               == 6)
+        removed = children.pop()
+        removed.remove()
+        sc.commit()
+        assert(sorted([g.primary_key for g in backend.kv_query(
+                        self.gob_cls, coll_key)])
+               == sorted([c.primary_key for c in children]))
+        for child in children:
+            child.remove()
+        sc.commit()
+        assert(backend.kv_query(self.gob_cls, coll_key) == [])
+        # removing from a collection which does not exist creates
+        # nothing
+        missing_key = ('gobtests', str(uuid.uuid4()), 'children')
+        assert(backend._collection_changes(
+                lambda keys: {}, [],
+                [(missing_key, backend.key_to_mykey(removed.obj_key))]) == {})
+
+    def test_cas_commit(self):
+        added = []
+        interfere = [True]
+        class ConflictingClient(pylibmc.Client):
+            def add(self, key, value, time=0):
+                added.append(key)
+                return super(ConflictingClient, self).add(key, value, time)
+            def cas(self, key, value, cas, time=0):
+                if interfere[0]:
+                    # another process writes the same key first
+                    interfere[0] = False
+                    self.set(key, self.get(key))
+                return super(ConflictingClient, self).cas(key, value, cas,
+                                                          time)
+        backend = gobpersist.backends.memcached.MemcachedBackend(
+            expiry=60, use_cas=True,
+            pool=gobpersist.backends.pools.SimpleThreadMappedPool(
+                client=ConflictingClient))
+        sc = self.sc_class(session=gobpersist.session.Session(backend=backend))
+        gob = sc.gobtests.get(primary_key=self.gob_key)
+        child = self.sc_class.gobtests(sc)
+        child.primary_key = str(uuid.uuid4())
+        child.parent_key = self.gob_key
+        child.boolean_field = False
+        child.datetime_field = datetime.datetime.utcnow()
+        child.string_field = 'cas child'
+        child.integer_field = 1
+        child.real_field = 0.5
+        child.enum_field = 'test1'
+        child.uuid_field = str(uuid.uuid4())
+        child.list_field = []
+        child.set_field = set()
+        child.save()
+        sc.commit()
+        assert(not interfere[0])
+        assert(not [key for key in added if key.startswith('_lock')])
+        assert(sorted([g.primary_key for g in gob.children.list()])
+               == sorted([self.gob2_key, child.primary_key]))
+        child.remove()
+        sc.commit()
+        assert([g.primary_key for g in gob.children.list()]
+               == [self.gob2_key])
+
+    def test_cas_conflicts(self):
+        evict = [True]
+        class EvictingClient(pylibmc.Client):
+            def cas(self, key, value, cas, time=0):
+                if evict[0]:
+                    # the key is evicted between gets and cas
+                    evict[0] = False
+                    self.delete(key)
+                    raise pylibmc.NotFound(key)
+                return super(EvictingClient, self).cas(key, value, cas,
+                                                       time)
+        backend = gobpersist.backends.memcached.MemcachedBackend(
+            expiry=60, use_cas=True,
+            pool=gobpersist.backends.pools.SimpleThreadMappedPool(
+                client=EvictingClient))
+        sc = self.sc_class(session=gobpersist.session.Session(backend=backend))
+        def new_child():
+            child = self.sc_class.gobtests(sc)
+            child.primary_key = str(uuid.uuid4())
+            child.parent_key = self.gob_key
+            child.boolean_field = False
+            child.datetime_field = datetime.datetime.utcnow()
+            child.string_field = 'cas child'
+            child.integer_field = 1
+            child.real_field = 0.5
+            child.enum_field = 'test1'
+            child.uuid_field = str(uuid.uuid4())
+            child.list_field = []
+            child.set_field = set()
+            return child
+        child = new_child()
+        child.save()
+        sc.commit()
+        try:
+            # the evicted collection was created afresh
+            assert(not evict[0])
+            assert([g.primary_key for g in backend.kv_query(
+                        self.gob_cls, ('gobtests', self.gob_key, 'children'))]
+                   == [child.primary_key])
+            # a unique key which exists already is not overwritten
+            other = new_child()
+            other.timestamp_field = child.timestamp_field
+            other.save()
+            try:
+                sc.commit()
+                assert(False)
+            except gobpersist.exception.ConditionFailed:
+                pass
+            res = backend.kv_query(self.gob_cls,
+                                   ('gobtests_by_timestamp',
+                                    child.timestamp_field))
+            assert([g.primary_key for g in res] == [child.primary_key])
+            try:
+                backend.kv_query(self.gob_cls, other.obj_key)
+                assert(False)
+            except gobpersist.exception.NotFound:
+                pass
+        finally:
+            sc.rollback()
+            child.remove()
+            sc.commit()
+
+    def test_prefetch(self):
+        sc = self.sc_class(session=gobpersist.session.Session(
+                backend=self.backend))
+        gobs = sc.query(self.gob_cls, key=('gobtests',))
+        gobs.append(sc.gobtests.get(self.gob2_key))
+        del self.calls[:]
+        sc.prefetch(gobs, 'parent')
+        assert(len(self.calls) == 1)
+        del self.calls[:]
+        assert(gobs[-1].parent.value is gobs[0])
+        assert(self.calls == [])
+        gob = sc.query(self.gob_cls, key=self.gob.obj_key,
+                       prefetch=['children'])[0]
+        del self.calls[:]
+        assert([g.primary_key for g in gob.children.list()]
+               == [self.gob2_key])
+        assert(self.calls == [])
+        # a query still goes to the back end
+        assert(gob.children.list(integer_field=0) == [])
+        assert(len(self.calls) > 0)
+        # what was prefetched is forgotten by a commit
+        sc.commit()
+        del self.calls[:]
+        assert([g.primary_key for g in gob.children.list()]
+               == [self.gob2_key])
+        assert(len(self.calls) > 0)
+        # and by a change through the collection
+        children = gob.children.value
+        children.prefetched = children.list()
+        children.update(children.prefetched[0])
+        assert(children.prefetched is None)
+
+    def test_get_many(self):
+        sc = self.sc_class(session=gobpersist.session.Session(
+                backend=self.backend))
+        del self.calls[:]
+        res = sc.gobtests.get_many([self.gob_key, str(uuid.uuid4()),
+                                    self.gob2_key])
+        assert(len(self.calls) == 1)
+        assert(res[0].primary_key == self.gob_key)
+        assert(res[1] is None)
+        assert(res[2].primary_key == self.gob2_key)
+        assert(sc.gobtests.get(self.gob_key) is res[0])
+
+    def test_bulk_add(self):
+        children = []
+        for i in xrange(5):
+            child = self.sc_class.gobtests(self.sc)
+            child.primary_key = str(uuid.uuid4())
+            child.parent_key = self.gob_key
+            child.boolean_field = False
+            child.datetime_field = datetime.datetime.utcnow()
+            child.string_field = 'bulk child %d' % i
+            child.integer_field = i
+            child.real_field = 0.5
+            child.enum_field = 'test1'
+            child.uuid_field = str(uuid.uuid4())
+            child.list_field = []
+            child.set_field = set()
+            children.append(child)
+        assert(self.sc.bulk_add(iter(children), batch_size=2) == 5)
+        try:
+            assert(not [child for child in children if child.dirty])
+            gob = self.sc.gobtests.get(self.gob_key)
+            assert(sorted([g.primary_key for g in gob.children.list()])
+                   == sorted([self.gob2_key]
+                             + [child.primary_key for child in children]))
+            res = self.sc.gobtests.get_many([child.primary_key
+                                             for child in children])
+            assert([g.string_field for g in res]
+                   == ['bulk child %d' % i for i in xrange(5)])
+        finally:
+            for child in children:
+                child.remove()
+            self.sc.commit()
+
+    def test_bulk_add_unique(self):
+        def new_child(i):
+            child = self.sc_class.gobtests(self.sc)
+            child.primary_key = str(uuid.uuid4())
+            child.parent_key = self.gob_key
+            child.boolean_field = False
+            child.datetime_field = datetime.datetime.utcnow()
+            child.timestamp_field = datetime.datetime(2012, 1, 1, 0, 0, i)
+            child.string_field = 'bulk child %d' % i
+            child.integer_field = i
+            child.real_field = 0.5
+            child.enum_field = 'test1'
+            child.uuid_field = str(uuid.uuid4())
+            child.list_field = []
+            child.set_field = set()
+            return child
+        first = new_child(0)
+        assert(self.sc.bulk_add([first]) == 1)
+        try:
+            # a later batch reusing the unique key is refused whole
+            second = new_child(1)
+            third = new_child(0)
+            try:
+                self.sc.bulk_add([second, third])
+                assert(False)
+            except gobpersist.exception.Corruption:
+                pass
+            res = self.sc.query(self.gob_cls,
+                                key=('gobtests_by_timestamp',
+                                     first.timestamp_field))
+            assert([g.primary_key for g in res] == [first.primary_key])
+            for key in (('gobtests', second.primary_key),
+                        ('gobtests_by_timestamp', second.timestamp_field)):
+                try:
+                    self.sc.query(self.gob_cls, key=key)
+                    assert(False)
+                except gobpersist.exception.NotFound:
+                    pass
+        finally:
+            first.remove()
+            self.sc.commit()
+
+    def test_cas_bulk_add(self):
+        added = []
+        interfere = [True]
+        class ConflictingClient(pylibmc.Client):
+            def add(self, key, value, time=0):
+                added.append(key)
+                return super(ConflictingClient, self).add(key, value, time)
+            def cas(self, key, value, cas, time=0):
+                if interfere[0]:
+                    # another process writes the same key first
+                    interfere[0] = False
+                    self.set(key, self.get(key))
+                return super(ConflictingClient, self).cas(key, value, cas,
+                                                          time)
+        backend = gobpersist.backends.memcached.MemcachedBackend(
+            expiry=60, use_cas=True,
+            pool=gobpersist.backends.pools.SimpleThreadMappedPool(
+                client=ConflictingClient))
+        sc = self.sc_class(session=gobpersist.session.Session(backend=backend))
+        children = []
+        for i in xrange(3):
+            child = self.sc_class.gobtests(sc)
+            child.primary_key = str(uuid.uuid4())
+            child.parent_key = self.gob_key
+            child.boolean_field = False
+            child.datetime_field = datetime.datetime.utcnow()
+            child.string_field = 'cas bulk child %d' % i
+            child.integer_field = i
+            child.real_field = 0.5
+            child.enum_field = 'test1'
+            child.uuid_field = str(uuid.uuid4())
+            child.list_field = []
+            child.set_field = set()
+            children.append(child)
+        assert(sc.bulk_add(children) == 3)
+        try:
+            assert(not interfere[0])
+            assert(not [key for key in added if key.startswith('_lock')])
+            gob = sc.gobtests.get(self.gob_key)
+            assert(sorted([g.primary_key for g in gob.children.list()])
+                   == sorted([self.gob2_key]
+                             + [child.primary_key for child in children]))
+        finally:
+            for child in children:
+                child.remove()
+            sc.commit()
+
+    def test_lock_manager(self):
+        added = []
+        class RecordingClient(pylibmc.Client):
+            # shaped like pylibmc, which has add_multi
+            def add_multi(self, mapping, time=0):
+                added.append((sorted(mapping), time))
+                return [key for key, value in mapping.iteritems() \
+                            if not self.add(key, value, time)]
+        backend = gobpersist.backends.memcached.MemcachedBackend(
+            expiry=60, lock_tries=2, lock_backoff=0.001, lock_lease=5,
+            pool=gobpersist.backends.pools.SimpleThreadMappedPool(
+                client=RecordingClient))
+        manager = backend.lock_manager
+        manager.batch_size = 2
+        locks = ['_lock.c', '_lock.a', '_lock.d', '_lock.b']
+        try:
+            assert(backend.try_acquire_locks(locks))
+            # sorted, in batches, and every lock is a lease
+            assert(added == [(['_lock.a', '_lock.b'], 5),
+                             (['_lock.c', '_lock.d'], 5)])
+            assert(not backend.try_acquire_locks(['_lock.0', '_lock.c']))
+            # the partial acquisition was backed out
+            assert(backend.try_acquire_locks(['_lock.0']))
+            backend.release_locks(['_lock.0'])
+            assert(manager.stats['acquired'] == 2)
+            assert(manager.stats['contended'] == 1)
+            # still held under a valid lease, so never taken
+            try:
+                backend.acquire_locks(['_lock.a'])
+                assert(False)
+            except gobpersist.exception.Deadlock:
+                pass
+            assert(manager.stats['failed'] == 1)
+            assert(manager.stats['retries'] == 1)
+            assert(manager.backoff == 0.01)
+        finally:
+            backend.release_locks(locks)
+
+
+class TestMemcachedCache(TestWithGob):
+    def setUp(self):
+        super(TestMemcachedCache, self).setUp()
+        self.gob_cls = self.sc_class.gobtests
+        calls = self.calls = []
+        class CountingClient(pylibmc.Client):
+            def get(self, key):
+                calls.append(key)
+                return super(CountingClient, self).get(key)
+            def get_multi(self, keys):
+                calls.append(keys)
+                return super(CountingClient, self).get_multi(keys)
+        self.cache = gobpersist.backends.memcached.MemcachedCache(
+            expiry=60,
+            pool=gobpersist.backends.pools.SimpleThreadMappedPool(
+                client=CountingClient))
+        self.key = ('cachetests', str(uuid.uuid4()))
+        self.query = {'eq': [('integer_field',), 97]}
+
+    def tearDown(self):
+        self.cache.invalidate([self.gob, self.gob2], [self.key])
+
+    def test_query_single_probe(self):
+        self.gob.mark_persisted()
+        self.gob2.mark_persisted()
+        # a full miss
+        del self.calls[:]
+        try:
+            self.cache.query(self.gob_cls, key=self.key, query=self.query,
+                             offset=0, limit=5)
+            assert(False)
+        except gobpersist.exception.NotFound:
+            pass
+        assert(len(self.calls) == 1)
+        assert(len(self.calls[0]) == 3)
+        # a hit on the most specific key
+        self.cache.cache_query(self.gob_cls, [self.gob2], key=self.key,
+                               query=self.query, offset=0, limit=5)
+        del self.calls[:]
+        res = self.cache.query(self.gob_cls, key=self.key, query=self.query,
+                               offset=0, limit=5)
+        assert([g.primary_key for g in res] == [self.gob2_key])
+        # the probe, then the members
+        assert(len(self.calls) == 2)
+        # a hit on the general key is filtered locally
+        self.cache.cache_query(self.gob_cls, [self.gob, self.gob2],
+                               key=self.key)
+        res = self.cache.query(self.gob_cls, key=self.key, query=self.query,
+                               offset=0, limit=5)
+        assert([g.primary_key for g in res] == [self.gob2_key])
+
+    def test_generations(self):
+        self.cache.use_generations = True
+        self.gob.mark_persisted()
+        self.gob2.mark_persisted()
+        children = self.key + ('children',)
+        self.cache.cache_query(self.gob_cls, [self.gob2], key=children,
+                               query=self.query)
+        res = self.cache.query(self.gob_cls, key=children, query=self.query)
+        assert([g.primary_key for g in res] == [self.gob2_key])
+        # objects are still cached under their own keys
+        res = self.cache.query(self.gob_cls, key=self.gob2.obj_key)
+        assert([g.primary_key for g in res] == [self.gob2_key])
+        del self.calls[:]
+        self.cache.invalidate(keys=[children])
+        # no keyset walk
+        assert(self.calls == [])
+        self.assertRaises(gobpersist.exception.NotFound, self.cache.query,
+                          self.gob_cls, key=children, query=self.query)
+        res = self.cache.query(self.gob_cls, key=self.gob2.obj_key)
+        assert([g.primary_key for g in res] == [self.gob2_key])
+        self.cache.invalidate([self.gob2])
+        self.assertRaises(gobpersist.exception.NotFound, self.cache.query,
+                          self.gob_cls, key=self.gob2.obj_key)
+
+
+class TestCachingBackend(TestWithGob):
+    def setUp(self):
+        super(TestCachingBackend, self).setUp()
+        self.gob_cls = self.sc_class.gobtests
+        self.cache = gobpersist.backends.memcached.MemcachedCache(expiry=60)
+        self.key = ('cachetests', str(uuid.uuid4()))
+        self.gob.mark_persisted()
+        self.gob2.mark_persisted()
+        queries = self.queries = []
+        missing = self.missing = set()
+        gobs = [self.gob, self.gob2]
+        class SlowBackend(gobpersist.session.Backend):
+            def query(self, cls, key=None, key_range=None, query=None,
+                      retrieve=None, order=None, offset=None, limit=None):
+                queries.append(key)
+                time.sleep(0.05)
+                if key in missing:
+                    raise gobpersist.exception.NotFound()
+                return gobs
+            def commit(self, additions=[], updates=[], removals=[],
+                       collection_additions=[], collection_removals=[]):
+                return []
+        self.caching = gobpersist.backends.cache.CachingBackend(
+            self.cache, SlowBackend(), lease_time=1, lease_wait=0.01)
+
+    def tearDown(self):
+        self.cache.invalidate([self.gob, self.gob2], [self.key])
+
+    def test_single_flight(self):
+        results = []
+        def query():
+            results.append(self.caching.query(self.gob_cls, key=self.key))
+        threads = [threading.Thread(target=query) for i in xrange(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert(len(self.queries) == 1)
+        assert(len(results) == 5)
+        for res in results:
+            assert(sorted([g.primary_key for g in res])
+                   == sorted([self.gob_key, self.gob2_key]))
+
+    def test_lease(self):
+        flight_key = self.caching._flight_key(self.gob_cls, self.key, None,
+                                              None, None, None, None, None)
+        # another process is refilling
+        assert(self.cache.acquire_lease(flight_key, 1))
+        assert(not self.cache.acquire_lease(flight_key, 1))
+        timer = threading.Timer(0.05, self.cache.cache_query,
+                                (self.gob_cls, [self.gob], self.key))
+        timer.start()
+        try:
+            res = self.caching.query(self.gob_cls, key=self.key)
+        finally:
+            timer.join()
+            self.cache.release_lease(flight_key)
+        assert([g.primary_key for g in res] == [self.gob_key])
+        assert(self.queries == [])
+
+    def test_generation_race(self):
+        self.cache.use_generations = True
+        cache = self.cache
+        queries = []
+        class RacingBackend(gobpersist.session.Backend):
+            def query(self, cls, key=None, key_range=None, query=None,
+                      retrieve=None, order=None, offset=None, limit=None):
+                queries.append(key)
+                if len(queries) == 1:
+                    # A commit lands while the answer is on its way
+                    cache.invalidate([], [key])
+                    return []
+                return [self.gob]
+        backend = RacingBackend()
+        backend.gob = self.gob
+        caching = gobpersist.backends.cache.CachingBackend(
+            self.cache, backend, lease_time=None)
+        res = caching.query(self.gob_cls, key=self.key)
+        # the outdated answer was stored under its own generation, so
+        # the query was made again
+        assert(len(queries) == 2)
+        assert([g.primary_key for g in res] == [self.gob_key])
+
+    def test_serve_stale(self):
+        self.caching.serve_stale = True
+        self.caching.query(self.gob_cls, key=self.key)
+        self.cache.invalidate(keys=[self.key])
+        flight_key = self.caching._flight_key(self.gob_cls, self.key, None,
+                                              None, None, None, None, None)
+        assert(self.cache.acquire_lease(flight_key, 1))
+        try:
+            res = self.caching.query(self.gob_cls, key=self.key)
+        finally:
+            self.cache.release_lease(flight_key)
+        assert(sorted([g.primary_key for g in res])
+               == sorted([self.gob_key, self.gob2_key]))
+        assert(len(self.queries) == 1)
+        # a commit of one of the results forgets it
+        self.caching.commit(updates=[{'gob': self.gob2}])
+        assert(self.caching._get_stale(flight_key) is None)
+        # as does age
+        self.caching.query(self.gob_cls, key=self.key)
+        assert(self.caching._get_stale(flight_key) is not None)
+        self.caching.stale_age = -1
+        assert(self.caching._get_stale(flight_key) is None)
+
+    def test_flight_key(self):
+        def flight_key(retrieve, order):
+            return self.caching._flight_key(self.gob_cls, self.key, None,
+                                            None, retrieve, order, None,
+                                            None)
+        by_integer = flight_key(None, [{'asc': self.gob_cls.integer_field}])
+        assert(by_integer
+               != flight_key(None, [{'asc': self.gob_cls.string_field}]))
+        assert(by_integer == flight_key(None, [{'asc': ('integer_field',)}]))
+        assert(flight_key([self.gob_cls.integer_field], None)
+               != flight_key([self.gob_cls.string_field], None))
+        assert(flight_key([self.gob_cls.integer_field], None)
+               == flight_key(['integer_field'], None))
+
+    def test_negative(self):
+        self.missing.add(self.key)
+        for i in xrange(2):
+            try:
+                self.caching.query(self.gob_cls, key=self.key)
+                assert(False)
+            except gobpersist.exception.NotFound:
+                pass
+        assert(len(self.queries) == 1)
+        # invalidation forgets the miss
+        self.missing.clear()
+        self.cache.invalidate(keys=[self.key])
+        res = self.caching.query(self.gob_cls, key=self.key)
+        assert(len(res) == 2)
+        assert(len(self.queries) == 2)
+
+    def test_multi_query(self):
+        other = ('cachetests', str(uuid.uuid4()))
+        self.cache.cache_query(self.gob_cls, [self.gob], key=self.key)
+        try:
+            for i in xrange(2):
+                res = self.caching.multi_query(self.gob_cls, [self.key, other])
+                assert([g.primary_key for g in res[0]] == [self.gob_key])
+                assert(len(res[1]) == 2)
+            # only the miss was refilled, and only once
+            assert(self.queries == [other])
+        finally:
+            self.cache.invalidate(keys=[other])
+
+    def test_write_through(self):
+        self.caching.query(self.gob_cls, key=self.key)
+        self.caching.write_through = True
+        self.gob.integer_field = 17
+        self.caching.commit(updates=[{'gob': self.gob}],
+                            collection_additions=[self.key])
+        res = self.cache.query(self.gob_cls, key=self.gob.obj_key)
+        assert(res[0].integer_field == 17)
+        try:
+            self.cache.query(self.gob_cls, key=self.key)
+            assert(False)
+        except gobpersist.exception.NotFound:
+            pass
+        # a version cached while the commit is under way may be the
+        # newer one, so it is removed rather than overwritten
+        cache = self.cache
+        gob = self.gob
+        class RacingBackend(gobpersist.session.Backend):
+            def commit(self, additions=[], updates=[], removals=[],
+                       collection_additions=[], collection_removals=[]):
+                cache.cache_items([gob])
+                return []
+        caching = gobpersist.backends.cache.CachingBackend(
+            self.cache, RacingBackend(), write_through=True)
+        self.gob.integer_field = 18
+        caching.commit(updates=[{'gob': self.gob}])
+        try:
+            self.cache.query(self.gob_cls, key=self.gob.obj_key)
+            assert(False)
+        except gobpersist.exception.NotFound:
+            pass
+        # as is one evicted in the meantime
+        class EvictingClient(pylibmc.Client):
+            # pylibmc raises rather than returning false
+            def cas(self, key, value, cas, time=0):
+                if self.get(key) is None:
+                    raise pylibmc.NotFound(key)
+                return super(EvictingClient, self).cas(key, value, cas,
+                                                       time)
+        cache = gobpersist.backends.memcached.MemcachedCache(
+            expiry=60, pool=gobpersist.backends.pools.SimpleThreadMappedPool(
+                client=EvictingClient))
+        class EvictingBackend(gobpersist.session.Backend):
+            def commit(self, additions=[], updates=[], removals=[],
+                       collection_additions=[], collection_removals=[]):
+                cache.invalidate([gob])
+                return []
+        cache.cache_items([self.gob])
+        caching = gobpersist.backends.cache.CachingBackend(
+            cache, EvictingBackend(), write_through=True)
+        self.gob.integer_field = 19
+        caching.commit(updates=[{'gob': self.gob}])
+        try:
+            cache.query(self.gob_cls, key=self.gob.obj_key)
+            assert(False)
+        except gobpersist.exception.NotFound:
+            pass
+
+
+class TestLocalCache(TestWithGob):
+    def setUp(self):
+        super(TestLocalCache, self).setUp()
+        self.gob_cls = self.sc_class.gobtests
+        self.shared = gobpersist.backends.memcached.MemcachedCache(expiry=60)
+        self.cache = gobpersist.backends.localcache.LocalCache(self.shared)
+        self.key = ('cachetests', str(uuid.uuid4()))
+        self.gob.mark_persisted()
+        self.gob2.mark_persisted()
+
+    def tearDown(self):
+        self.cache.invalidate([self.gob, self.gob2], [self.key])
+
+    def test_layers(self):
+        self.shared.cache_query(self.gob_cls, [self.gob, self.gob2],
+                                key=self.key)
+        res = self.cache.query(self.gob_cls, key=self.key)
+        assert(sorted([g.primary_key for g in res])
+               == sorted([self.gob_key, self.gob2_key]))
+        # now served without the shared cache
+        self.shared.invalidate(keys=[self.key])
+        res = self.cache.query(self.gob_cls, key=self.key)
+        assert(len(res) == 2)
+        assert(res[0] is not self.cache.query(self.gob_cls, key=self.key)[0])
+        # invalidation reaches both layers
+        self.cache.cache_query(self.gob_cls, [self.gob], key=self.key)
+        self.cache.invalidate([self.gob])
+        for cache in (self.cache, self.shared):
+            try:
+                cache.query(self.gob_cls, key=self.key)
+                assert(False)
+            except gobpersist.exception.NotFound:
+                pass
+
+    def test_order_key(self):
+        def query_key(order):
+            return self.cache._query_key(self.gob_cls, self.key, None, None,
+                                         None, order, None, None)
+        by_integer = query_key([{'asc': self.gob_cls.integer_field}])
+        assert(by_integer
+               != query_key([{'asc': self.gob_cls.string_field}]))
+        assert(by_integer == query_key([{'asc': ('integer_field',)}]))
+
+    def test_bounds(self):
+        cache = gobpersist.backends.localcache.LocalCache(
+            max_entries=2, class_ttls={self.gob_cls: 0.01})
+        cache.cache_items([self.gob, self.gob2])
+        assert(len(cache.entries) == 2)
+        assert(cache.query(self.gob_cls, key=self.gob2.obj_key)[0].primary_key
+               == self.gob2_key)
+        time.sleep(0.02)
+        try:
+            cache.query(self.gob_cls, key=self.gob2.obj_key)
+            assert(False)
+        except gobpersist.exception.NotFound:
+            pass
+        assert(len(cache.entries) == 1)
+        cache.max_bytes = 0
+        cache.cache_items([self.gob])
+        assert(len(cache.entries) == 0)
+        assert(cache.size == 0)
+
+
+class TestUnixDatagramBus(TestWithGob):
+    def setUp(self):
+        super(TestUnixDatagramBus, self).setUp()
+        self.gob_cls = self.sc_class.gobtests
+        self.gob.mark_persisted()
+        self.directory = tempfile.mkdtemp()
+        self.buses = [gobpersist.backends.invalidation.UnixDatagramBus(
+                self.directory, max_datagram=64) for i in xrange(2)]
+        self.caches = [gobpersist.backends.localcache.LocalCache(bus=bus) \
+                           for bus in self.buses]
+
+    def tearDown(self):
+        for bus in self.buses:
+            bus.close()
+        shutil.rmtree(self.directory)
+
+    def wait_for(self, condition):
+        deadline = time.time() + 2
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_publish(self):
+        received = []
+        self.buses[1].subscribe(received.extend)
+        keys = [('key', str(i)) for i in xrange(10)]
+        self.buses[0].publish(keys)
+        assert(self.wait_for(lambda: len(received) == 10))
+        assert(sorted(received) == sorted(keys))
+
+    def test_invalidate(self):
+        for cache in self.caches:
+            cache.cache_items([self.gob])
+        self.caches[0].invalidate([self.gob])
+        assert(len(self.caches[0].entries) == 0)
+        assert(self.wait_for(lambda: len(self.caches[1].entries) == 0))
+
+    def test_key_values(self):
+        received = []
+        self.buses[1].subscribe(received.extend)
+        keys = [('key', datetime.datetime(2012, 1, 1)),
+                ('key', '\xff\xfe'),
+                ('key', ('nested', 1))]
+        self.buses[0].publish(keys)
+        assert(self.wait_for(lambda: len(received) == 3))
+        assert(set(received) == set(keys))
+
+    def test_datetime_key(self):
+        self.gob.timestamp_field = datetime.datetime.utcnow()
+        shared = gobpersist.backends.memcached.MemcachedCache(expiry=60)
+        cache = gobpersist.backends.localcache.LocalCache(
+            shared, bus=self.buses[0])
+        cache.cache_items([self.gob])
+        self.caches[1].cache_items([self.gob])
+        cache.invalidate([self.gob])
+        try:
+            shared.query(self.gob_cls, key=self.gob.obj_key)
+            assert(False)
+        except gobpersist.exception.NotFound:
+            pass
+        assert(self.wait_for(lambda: len(self.caches[1].entries) == 0))
+
+    def test_publish_failure(self):
+        class BrokenBus(gobpersist.backends.invalidation.InvalidationBus):
+            def publish(self, keys):
+                raise socket.error(errno.EPERM, "broken")
+        shared = gobpersist.backends.memcached.MemcachedCache(expiry=60)
+        cache = gobpersist.backends.localcache.LocalCache(
+            shared, bus=BrokenBus())
+        cache.cache_items([self.gob])
+        try:
+            cache.invalidate([self.gob])
+            assert(False)
+        except socket.error:
+            pass
+        # the shared cache was invalidated all the same
+        try:
+            shared.query(self.gob_cls, key=self.gob.obj_key)
+            assert(False)
+        except gobpersist.exception.NotFound:
+            pass
+
+    def test_dead_peer(self):
+        self.buses[1].close()
+        dead = os.path.join(self.directory, '1.dead.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(dead)
+        sock.close()
+        self.buses[0].publish([('key',)])
+        assert(os.listdir(self.directory)
+               == [os.path.basename(self.buses[0].path)])
+
+
+class TestDump(TestWithGob):
+    def setUp(self):
+        super(TestDump, self).setUp()
+        self.gob.save()
+        self.gob2.save()
+        self.sc.commit()
+        self.target = self.sc_class(session=gobpersist.session.Session(
+                backend=gobpersist.backends.memcached.MemcachedBackend(
+                    expiry=60, separator=':')))
+
+    def tearDown(self):
+        self.gob.remove()
+        self.gob2.remove()
+        self.sc.commit()
+        for gob in self.target.gobtests.get_many([self.gob_key,
+                                                  self.gob2_key]):
+            if gob is not None:
+                gob.remove()
+        self.target.commit()
+
+    def test_dump_restore(self):
+        fp = StringIO.StringIO()
+        count = gobpersist.dump.dump(self.sc, fp, chunk_size=1)
+        assert(count >= 2)
+        fp.seek(0)
+        assert(gobpersist.dump.restore(self.target, fp, batch_size=1)
+               == count)
+        gob, gob2 = self.target.gobtests.get_many([self.gob_key,
+                                                   self.gob2_key])
+        assert(gob.string_field == 'example string')
+        assert(gob2.parent_key == self.gob_key)
+        assert([g.primary_key for g in gob.children.list()]
+               == [self.gob2_key])
+        assert(self.gob_key in [g.primary_key
+                                for g in self.target.gobtests.list()])
+
+    def test_multiple_keys(self):
+        class DumpItem(gobpersist.gob.Gob):
+            item_key = gobpersist.field.UUIDField(primary_key=True)
+            tag = gobpersist.field.StringField(encoding='UTF-8')
+            keys = [('dumpitems_by_tag', tag), ('dumpitems',)]
+        class DumpSchema(gobpersist.schema.Schema):
+            dumpitems = DumpItem
+        sc = DumpSchema(session=get_session())
+        item = DumpItem(sc)
+        item.primary_key = str(uuid.uuid4())
+        item.tag = 'tag'
+        item.save()
+        sc.commit()
+        try:
+            assert(len(sc.dumpitems.list()) == 1)
+            # found first under a key which is never walked, but
+            # dumped from the collection key of its class
+            fp = StringIO.StringIO()
+            assert(gobpersist.dump.dump(sc, fp) == 1)
+            fp.seek(0)
+            target = DumpSchema(session=self.target.session)
+            assert(gobpersist.dump.restore(target, fp) == 1)
+            res = target.dumpitems.list()
+            assert([g.primary_key for g in res] == [item.primary_key])
+            res[0].remove()
+            target.commit()
+        finally:
+            item.remove()
+            sc.commit()
+
+    def test_truncated(self):
+        fp = StringIO.StringIO()
+        gobpersist.dump.dump(self.sc, fp)
+        fp = StringIO.StringIO(fp.getvalue()[:-1])
+        try:
+            gobpersist.dump.restore(self.target, fp)
+            assert(False)
+        except ValueError:
+            pass
+
+
+class TestSchemaSerializer(TestWithGob):
+    def setUp(self):
+        super(TestSchemaSerializer, self).setUp()
+        self.serializer = gobpersist.backends.serializer.SchemaSerializer(
+            [self.sc_class.gobtests])
+        self.mygob = self.sc.session.gob_to_mygob(self.gob)
+
+    def test_roundtrip(self):
+        data = self.serializer.dumps(self.mygob)
+        assert(data[0] == gobpersist.backends.serializer.MAGIC)
+        assert(len(data) < len(gobpersist.backends.memcached.JsonWrapper \
+                                   .dumps(self.mygob)))
+        assert(len(data) < len(gobpersist.backends.memcached.PickleWrapper \
+                                   .dumps(self.mygob)))
+        assert(self.serializer.loads(data) == self.mygob)
+        mygob2 = self.sc.session.gob_to_mygob(self.gob2)
+        assert(self.serializer.loads(
+                self.serializer.dumps([self.mygob, mygob2]))
+               == [self.mygob, mygob2])
+        for value in (('gobtests', self.gob_key), [], '_NOT_FOUND_',
+                      {'_BUCKETS_': ['a']}, [self.mygob, 'other']):
+            assert(self.serializer.loads(self.serializer.dumps(value))
+                   == value)
+
+    def test_fallback(self):
+        # A timezone-aware datetime is stored in UTC
+        class PlusOne(datetime.tzinfo):
+            def utcoffset(self, dt):
+                return datetime.timedelta(hours=1)
+        self.mygob['datetime_field'] = datetime.datetime(
+            2012, 1, 1, 12, 0, 0, tzinfo=PlusOne())
+        res = self.serializer.loads(self.serializer.dumps(self.mygob))
+        assert(res['datetime_field'] == datetime.datetime(2012, 1, 1, 11))
+        # A value not fitting its field is pickled
+        self.mygob['datetime_field'] = datetime.datetime(2012, 1, 1)
+        self.mygob['uuid_field'] = datetime.datetime(2012, 1, 1)
+        data = self.serializer.dumps(self.mygob)
+        assert(data[0] == '\x80')
+        assert(self.serializer.loads(data) == self.mygob)
+
+    def test_legacy(self):
+        json_data = gobpersist.backends.memcached.JsonWrapper.dumps(
+            self.mygob)
+        assert(self.serializer.loads(json_data)['string_field']
+               == 'example string')
+        for protocol in (0, 2):
+            assert(self.serializer.loads(pickle.dumps(self.mygob, protocol))
+                   == self.mygob)
+        other = gobpersist.backends.serializer.SchemaSerializer([])
+        try:
+            other.loads(self.serializer.dumps(self.mygob))
+            assert(False)
+        except ValueError:
+            pass
+
+    def test_backend(self):
+        sc = self.sc_class(session=gobpersist.session.Session(
+                backend=gobpersist.backends.memcached.MemcachedBackend(
+                    expiry=60, separator='|', serializer=self.serializer)))
+        gob = self.sc_class.gobtests(
+            sc, **dict([(k, v) for k, v in self.mygob.iteritems() \
+                            if v is not None]))
+        gob.save()
+        sc.commit()
+        try:
+            gotten_gob = sc.gobtests.get(self.gob_key)
+            assert(gotten_gob.uuid_field == self.gob.uuid_field)
+            assert(gotten_gob.datetime_field == self.gob.datetime_field)
+            assert(gotten_gob.set_field == set([1, 2, 3]))
+        finally:
+            gob.remove()
+            sc.commit()
+
+
+class TestBoundedPool(unittest.TestCase):
+    def setUp(self):
+        self.closed = closed = []
+        self.healthy = healthy = [True]
+        class Client(object):
+            def __init__(self, name):
+                self.name = name
+            def close(self):
+                closed.append(self)
+        self.pool = gobpersist.backends.pools.BoundedPool(
+            client=Client, max_size=2, timeout=0.01,
+            check=lambda client: healthy[0], check_idle=0)
+
+    def test_reuse(self):
+        with self.pool.reserve('a') as client:
+            with self.pool.reserve('a') as nested:
+                assert(nested is client)
+        with self.pool.reserve('a') as again:
+            assert(again is client)
+        assert(self.pool.size == 1)
+
+    def test_bound(self):
+        with self.pool.reserve('a') as a:
+            with self.pool.reserve('b') as b:
+                assert(a is not b)
+                try:
+                    with self.pool.reserve('c'):
+                        pass
+                    assert(False)
+                except gobpersist.exception.PoolTimeout:
+                    pass
+        # idle clients for other arguments make room
+        with self.pool.reserve('c') as c:
+            assert(c.name == 'c')
+        assert(self.pool.size == 2)
+        assert(len(self.closed) == 1)
+
+    def test_discard(self):
+        try:
+            with self.pool.reserve('a') as client:
+                raise gobpersist.exception.NotFound()
+        except gobpersist.exception.NotFound:
+            pass
+        # not the client's fault, so kept
+        assert(self.closed == [])
+        assert(self.pool.size == 1)
+        try:
+            with self.pool.reserve('a') as again:
+                assert(again is client)
+                raise socket.error()
+        except socket.error:
+            pass
+        assert(self.closed == [client])
+        assert(self.pool.size == 0)
+        with self.pool.reserve('a') as client:
+            pass
+        self.healthy[0] = False
+        with self.pool.reserve('a') as replacement:
+            assert(replacement is not client)
+        assert(self.closed[-1] is client)
+        assert(self.pool.size == 1)
+
+    def test_warm(self):
+        assert(self.pool.warm(3, 'a') == 2)
+        warmed = [h['client'] for h in self.pool.idle]
+        with self.pool.reserve('a') as client:
+            assert(client in warmed)
+        assert(self.pool.warm(1, 'a') == 0)
+        assert(self.closed == [])
+
+    def test_fork(self):
+        with self.pool.reserve('a') as client:
+            pass
+        # pretend to be a child of the process which opened the client
+        self.pool.pid = -1
+        with self.pool.reserve('a') as child_client:
+            assert(child_client is not client)
+        # the parent's socket is left alone
+        assert(self.closed == [])
+        assert(self.pool.size == 1)
+
 
 class TestStorage(TestWithGob):
     # currently no supported storage engine with which to test...